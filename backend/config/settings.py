@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -57,12 +58,13 @@ REST_FRAMEWORK = {
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'markets.profiling.ProfilingMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'markets.middleware.UserProfileAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -86,6 +88,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'config.wsgi.application'
+ASGI_APPLICATION = 'config.asgi.application'
 
 
 # Database
@@ -104,6 +107,114 @@ database_url = os.environ.get("DATABASE_URL")
 if database_url:
     DATABASES["default"] = dj_database_url.parse(database_url)
 
+# Resolved markets are moved to the archive after ARCHIVE_AFTER_DAYS
+# (see markets/archive.py). Point ARCHIVE_DATABASE_URL at a separate
+# database to keep cold data off the primary.
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_DATABASE = 'default'
+
+archive_database_url = os.environ.get("ARCHIVE_DATABASE_URL")
+if archive_database_url:
+    DATABASES["archive"] = dj_database_url.parse(archive_database_url)
+    ARCHIVE_DATABASE = "archive"
+
+# Markets (with their outcomes, positions, trades, orders and comments) can
+# be spread over several databases; see markets/sharding.py. The default
+# database is always the first shard. MARKET_SHARD_URLS adds more, e.g.
+# "sqlite:///shard1.sqlite3,sqlite:///shard2.sqlite3". Run
+# `migrate --database <alias>` for every shard.
+MARKET_SHARDS = ['default']
+for i, shard_url in enumerate(filter(None, os.environ.get('MARKET_SHARD_URLS', '').split(',')), start=1):
+    DATABASES[f'shard{i}'] = dj_database_url.parse(shard_url.strip())
+    MARKET_SHARDS.append(f'shard{i}')
+MARKET_SHARD_WORKERS = int(os.environ.get('MARKET_SHARD_WORKERS', '8'))
+# The test run always gets a second database so the sharded code paths are
+# covered; tests opt in with override_settings(MARKET_SHARDS=...).
+if sys.argv[1:2] == ['test'] and 'shard1' not in DATABASES:
+    DATABASES['shard1'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'shard1.sqlite3'}
+DATABASE_ROUTERS = ['markets.sharding.ShardRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Shared state (rate limit buckets) needs a cache every worker can see.
+# Set REDIS_URL in production; local dev falls back to per-process memory.
+
+redis_url = os.environ.get('REDIS_URL')
+if redis_url:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': redis_url,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
+# Sessions are read from the cache and only hit the database on a miss.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+
+# API responses (markets/renderers.py): encode Decimal fields such as
+# price, pool and shares as JSON numbers with their exact digits ('number')
+# or as strings ('string').
+JSON_DECIMAL_FORMAT = os.environ.get('JSON_DECIMAL_FORMAT', 'number')
+
+
+# Request profiler (markets/profiling.py). Off unless PROFILE_ENABLED=True.
+# Profiles a PROFILE_SAMPLE_RATE fraction of requests with cProfile, and
+# stack-samples every request slower than PROFILE_SLOW_MS (0 disables);
+# the newest PROFILE_KEEP profiles are kept in PROFILE_DIR.
+PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', 'False') == 'True'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_MS = int(os.environ.get('PROFILE_SLOW_MS', '1000'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', str(BASE_DIR / 'profiles'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '200'))
+
+
+# Password hashing for login and signup (markets/passwords.py) runs in
+# AUTH_HASH_WORKERS processes per server process, so a login storm cannot
+# take every core. At most AUTH_HASH_QUEUE hashes run or wait per server
+# process; further logins get a 503. Both are per server process: keep
+# AUTH_HASH_WORKERS x server processes <= cores. Across the host at most
+# AUTH_HASH_HOST_LIMIT hashes are in flight, counted through slots in the
+# shared cache (needs REDIS_URL) that expire after AUTH_HASH_SLOT_TTL
+# seconds if a process dies holding one. Credentials that just failed are
+# rejected without hashing for AUTH_FAILURE_TTL seconds (the newest
+# AUTH_FAILURE_CACHE_SIZE of them are kept).
+AUTH_HASH_WORKERS = int(os.environ.get('AUTH_HASH_WORKERS', max(1, (os.cpu_count() or 1) // 4)))
+AUTH_HASH_QUEUE = int(os.environ.get('AUTH_HASH_QUEUE', '32'))
+AUTH_HASH_HOST_LIMIT = int(os.environ.get('AUTH_HASH_HOST_LIMIT', max(1, (os.cpu_count() or 1) // 2)))
+AUTH_HASH_SLOT_TTL = int(os.environ.get('AUTH_HASH_SLOT_TTL', '30'))
+AUTH_FAILURE_TTL = int(os.environ.get('AUTH_FAILURE_TTL', '300'))
+AUTH_FAILURE_CACHE_SIZE = int(os.environ.get('AUTH_FAILURE_CACHE_SIZE', '10000'))
+
+# PoolBackend checks passwords in that pool. It refuses wrong passwords
+# outright, so backends listed after it are never asked for credentials;
+# ModelBackend stays only to resolve sessions it logged in.
+AUTHENTICATION_BACKENDS = [
+    'markets.backends.PoolBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+
+# Rate limiting (token buckets, see markets/ratelimit.py)
+# rate = tokens refilled per second, burst = bucket size,
+# lease = tokens a worker may take from the shared bucket at once.
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'True') == 'True'
+
+RATE_LIMITS = {
+    'user': {'rate': 2, 'burst': 20},
+    'market': {'rate': 50, 'burst': 200, 'lease': 5},
+    'endpoint': {'rate': 200, 'burst': 500, 'lease': 10},
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -146,6 +257,8 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 # CORS Config
 CORS_ALLOWED_ORIGINS = os.environ.get('CORS_ALLOWED_ORIGINS', 'http://localhost:5173').split(',')
 CORS_ALLOW_CREDENTIALS = True
+# Sequence number of a full market list, for ?since= delta syncs.
+CORS_EXPOSE_HEADERS = ['X-Change-Seq']
 
 # Session Cookie Config (for cross-origin auth)
 # Cookies must be Secure and SameSite=None to work cross-origin
@@ -1,23 +1,104 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
 from .models import Market
 
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the planner's row estimate instead of COUNT(*) on PostgreSQL once a
+    table is large; exact counts elsewhere and for small results.
+    """
+    exact_below = 10000
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        connection = connections[qs.db]
+        if connection.vendor == 'postgresql':
+            sql, params = qs.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                estimate = cursor.fetchone()[0][0]['Plan']['Plan Rows']
+            if estimate >= self.exact_below:
+                return int(estimate)
+        return super().count
+
+
+class InputFilter(admin.SimpleListFilter):
+    """
+    Sidebar filter rendered as a text box instead of a list of every related
+    object; the typed value is matched against an indexed column.
+    """
+    template = 'admin/markets/input_filter.html'
+    placeholder = ''
+
+    def lookups(self, request, model_admin):
+        # Must be non-empty for the filter to be displayed.
+        return ((),)
+
+    def choices(self, changelist):
+        all_choice = next(super().choices(changelist))
+        all_choice['query_parts'] = (
+            (k, v) for k, v in changelist.get_filters_params().items() if k != self.parameter_name
+        )
+        yield all_choice
+
+
+class UsernameFilter(InputFilter):
+    title = 'username'
+    parameter_name = 'username'
+    placeholder = 'exact username'
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(user__username=self.value().strip())
+
+
+class MarketSlugFilter(InputFilter):
+    title = 'market slug'
+    parameter_name = 'market'
+    placeholder = 'exact slug'
+    market_path = 'market__slug'
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.market_path: self.value().strip()})
+
+
+class PositionMarketSlugFilter(MarketSlugFilter):
+    market_path = 'outcome__market__slug'
+
+
+class ScaleModelAdmin(admin.ModelAdmin):
+    """Defaults for tables with millions of rows."""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 @admin.register(Market)
-class MarketAdmin(admin.ModelAdmin):
+class MarketAdmin(ScaleModelAdmin):
     list_display = ('title', 'slug', 'status', 'created_at')
-    search_fields = ('title', 'slug')
+    search_fields = ('=slug',)  # unique index; title is not indexed
     list_filter = ('status',)
 
 # Register your models here.
 from .models import Outcome, Position
 
 @admin.register(Outcome)
-class OutcomeAdmin(admin.ModelAdmin):
+class OutcomeAdmin(ScaleModelAdmin):
     list_display = ('market', 'name', 'current_price', 'pool_balance')
-    list_filter = ('market',)
+    list_select_related = ('market',)
+    list_filter = (MarketSlugFilter,)
+    search_fields = ('=market__slug',)
+    autocomplete_fields = ('market',)
 
 @admin.register(Position)
-class PositionAdmin(admin.ModelAdmin):
+class PositionAdmin(ScaleModelAdmin):
     list_display = ('user', 'outcome', 'shares')
-    list_filter = ('user', 'outcome__market')
+    list_select_related = ('user', 'outcome__market')
+    list_filter = (UsernameFilter, PositionMarketSlugFilter)
+    search_fields = ('=user__username', '=outcome__market__slug')
+    autocomplete_fields = ('user', 'outcome')
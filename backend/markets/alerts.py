@@ -0,0 +1,305 @@
+"""
+Price alerts: "tell me when YES reaches 0.70".
+
+Active alerts are persisted in PriceAlert and mirrored per outcome in an
+in-memory index holding two sorted threshold arrays, one per direction.
+After every trade execute_buy() reports each outcome's old and new price;
+the alerts crossed by that move form one contiguous slice of an array, so
+finding them is two bisections and the cost of a trade does not grow with
+the number of alerts that did not fire. Fired alerts leave the index at once
+and a task, committed with the trade, marks them triggered and writes the
+notifications.
+
+An "above" alert fires when the price moves from below its threshold to at
+or above it, a "below" alert when it moves from above to at or below it.
+Alerts whose condition already holds when created wait for the next
+crossing.
+
+Indexes are kept in sync the same way as the order books. The shared index
+only holds committed alerts; a transaction's own additions and removals
+ride on its on_commit callbacks (dropped by a rollback) and price_moved()
+layers them on top. On commit the operations are applied, the outcome's
+version in the cache is bumped and the operations are stored under that
+version for DELTA_TTL seconds, so a worker that is behind replays them and
+only reloads the outcome's alerts when some are gone or it is more than
+MAX_DELTAS versions behind.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+
+from . import sharding, tasks
+from .models import Notification, PriceAlert
+
+PRICE = Decimal('0.0001')  # prices are stored with 4 decimals
+
+MAX_DELTAS = 256
+DELTA_TTL = 300  # seconds
+
+
+class ThresholdIndex:
+    """Active alerts of one outcome, by direction, sorted by threshold."""
+
+    def __init__(self, version=0):
+        self.version = version
+        self._thresholds = {PriceAlert.DIRECTION_ABOVE: [], PriceAlert.DIRECTION_BELOW: []}
+        self._ids = {PriceAlert.DIRECTION_ABOVE: [], PriceAlert.DIRECTION_BELOW: []}
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._ids.values())
+
+    def add(self, alert_id, direction, threshold):
+        thresholds, ids = self._thresholds[direction], self._ids[direction]
+        # Equal thresholds stay in id order.
+        i = bisect_right(thresholds, threshold)
+        thresholds.insert(i, threshold)
+        ids.insert(i, alert_id)
+
+    def remove(self, alert_id, direction, threshold):
+        thresholds, ids = self._thresholds[direction], self._ids[direction]
+        i, end = bisect_left(thresholds, threshold), bisect_right(thresholds, threshold)
+        for j in range(i, end):
+            if ids[j] == alert_id:
+                del thresholds[j], ids[j]
+                return True
+        return False
+
+    def _slice(self, old_price, new_price):
+        """(direction, i, j): the alerts crossed by a move are that direction's [i:j]."""
+        if new_price > old_price:
+            direction = PriceAlert.DIRECTION_ABOVE
+            thresholds = self._thresholds[direction]
+            # old < threshold <= new
+            return direction, bisect_right(thresholds, old_price), bisect_right(thresholds, new_price)
+        if new_price < old_price:
+            direction = PriceAlert.DIRECTION_BELOW
+            thresholds = self._thresholds[direction]
+            # new <= threshold < old
+            return direction, bisect_left(thresholds, new_price), bisect_left(thresholds, old_price)
+        return None, 0, 0
+
+    def crossing(self, old_price, new_price):
+        """(direction, [(id, threshold)]) of the alerts crossed by a move from old_price to new_price."""
+        direction, i, j = self._slice(old_price, new_price)
+        if direction is None:
+            return None, []
+        return direction, list(zip(self._ids[direction][i:j], self._thresholds[direction][i:j]))
+
+    def crossed(self, old_price, new_price):
+        """Remove and return the ids of alerts crossed by a move from old_price to new_price."""
+        direction, i, j = self._slice(old_price, new_price)
+        if direction is None:
+            return []
+        fired = self._ids[direction][i:j]
+        del self._thresholds[direction][i:j], self._ids[direction][i:j]
+        return fired
+
+    def apply(self, ops):
+        for op, alert_id, direction, threshold in ops:
+            # Removing first makes replaying an add we already applied harmless.
+            self.remove(alert_id, direction, threshold)
+            if op == 'add':
+                self.add(alert_id, direction, threshold)
+
+
+_indexes = {}  # (shard, outcome_id) -> ThresholdIndex
+_indexes_lock = threading.RLock()
+
+
+def _index_key(outcome_id):
+    return sharding.current_shard() or DEFAULT_DB_ALIAS, outcome_id
+
+
+def _version_key(key):
+    shard, outcome_id = key
+    if shard == DEFAULT_DB_ALIAS:
+        return f'alerts:version:{outcome_id}'
+    return f'alerts:version:{shard}:{outcome_id}'
+
+
+def _delta_key(key, version):
+    return f'{_version_key(key)}:{version}'
+
+
+def _load_index(outcome_id, version):
+    index = ThresholdIndex(version)
+    rows = PriceAlert.objects.filter(
+        outcome_id=outcome_id, status=PriceAlert.STATUS_ACTIVE
+    ).order_by('threshold', 'id').values_list('id', 'direction', 'threshold')
+    for alert_id, direction, threshold in rows:
+        index.add(alert_id, direction, threshold)
+    return index
+
+
+def _catch_up(index, key, version):
+    """Replay the changes between index.version and `version`. Returns False if some are missing."""
+    if not 0 < version - index.version <= MAX_DELTAS:
+        return False
+    keys = [_delta_key(key, v) for v in range(index.version + 1, version + 1)]
+    deltas = cache.get_many(keys)
+    if len(deltas) != len(keys):
+        return False
+    for k in keys:
+        index.apply(deltas[k])
+    index.version = version
+    return True
+
+
+def get_index(outcome_id):
+    """
+    This process' index of committed alerts for an outcome, brought up to
+    date when another worker has changed it since.
+    """
+    key = _index_key(outcome_id)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        version = cache.get(_version_key(key), 0)
+        if index is None or (index.version != version and not _catch_up(index, key, version)):
+            index = _indexes[key] = _load_index(outcome_id, version)
+        return index
+
+
+class _PendingChange:
+    """on_commit callback carrying a transaction's operations on an index; a rollback drops it."""
+
+    def __init__(self, key, ops):
+        self.key = key
+        self.ops = ops
+
+    def __call__(self):
+        version_key = _version_key(self.key)
+        version = 1 if cache.add(version_key, 1, None) else cache.incr(version_key)
+        cache.set(_delta_key(self.key, version), self.ops, DELTA_TTL)
+        with _indexes_lock:
+            index = _indexes.get(self.key)
+            if index is None:
+                return
+            index.apply(self.ops)
+            # Otherwise another worker published in between; the next
+            # get_index() replays both.
+            if version == index.version + 1:
+                index.version = version
+
+
+def _mark_changed(outcome_id, *ops):
+    """Record `ops` on the outcome's index in the current transaction; published on commit."""
+    key = _index_key(outcome_id)
+    transaction.on_commit(_PendingChange(key, list(ops)), using=key[0])
+
+
+def _pending_ops(key):
+    """Operations on the index `key` made by this thread's open transaction, oldest first."""
+    ops = []
+    for _, callback, *_ in transaction.get_connection(key[0]).run_on_commit:
+        if isinstance(callback, _PendingChange) and callback.key == key:
+            ops.extend(callback.ops)
+    return ops
+
+
+def _crossed(outcome_id, old_price, new_price):
+    """
+    (direction, [(id, threshold)]) of the alerts crossed by a move, counting
+    the alerts this transaction added or removed but has not committed.
+    """
+    key = _index_key(outcome_id)
+    direction, crossed = get_index(outcome_id).crossing(old_price, new_price)
+    pending = _pending_ops(key)
+    if direction is None or not pending:
+        return direction, crossed
+    added, removed = {}, set()
+    for op, alert_id, alert_direction, threshold in pending:
+        if op == 'add':
+            added[alert_id] = (alert_direction, threshold)
+            removed.discard(alert_id)
+        else:
+            added.pop(alert_id, None)
+            removed.add(alert_id)
+    crossed = [(alert_id, threshold) for alert_id, threshold in crossed if alert_id not in removed]
+    probe = ThresholdIndex()
+    for alert_id, (alert_direction, threshold) in added.items():
+        probe.add(alert_id, alert_direction, threshold)
+    return direction, crossed + probe.crossing(old_price, new_price)[1]
+
+
+def reset_indexes():
+    """Drop all in-memory indexes (used by tests)."""
+    with _indexes_lock:
+        _indexes.clear()
+
+
+@sharding.atomic_method
+def create_alert(user, outcome, direction, threshold: Decimal) -> PriceAlert:
+    alert = PriceAlert.objects.create(user=user, outcome=outcome, direction=direction, threshold=threshold)
+    _mark_changed(outcome.id, ('add', alert.id, alert.direction, alert.threshold))
+    return alert
+
+
+@sharding.atomic_method
+def cancel_alert(alert: PriceAlert) -> bool:
+    """Cancel an active alert. Returns False if it already fired or was cancelled."""
+    updated = PriceAlert.objects.filter(pk=alert.pk, status=PriceAlert.STATUS_ACTIVE).update(
+        status=PriceAlert.STATUS_CANCELLED
+    )
+    if not updated:
+        return False
+    _mark_changed(alert.outcome_id, ('remove', alert.id, alert.direction, alert.threshold))
+    return True
+
+
+def price_moved(moves):
+    """
+    Called in the trade's transaction with [(outcome, old_price)] for every
+    outcome whose price changed. Queues one task for all alerts that fired.
+    """
+    fired = {}
+    with _indexes_lock:
+        for outcome, old_price in moves:
+            new_price = Decimal(outcome.current_price).quantize(PRICE)
+            direction, crossed = _crossed(outcome.id, Decimal(old_price).quantize(PRICE), new_price)
+            if crossed:
+                _mark_changed(outcome.id, *[('remove', alert_id, direction, threshold) for alert_id, threshold in crossed])
+                fired[str(outcome.id)] = {'ids': [alert_id for alert_id, _ in crossed], 'price': str(new_price)}
+    if fired:
+        tasks.enqueue('alerts.fired', {'shard': sharding.current_shard() or DEFAULT_DB_ALIAS, 'outcomes': fired})
+    return sum(len(f['ids']) for f in fired.values())
+
+
+@tasks.task('alerts.fired')
+def alerts_fired(payload):
+    """Mark fired alerts triggered and notify their owners."""
+    now = timezone.now()
+    notifications = []
+    with sharding.use_shard(payload['shard']), sharding.atomic():
+        for fired in payload['outcomes'].values():
+            price = Decimal(fired['price'])
+            alerts = list(
+                PriceAlert.objects.select_for_update()
+                .filter(id__in=fired['ids'], status=PriceAlert.STATUS_ACTIVE)
+                .select_related('outcome__market')
+            )
+            if not alerts:
+                continue  # already handled by an earlier attempt
+            PriceAlert.objects.filter(id__in=[a.id for a in alerts]).update(
+                status=PriceAlert.STATUS_TRIGGERED, triggered_at=now, triggered_price=price,
+            )
+            for alert in alerts:
+                market = alert.outcome.market
+                verb = 'rose to' if alert.direction == PriceAlert.DIRECTION_ABOVE else 'fell to'
+                notifications.append(Notification(
+                    user_id=alert.user_id,
+                    kind='price_alert',
+                    message=f'{alert.outcome.name} in "{market.title}" {verb} {price:.2f}',
+                    data={
+                        'alert_id': alert.id,
+                        'market': market.slug,
+                        'outcome': alert.outcome.name,
+                        'direction': alert.direction,
+                        'threshold': alert.threshold,
+                        'price': price,
+                    },
+                ))
+        Notification.objects.bulk_create(notifications)
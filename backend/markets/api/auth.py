@@ -1,75 +1,124 @@
 import json
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.db import IntegrityError
 from django.views.decorators.csrf import csrf_exempt
 
-@csrf_exempt
-def login_view(request):
+from .. import passwords
+from ..renderers import FastJsonResponse
+
+POOL_BACKEND = 'markets.backends.PoolBackend'
+
+
+def _user_payload(user, balance=True):
+    payload = {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+    }
+    if balance:
+        payload['balance'] = user.userprofile.balance
+    payload['is_staff'] = user.is_staff or user.is_superuser
+    return payload
+
+
+def _busy():
+    response = FastJsonResponse({'error': 'Too many sign-ins right now, please retry.'}, status=503)
+    response['Retry-After'] = '1'
+    return response
+
+
+async def login_view(request):
+    """
+    Async so the password check, which runs in the hashing pool (see
+    markets/passwords.py), does not keep the worker busy. authenticate()
+    itself runs in this request's sync thread, where PoolBackend waits on
+    the pool.
+    """
     if request.method != 'POST':
-        return JsonResponse({'error': 'Method not allowed'}, status=405)
-    
+        return FastJsonResponse({'error': 'Method not allowed'}, status=405)
+
     try:
         data = json.loads(request.body)
-        username = data.get('username')
-        password = data.get('password')
-        
-        user = authenticate(request, username=username, password=password)
-        if user is not None:
-            login(request, user)
-            return JsonResponse({
-                'id': user.id,
-                'username': user.username,
-                'email': user.email,
-                'balance': float(user.userprofile.balance),
-                'is_staff': user.is_staff or user.is_superuser,
-            })
-        else:
-            return JsonResponse({'error': 'Invalid credentials'}, status=401)
     except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        return FastJsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not isinstance(data, dict):
+        return FastJsonResponse({'error': 'Invalid JSON'}, status=400)
+    username = data.get('username')
+    password = data.get('password')
+    if not isinstance(username, str) or not isinstance(password, str):
+        return FastJsonResponse({'error': 'Invalid credentials'}, status=401)
+
+    try:
+        user = await sync_to_async(authenticate)(request, username=username, password=password)
+    except passwords.Busy:
+        return _busy()
+    if user is None:
+        return FastJsonResponse({'error': 'Invalid credentials'}, status=401)
+    await sync_to_async(login)(request, user)
+    return FastJsonResponse(_user_payload(user))
+
+
+# csrf_exempt() hides that a view is a coroutine before Django 5.0; mark it directly.
+login_view.csrf_exempt = True
 
 @csrf_exempt
 def logout_view(request):
     if request.method != 'POST':
-        return JsonResponse({'error': 'Method not allowed'}, status=405)
+        return FastJsonResponse({'error': 'Method not allowed'}, status=405)
     logout(request)
-    return JsonResponse({'status': 'logged out'})
+    return FastJsonResponse({'status': 'logged out'})
 
-@csrf_exempt
-def signup_view(request):
+async def signup_view(request):
+    """Async for the same reason as login_view: hashing the new password runs in the pool."""
     if request.method != 'POST':
-        return JsonResponse({'error': 'Method not allowed'}, status=405)
-        
+        return FastJsonResponse({'error': 'Method not allowed'}, status=405)
+
     try:
         data = json.loads(request.body)
-        username = data.get('username')
-        password = data.get('password')
-        email = data.get('email', '')
-        
-        if User.objects.filter(username=username).exists():
-            return JsonResponse({'error': 'Username already taken'}, status=400)
-            
-        user = User.objects.create_user(username=username, email=email, password=password)
-        login(request, user) # Auto login after signup
-        
-        return JsonResponse({
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'is_staff': user.is_staff or user.is_superuser,
-        })
-    except Exception as e:
-        return JsonResponse({'error': str(e)}, status=400)
+    except json.JSONDecodeError:
+        return FastJsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not isinstance(data, dict):
+        return FastJsonResponse({'error': 'Invalid JSON'}, status=400)
+    username = data.get('username')
+    password = data.get('password')
+    email = data.get('email', '')
+    if not username or not isinstance(username, str):
+        return FastJsonResponse({'error': 'The given username must be set'}, status=400)
+    if not password or not isinstance(password, str) or not isinstance(email, str):
+        return FastJsonResponse({'error': 'A password is required'}, status=400)
+
+    username = User.normalize_username(username)
+    # Checked before hashing so taken names cost no CPU.
+    if await User.objects.filter(username=username).aexists():
+        return FastJsonResponse({'error': 'Username already taken'}, status=400)
+    try:
+        encoded = await passwords.make(password)
+    except passwords.Busy:
+        return _busy()
+
+    user = User(username=username, email=User.objects.normalize_email(email), password=encoded)
+    try:
+        await user.asave()  # signals create the profile and replicate the user
+    except IntegrityError:
+        return FastJsonResponse({'error': 'Username already taken'}, status=400)
+    await sync_to_async(login)(request, user, backend=POOL_BACKEND)  # Auto login after signup
+    return FastJsonResponse(_user_payload(user, balance=False))
+
+
+signup_view.csrf_exempt = True
+
 
 def me_view(request):
     if not request.user.is_authenticated:
-        return JsonResponse({'error': 'Not authenticated'}, status=401)
+        return FastJsonResponse({'error': 'Not authenticated'}, status=401)
         
-    return JsonResponse({
+    return FastJsonResponse({
         'id': request.user.id,
         'username': request.user.username,
         'email': request.user.email,
-        'balance': float(request.user.userprofile.balance),
+        'balance': request.user.userprofile.balance,
         'is_staff': request.user.is_staff or request.user.is_superuser,
     })
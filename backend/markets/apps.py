@@ -4,3 +4,17 @@ from django.apps import AppConfig
 class MarketsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'markets'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from django.db.models.signals import post_delete, post_save
+
+        from .models import Tag
+        from .sharding import drop_replica, replicate_tag, replicate_user
+        post_save.connect(replicate_user, sender=User, dispatch_uid='markets.replicate_user')
+        post_save.connect(replicate_tag, sender=Tag, dispatch_uid='markets.replicate_tag')
+        post_delete.connect(drop_replica, sender=User, dispatch_uid='markets.drop_user_replica')
+        post_delete.connect(drop_replica, sender=Tag, dispatch_uid='markets.drop_tag_replica')
+
+        # Task handlers defined outside markets/tasks.py register on import.
+        from . import alerts, events, trending  # noqa: F401
@@ -0,0 +1,176 @@
+"""
+Hot/cold archival of settled markets.
+
+A market is settled once it has been resolved for ARCHIVE_AFTER_DAYS, has no
+open limit orders and no unredeemed winning shares. Archiving copies the
+market with its outcomes, positions, comments and trades into one
+ArchivedMarket row (optionally on the ARCHIVE_DATABASE alias) and then
+deletes the hot rows, so live-table indexes only cover live markets.
+
+When the archive lives on the market's own database both steps are one
+transaction. Otherwise the archive row commits first and the hot rows are
+deleted afterwards: a crash in between leaves the market in both places,
+the next run archives it again over the same row, and a delete that finds
+the market already gone does nothing.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from . import events, facets, sharding
+from .models import ArchivedMarket, LimitOrder, Market, Position, Trade
+from .scheduler import invalidate_status
+
+
+def _archive_db():
+    return getattr(settings, 'ARCHIVE_DATABASE', 'default')
+
+
+def archived_slug_exists(slug):
+    return ArchivedMarket.objects.using(_archive_db()).filter(slug=slug).exists()
+
+
+def archived_slugs(slugs):
+    return set(ArchivedMarket.objects.using(_archive_db()).filter(slug__in=slugs).values_list('slug', flat=True))
+
+
+def get_archived(slug):
+    return ArchivedMarket.objects.using(_archive_db()).filter(slug=slug).first()
+
+
+def settled_markets(older_than_days=None):
+    """Resolved markets past the retention age with nothing left to settle."""
+    if older_than_days is None:
+        older_than_days = settings.ARCHIVE_AFTER_DAYS
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+
+    open_orders = LimitOrder.objects.filter(outcome__market=OuterRef('pk'), status=LimitOrder.STATUS_OPEN)
+    unredeemed = Position.objects.filter(outcome=OuterRef('winning_outcome'), shares__gt=0)
+    return (
+        Market.objects
+        .filter(status=Market.STATUS_RESOLVED, resolved_at__lte=cutoff)
+        .exclude(Exists(open_orders))
+        .exclude(Exists(unredeemed))
+        .order_by('resolved_at')
+    )
+
+
+def _snapshot(market):
+    outcomes = list(market.outcomes.values('id', 'name', 'current_price', 'pool_balance'))
+    positions = list(
+        Position.objects.filter(outcome__market=market)
+        .values_list('user__username', 'outcome__name', 'shares')
+    )
+    comments = list(
+        market.comments.order_by('created_at').values_list('user__username', 'text', 'created_at')
+    )
+    trades = list(
+        Trade.objects.filter(outcome__market=market).order_by('created_at')
+        .values_list('user__username', 'outcome__name', 'kind', 'amount', 'shares', 'price', 'created_at')
+    )
+    return {
+        'description': market.description,
+        'created_by': market.created_by.username if market.created_by else None,
+        'outcomes': [
+            {'id': o['id'], 'name': o['name'], 'price': str(o['current_price']), 'pool': str(o['pool_balance'])}
+            for o in outcomes
+        ],
+        'positions': [
+            {'username': u, 'outcome': o, 'shares': str(s)} for u, o, s in positions
+        ],
+        'comments': [
+            {'username': u, 'text': t, 'created_at': c.isoformat()} for u, t, c in comments
+        ],
+        'trades': [
+            {'username': u, 'outcome': o, 'kind': k, 'amount': str(a), 'shares': str(s), 'price': str(p),
+             'created_at': c.isoformat()}
+            for u, o, k, a, s, p, c in trades
+        ],
+    }
+
+
+def _write_archive(market):
+    archived, _ = ArchivedMarket.objects.using(_archive_db()).update_or_create(
+        market_id=market.id,
+        defaults={
+            'slug': market.slug,
+            'title': market.title,
+            'status': market.status,
+            'winning_outcome': market.winning_outcome.name if market.winning_outcome else '',
+            'created_at': market.created_at,
+            'resolved_at': market.resolved_at,
+            'data': _snapshot(market),
+        },
+    )
+    return archived
+
+
+def _delete_hot(market):
+    current = Market.objects.select_for_update().filter(pk=market.pk).first()
+    if current is None:
+        return  # already deleted by an earlier run
+    # Outcomes, positions, comments, trades and orders cascade.
+    facets.market_changed(facets.state(current), None)
+    current.delete()
+    events.record('market.archive', market_id=market.id, slug=market.slug)
+
+
+def archive_market(market):
+    """Copy a market into the archive and delete its hot rows."""
+    alias = market._state.db or DEFAULT_DB_ALIAS
+    with sharding.use_shard(alias):
+        if _archive_db() == alias:
+            with sharding.atomic():
+                archived = _write_archive(market)
+                _delete_hot(market)
+        else:
+            # Separate transactions: the archive row must be durable before
+            # the hot rows go (sharding.atomic() commits the shard first).
+            with transaction.atomic(using=_archive_db()):
+                archived = _write_archive(market)
+            with sharding.atomic():
+                _delete_hot(market)
+    sharding.forget(market.slug)
+    invalidate_status(market.slug)
+    return archived
+
+
+def archive_settled_markets(older_than_days=None, limit=None, dry_run=False):
+    """Archive settled markets on every shard, oldest first. Returns the archived slugs."""
+    def shard_markets():
+        markets = settled_markets(older_than_days).select_related('created_by', 'winning_outcome')
+        return list(markets[:limit] if limit else markets)
+
+    markets = sorted(
+        (market for shard_markets in sharding.scatter_gather(shard_markets) for market in shard_markets),
+        key=lambda market: market.resolved_at,
+    )[:limit]
+
+    slugs = []
+    for market in markets:
+        if not dry_run:
+            archive_market(market)
+        slugs.append(market.slug)
+    return slugs
+
+
+def archived_payload(archived, include_details=True):
+    payload = {
+        'id': archived.market_id,
+        'title': archived.title,
+        'slug': archived.slug,
+        'status': archived.status,
+        'winning_outcome': archived.winning_outcome or None,
+        'created_at': archived.created_at.isoformat(),
+        'resolved_at': archived.resolved_at.isoformat() if archived.resolved_at else None,
+        'archived_at': archived.archived_at.isoformat(),
+        'archived': True,
+    }
+    if include_details:
+        payload.update(archived.data)
+    else:
+        payload['outcomes'] = archived.data.get('outcomes', [])
+    return payload
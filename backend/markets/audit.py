@@ -0,0 +1,298 @@
+"""
+Invariant audit: reconcile pools, positions and balances with the Trade journal.
+
+Checks, per market:
+    price_sum     Outcome prices sum to 1.
+    pool_price    Each binary outcome's price equals other pool / total pool.
+    collateral    Every outcome has the same minted supply (pool + held shares
+                  + shares redeemed), i.e. all shares are backed by complete
+                  sets, and that supply covers the USD bought into the market.
+    negative      No pool or position is negative.
+Per user:
+    position      Position.shares equals shares bought minus shares redeemed.
+    balance       UserProfile.balance equals the starting balance minus buys,
+                  plus redemptions, minus USD reserved by open limit orders
+                  (archived markets' trades included).
+
+Rows are scanned in id ranges of `chunk_size` with the sums done by the
+database, so memory use is bounded by the chunk size (plus one net cash
+flow per user who traded in an archived market). Chunks run on a thread
+pool; every worker uses its own connection.
+
+Markets and positions are checked shard by shard (a market's outcomes,
+positions and trades share its shard). Balances are checked once per user
+range against the trades and open orders summed over every shard.
+
+Amounts are stored with 4 decimals and balances with 2, so every trade may
+shift the totals by a rounding step. The allowed difference grows with the
+number of trades involved: `tolerance` + step * trades.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Count, Q, Sum
+
+from . import sharding
+from .archive import _archive_db
+from .models import ArchivedMarket, LimitOrder, Market, Outcome, Position, Trade, UserProfile
+
+CHUNK_SIZE = 1000
+TOLERANCE = Decimal('0.0001')
+SHARE_STEP = Decimal('0.0001')  # rounding of pools, shares and prices
+BALANCE_STEP = Decimal('0.005')  # rounding of 4-decimal amounts into 2-decimal balances
+
+ZERO = Decimal('0')
+BUY = Q(kind=Trade.KIND_BUY)
+REDEEM = Q(kind=Trade.KIND_REDEEM)
+
+
+def id_ranges(queryset, field, chunk_size=CHUNK_SIZE):
+    """Yield inclusive (first, last) ranges of `field` covering `chunk_size` rows each."""
+    last = None
+    while True:
+        qs = queryset.order_by(field).values_list(field, flat=True)
+        if last is not None:
+            qs = qs.filter(**{f'{field}__gt': last})
+        ids = list(qs[:chunk_size])
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        last = ids[-1]
+
+
+def _issue(check, expected, actual, **context):
+    return {
+        'check': check,
+        **context,
+        'expected': str(expected),
+        'actual': str(actual),
+        'difference': str(actual - expected),
+    }
+
+
+def audit_markets(first, last, tolerance=TOLERANCE):
+    """Check markets with first <= id <= last. Returns (markets checked, discrepancies)."""
+    in_range = {'market_id__gte': first, 'market_id__lte': last}
+    outcome_range = {'outcome__market_id__gte': first, 'outcome__market_id__lte': last}
+
+    outcomes = {}
+    for o in Outcome.objects.filter(**in_range).values('id', 'market_id', 'market__slug', 'name',
+                                                        'current_price', 'pool_balance'):
+        outcomes.setdefault(o['market_id'], []).append(o)
+    held = dict(
+        Position.objects.filter(**outcome_range).values('outcome_id')
+        .annotate(total=Sum('shares')).values_list('outcome_id', 'total')
+    )
+    negative = dict(
+        Position.objects.filter(shares__lt=0, **outcome_range).values('outcome_id')
+        .annotate(n=Count('id')).values_list('outcome_id', 'n')
+    )
+    flows = {
+        row['outcome_id']: row
+        for row in Trade.objects.filter(**outcome_range).values('outcome_id').annotate(
+            bought=Sum('amount', filter=BUY), redeemed=Sum('shares', filter=REDEEM), trades=Count('id'),
+        )
+    }
+
+    issues = []
+    markets = Market.objects.filter(id__gte=first, id__lte=last).values_list('id', 'slug')
+    checked = 0
+    for market_id, slug in markets.iterator():
+        checked += 1
+        rows = outcomes.get(market_id, [])
+        if len(rows) < 2:
+            issues.append(_issue('collateral', 2, len(rows), market=slug, detail='outcomes'))
+            continue
+        trades = sum(flows.get(o['id'], {}).get('trades', 0) for o in rows)
+        share_tol = tolerance + SHARE_STEP * trades
+
+        price_sum = sum(o['current_price'] for o in rows)
+        if abs(price_sum - 1) > tolerance + SHARE_STEP * len(rows):
+            issues.append(_issue('price_sum', Decimal('1'), price_sum, market=slug))
+
+        total_pool = sum(o['pool_balance'] for o in rows)
+        if len(rows) == 2 and total_pool > 0:
+            for o in rows:
+                implied = (total_pool - o['pool_balance']) / total_pool
+                if abs(o['current_price'] - implied) > tolerance + SHARE_STEP:
+                    issues.append(_issue('pool_price', implied.quantize(SHARE_STEP), o['current_price'],
+                                         market=slug, outcome=o['name']))
+
+        minted = {}
+        bought = ZERO
+        for o in rows:
+            flow = flows.get(o['id'], {})
+            bought += flow.get('bought') or ZERO
+            minted[o['name']] = o['pool_balance'] + (held.get(o['id']) or ZERO) + (flow.get('redeemed') or ZERO)
+            if o['pool_balance'] < 0:
+                issues.append(_issue('negative', ZERO, o['pool_balance'], market=slug, outcome=o['name'], detail='pool'))
+            if negative.get(o['id']):
+                issues.append(_issue('negative', 0, negative[o['id']], market=slug, outcome=o['name'],
+                                     detail='positions'))
+        supply = min(minted.values())
+        for name, value in minted.items():
+            if value - supply > share_tol:
+                issues.append(_issue('collateral', supply, value, market=slug, outcome=name, detail='minted'))
+        if supply + share_tol < bought:
+            issues.append(_issue('collateral', bought, supply, market=slug, detail='backing'))
+    return checked, issues
+
+
+def audit_positions(first, last, tolerance=TOLERANCE):
+    """Check positions of users with first <= id <= last against their trades."""
+    in_range = {'user_id__gte': first, 'user_id__lte': last}
+    journal = {
+        (row['user_id'], row['outcome_id']): row
+        for row in Trade.objects.filter(**in_range).values('user_id', 'outcome_id').annotate(
+            bought=Sum('shares', filter=BUY), redeemed=Sum('shares', filter=REDEEM), trades=Count('id'),
+        )
+    }
+    issues = []
+    checked = 0
+    positions = Position.objects.filter(**in_range).values_list(
+        'user_id', 'user__username', 'outcome_id', 'outcome__market__slug', 'outcome__name', 'shares'
+    )
+    for user_id, username, outcome_id, slug, name, shares in positions.iterator():
+        checked += 1
+        row = journal.pop((user_id, outcome_id), {})
+        expected = (row.get('bought') or ZERO) - (row.get('redeemed') or ZERO)
+        if abs(shares - expected) > tolerance + SHARE_STEP * row.get('trades', 0):
+            issues.append(_issue('position', expected, shares, user=username, market=slug, outcome=name))
+
+    # Trades without a position row.
+    if journal:
+        names = dict(
+            Outcome.objects.filter(id__in={outcome_id for _, outcome_id in journal})
+            .values_list('id', 'market__slug')
+        )
+        usernames = dict(
+            UserProfile.objects.filter(user_id__in={user_id for user_id, _ in journal})
+            .values_list('user_id', 'user__username')
+        )
+        for (user_id, outcome_id), row in journal.items():
+            expected = (row['bought'] or ZERO) - (row['redeemed'] or ZERO)
+            if abs(expected) > tolerance + SHARE_STEP * row['trades']:
+                issues.append(_issue('position', expected, ZERO, user=usernames.get(user_id, user_id),
+                                     market=names.get(outcome_id), detail='missing'))
+    return checked, issues
+
+
+def archived_cash_flows():
+    """Net USD each user received (+) or paid (-) in archived markets, by username."""
+    flows = {}
+    counts = {}
+    archived = ArchivedMarket.objects.using(_archive_db()).values_list('data', flat=True)
+    for data in archived.iterator(chunk_size=100):
+        for trade in data.get('trades', []):
+            amount = Decimal(trade['amount'])
+            sign = 1 if trade['kind'] == Trade.KIND_REDEEM else -1
+            flows[trade['username']] = flows.get(trade['username'], ZERO) + sign * amount
+            counts[trade['username']] = counts.get(trade['username'], 0) + 1
+    return {username: (flows[username], counts[username]) for username in flows}
+
+
+def _add_rows(totals, rows):
+    """Sum per-user aggregate rows from one shard into {user_id: {field: total}}."""
+    for row in rows:
+        total = totals.setdefault(row.pop('user_id'), {})
+        for field, value in row.items():
+            if value is not None:
+                total[field] = total.get(field, 0) + value
+
+
+def audit_balances(first, last, archived=None, tolerance=TOLERANCE):
+    """Check profiles of users with first <= id <= last against the journal and open orders."""
+    archived = archived or {}
+    in_range = {'user_id__gte': first, 'user_id__lte': last}
+    flows, reserved = {}, {}
+    for alias in sharding.shards():
+        _add_rows(flows, Trade.objects.using(alias).filter(**in_range).values('user_id').annotate(
+            bought=Sum('amount', filter=BUY), redeemed=Sum('amount', filter=REDEEM), trades=Count('id'),
+        ))
+        _add_rows(reserved, LimitOrder.objects.using(alias).filter(status=LimitOrder.STATUS_OPEN, **in_range)
+                  .values('user_id').annotate(remaining=Sum('remaining'), orders=Count('id')))
+    start = UserProfile.starting_balance()
+    issues = []
+    checked = 0
+    profiles = UserProfile.objects.filter(**in_range).values_list('user_id', 'user__username', 'balance')
+    for user_id, username, balance in profiles.iterator():
+        checked += 1
+        flow = flows.get(user_id, {})
+        orders = reserved.get(user_id, {})
+        archived_net, archived_trades = archived.get(username, (ZERO, 0))
+        expected = (
+            start - (flow.get('bought') or ZERO) + (flow.get('redeemed') or ZERO)
+            - (orders.get('remaining') or ZERO) + archived_net
+        )
+        steps = flow.get('trades', 0) + orders.get('orders', 0) + archived_trades
+        if abs(balance - expected) > tolerance + BALANCE_STEP * steps:
+            issues.append(_issue('balance', expected, balance, user=username))
+        if balance < 0:
+            issues.append(_issue('negative', ZERO, balance, user=username, detail='balance'))
+    return checked, issues
+
+
+def _call(job):
+    func, alias, args = job
+    with sharding.use_shard(alias):
+        return func.__name__, func(*args)
+
+
+def _run(job):
+    try:
+        return _call(job)
+    finally:
+        for alias in {DEFAULT_DB_ALIAS, job[1]}:
+            connections[alias].close()
+
+
+def run_audit(chunk_size=CHUNK_SIZE, workers=1, tolerance=TOLERANCE):
+    """
+    Run every check. Yields discrepancies as chunks complete, then a final
+    {'summary': {...}} entry with row counts per check group.
+    """
+    archived = archived_cash_flows()
+
+    def jobs():
+        for alias in sharding.shards():
+            for first, last in id_ranges(Market.objects.using(alias), 'id', chunk_size):
+                yield audit_markets, alias, (first, last, tolerance)
+        for first, last in id_ranges(UserProfile.objects.all(), 'user_id', chunk_size):
+            for alias in sharding.shards():
+                yield audit_positions, alias, (first, last, tolerance)
+            yield audit_balances, DEFAULT_DB_ALIAS, (first, last, archived, tolerance)
+
+    counts = {'audit_markets': 0, 'audit_positions': 0, 'audit_balances': 0}
+    found = 0
+    if workers <= 1:
+        results = (_call(job) for job in jobs())
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        results = _bounded_map(pool, jobs(), workers * 2)
+    try:
+        for name, (checked, issues) in results:
+            counts[name] += checked
+            found += len(issues)
+            yield from issues
+    finally:
+        if workers > 1:
+            pool.shutdown(cancel_futures=True)
+
+    yield {'summary': {
+        'markets': counts['audit_markets'],
+        'positions': counts['audit_positions'],
+        'profiles': counts['audit_balances'],
+        'discrepancies': found,
+    }}
+
+
+def _bounded_map(pool, jobs, in_flight):
+    """pool.map over a lazy iterable with at most `in_flight` pending jobs, in order."""
+    pending = []
+    for job in jobs:
+        pending.append(pool.submit(_run, job))
+        if len(pending) >= in_flight:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
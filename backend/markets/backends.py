@@ -0,0 +1,43 @@
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
+
+from . import passwords
+
+
+class PoolBackend(ModelBackend):
+    """
+    ModelBackend whose password check runs in the pool, so logins still go
+    through authenticate() (AUTHENTICATION_BACKENDS, user_login_failed)
+    without hashing in the server process. Known-bad credentials are
+    refused without hashing.
+
+    A wrong password raises PermissionDenied rather than returning None:
+    authenticate() then stops and reports the failure instead of handing
+    the same credentials to the plain ModelBackend listed after this one
+    (kept for the sessions it logged in), which would hash them again
+    in-process. Busy propagates out of authenticate() to the view.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        user = User._default_manager.select_related('userprofile').filter(
+            **{User.USERNAME_FIELD: username}
+        ).first()
+        encoded = user.password if user is not None else None
+        if passwords.known_bad(username, password, encoded):
+            raise PermissionDenied
+        correct, upgraded = passwords.verify(password, encoded)
+        if not correct:
+            passwords.remember_bad(username, password, encoded)
+            raise PermissionDenied
+        if upgraded:
+            # The hasher's parameters changed since this password was set.
+            user.password = upgraded
+            user.save(update_fields=['password'])
+        if not self.user_can_authenticate(user):
+            raise PermissionDenied
+        return user
@@ -0,0 +1,311 @@
+"""
+Synthetic production-scale datasets for load and scaling tests (the
+generate_dataset command).
+
+Users are written with bulk_create, which fires no model signals: every
+user gets the same password hash, computed once (hashing a million
+passwords would take hours), and their UserProfile rows are inserted next
+to them instead of by create_user_profile. Markets go through the bulk
+importer, so they get their outcomes, shard directory entries, facet counts
+and event log rows as usual. Positions and comments are inserted directly,
+without trades: pools, balances and the event log do not reflect them.
+
+Activity is heavy-tailed. Markets, in a random order, are picked for
+positions and comments with weight rank ** -market_alpha, and users with
+weight rank ** -user_alpha; an alpha of 0 is uniform. Draft markets get no
+activity.
+
+Users, positions and comments are produced in chunks by a pool of worker
+processes, each with its own database connections and a random stream
+derived from the seed and the chunk number, so the output for a given seed
+does not depend on the number of workers. A chunk of positions covers a
+disjoint range of users, which keeps (user, outcome) unique without
+looking at other chunks.
+"""
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from . import importing, sharding
+from .models import Comment, Market, Outcome, Position, UserProfile
+
+BATCH_SIZE = 5000  # rows per INSERT
+CHUNK_SIZE = 100_000  # rows per worker task
+IMPORT_SIZE = 10_000  # markets per importer call, which checks their slugs in one query
+SHARES_SIGMA = 1.5  # lognormal spread of position sizes
+MAX_TAGS_PER_MARKET = 3
+STATUSES = (Market.STATUS_DRAFT, Market.STATUS_OPEN, Market.STATUS_CLOSED)
+
+COMMENT_WORDS = (
+    'yes', 'no', 'likely', 'unlikely', 'priced', 'in', 'cheap', 'overpriced', 'the', 'odds', 'are',
+    'wrong', 'buying', 'selling', 'holding', 'news', 'just', 'dropped', 'resolution', 'source', 'says',
+)
+
+# Streams of the seed sequence, one per kind of row.
+_USERS, _MARKETS, _POSITIONS, _COMMENTS = range(4)
+
+_state = {}  # shared with the worker processes, see _init_worker()
+
+
+def popularity(n, alpha, rng):
+    """Weights rank ** -alpha of n items, the ranks in random order."""
+    weights = np.arange(1, n + 1, dtype=np.float64) ** -alpha
+    return weights[rng.permutation(n)]
+
+
+def _cdf(weights):
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def _pick(cdf, rng, size):
+    return np.minimum(np.searchsorted(cdf, rng.random(size), side='right'), len(cdf) - 1)
+
+
+def _rng(seed, stream, chunk=0):
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(stream, chunk)))
+
+
+def _batches(rows, size=BATCH_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _init_worker(state):
+    _state.clear()
+    _state.update(state)
+
+
+# Worker tasks
+
+def _create_users(task):
+    """Insert users [start, stop) with their profiles. Returns their ids in order."""
+    start, stop = task
+    prefix, password = _state['prefix'], _state['password']
+    now = timezone.now()
+    ids = []
+    for lo in range(start, stop, BATCH_SIZE):
+        hi = min(lo + BATCH_SIZE, stop)
+        users = [
+            User(username=f'{prefix}{n:07d}', password=password, date_joined=now)
+            for n in range(lo, hi)
+        ]
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            users = User.objects.using(DEFAULT_DB_ALIAS).bulk_create(users)
+            if any(user.pk is None for user in users):
+                # Backends that do not return ids from bulk inserts.
+                pks = dict(User.objects.using(DEFAULT_DB_ALIAS).filter(
+                    username__in=[user.username for user in users]
+                ).values_list('username', 'id'))
+                for user in users:
+                    user.pk = pks[user.username]
+            UserProfile.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+                [UserProfile(user_id=user.pk) for user in users]
+            )
+        for alias in _state['shards'][1:]:
+            # What sharding.replicate_user would have written.
+            User.objects.using(alias).bulk_create(
+                [User(pk=user.pk, username=user.username, password='!') for user in users]
+            )
+        ids.extend(user.pk for user in users)
+    return ids
+
+
+def _insert_by_shard(model, market_index, make):
+    """bulk_create make(i) for every row i, on the shard of market market_index[i]."""
+    shards = _state['market_shard'][market_index]
+    for shard, alias in enumerate(_state['shards']):
+        rows = np.flatnonzero(shards == shard).tolist()
+        for batch in _batches(rows):
+            with transaction.atomic(using=alias):
+                model.objects.using(alias).bulk_create([make(i) for i in batch])
+
+
+def _create_positions(task):
+    """Insert about `count` positions of users [start, stop). Returns the number inserted."""
+    chunk, start, stop, count = task
+    rng = _rng(_state['seed'], _POSITIONS, chunk)
+    user_cdf = _cdf(_state['user_weights'][start:stop])
+    n_markets = len(_state['outcome_ids'])
+    # Draw (user, market, side) keys and drop repeats until there are enough;
+    # popular markets and active users collide often. Bounded in case the
+    # range has fewer distinct pairs than requested.
+    keys = np.empty(0, dtype=np.int64)
+    for _ in range(10):
+        missing = count - len(keys)
+        if missing <= 0:
+            break
+        size = int(missing * 1.2) + 10
+        users = start + _pick(user_cdf, rng, size)
+        markets = _pick(_state['market_cdf'], rng, size)
+        sides = rng.integers(0, 2, size)
+        keys = np.unique(np.concatenate([keys, (users.astype(np.int64) * n_markets + markets) * 2 + sides]))
+    keys = rng.permutation(keys)[:count]
+    users, markets, sides = keys // 2 // n_markets, keys // 2 % n_markets, keys % 2
+
+    mu = math.log(_state['shares_mean']) - SHARES_SIGMA ** 2 / 2
+    shares = np.maximum(rng.lognormal(mu, SHARES_SIGMA, len(keys)), 0.0001).tolist()
+    user_ids = _state['user_ids'][users].tolist()
+    outcome_ids = _state['outcome_ids'][markets, sides].tolist()
+    _insert_by_shard(Position, markets, lambda i: Position(
+        user_id=user_ids[i], outcome_id=outcome_ids[i], shares=Decimal(f'{shares[i]:.4f}'),
+    ))
+    return len(keys)
+
+
+def _create_comments(task):
+    """Insert `count` comments. Returns the number inserted."""
+    chunk, count = task
+    rng = _rng(_state['seed'], _COMMENTS, chunk)
+    users = _pick(_state['user_cdf'], rng, count)
+    markets = _pick(_state['market_cdf'], rng, count)
+    lengths = rng.integers(3, 30, count)
+    words = rng.integers(0, len(COMMENT_WORDS), int(lengths.sum())).tolist()
+    ends = lengths.cumsum().tolist()
+    lengths = lengths.tolist()
+    user_ids = _state['user_ids'][users].tolist()
+    market_ids = _state['market_ids'][markets].tolist()
+    _insert_by_shard(Comment, markets, lambda i: Comment(
+        user_id=user_ids[i],
+        market_id=market_ids[i],
+        text=' '.join(COMMENT_WORDS[w] for w in words[ends[i] - lengths[i]:ends[i]]),
+    ))
+    return count
+
+
+# Orchestration
+
+def _run(func, tasks, workers):
+    if workers <= 1 or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+    # Children open their own connections; inherited ones must not be shared.
+    connections.close_all()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=_init_worker,
+        initargs=(dict(_state),),
+    ) as pool:
+        return list(pool.map(func, tasks))
+
+
+def _market_rows(prefix, count, status_mix, tags, rng):
+    p = np.array([status_mix.get(s, 0.0) for s in STATUSES])
+    statuses = rng.choice(len(STATUSES), size=count, p=p / p.sum())
+    tag_cdf = _cdf(popularity(tags, 1.0, rng)) if tags else None
+    rows = []
+    for n in range(count):
+        row = {'title': f'Synthetic market {n}', 'slug': f'{prefix}-market-{n:07d}', 'status': STATUSES[statuses[n]]}
+        if tag_cdf is not None:
+            picked = _pick(tag_cdf, rng, rng.integers(0, MAX_TAGS_PER_MARKET + 1))
+            row['tags'] = [f'{prefix}-tag-{t}' for t in sorted(set(picked))]
+        rows.append(row)
+    return rows
+
+
+def _load_markets(prefix, count):
+    """Market ids, [YES, NO] outcome ids, shard numbers and statuses of the generated markets, by number."""
+    market_ids = np.zeros(count, dtype=np.int64)
+    outcome_ids = np.zeros((count, 2), dtype=np.int64)
+    market_shard = np.zeros(count, dtype=np.int8)
+    statuses = [''] * count
+    offset = len(prefix) + len('-market-')
+    for shard, alias in enumerate(sharding.shards()):
+        rows = Outcome.objects.using(alias).filter(market__slug__startswith=f'{prefix}-market-').values_list(
+            'market__slug', 'market_id', 'market__status', 'name', 'id',
+        )
+        for slug, market_id, status, name, outcome_id in rows.iterator(chunk_size=BATCH_SIZE):
+            n = int(slug[offset:])
+            market_ids[n] = market_id
+            market_shard[n] = shard
+            statuses[n] = status
+            outcome_ids[n, 0 if name == 'YES' else 1] = outcome_id
+    return market_ids, outcome_ids, market_shard, statuses
+
+
+def generate(users, markets, positions, comments, *, prefix='gen', password='password', status_mix=None,
+             tags=50, market_alpha=1.1, user_alpha=0.8, shares_mean=50.0, liquidity=importing.DEFAULT_LIQUIDITY,
+             seed=None, workers=None, chunk_size=CHUNK_SIZE, log=None):
+    """
+    Generate a dataset. Returns {'users', 'markets', 'positions', 'comments'}
+    with the numbers of rows created and the seed used. Raises ValueError if
+    rows with `prefix` already exist.
+    """
+    log = log or (lambda message: None)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    if workers is None:
+        # SQLite takes one writer at a time; more processes only wait on its lock.
+        workers = 1 if connections[DEFAULT_DB_ALIAS].vendor == 'sqlite' else os.cpu_count() or 1
+    status_mix = status_mix or {Market.STATUS_OPEN: 0.8, Market.STATUS_CLOSED: 0.15, Market.STATUS_DRAFT: 0.05}
+    if User.objects.filter(username__startswith=prefix).exists():
+        raise ValueError(f'Users named {prefix}* already exist; pick another prefix.')
+    if sharding.existing_slugs([f'{prefix}-market-{0:07d}']):
+        raise ValueError(f'Markets named {prefix}-market-* already exist; pick another prefix.')
+    if users < 1 or markets < 1:
+        raise ValueError('At least one user and one market are needed.')
+
+    _init_worker({
+        'seed': seed,
+        'prefix': prefix,
+        'password': make_password(password),
+        'shares_mean': shares_mean,
+        'shards': sharding.shards(),
+    })
+
+    started = time.monotonic()
+    ranges = [(lo, min(lo + chunk_size, users)) for lo in range(0, users, chunk_size)]
+    user_ids = np.array([pk for ids in _run(_create_users, ranges, workers) for pk in ids], dtype=np.int64)
+    log(f'{users} users in {time.monotonic() - started:.1f}s')
+
+    started = time.monotonic()
+    rows = _market_rows(prefix, markets, status_mix, tags, _rng(seed, _MARKETS))
+    for batch in _batches(rows, IMPORT_SIZE):
+        result = importing.import_markets(batch, liquidity=liquidity)
+        if result['errors']:
+            raise ValueError(f'Market import failed: {result["errors"][:3]}')
+    market_ids, outcome_ids, market_shard, statuses = _load_markets(prefix, markets)
+    log(f'{markets} markets in {time.monotonic() - started:.1f}s')
+
+    rng = _rng(seed, _USERS)
+    user_weights = popularity(users, user_alpha, rng)
+    market_weights = popularity(markets, market_alpha, rng)
+    market_weights[np.array(statuses) == Market.STATUS_DRAFT] = 0
+    created = {'users': users, 'markets': markets, 'positions': 0, 'comments': 0, 'seed': seed}
+    if not market_weights.any():
+        return created
+
+    _state.update({
+        'user_ids': user_ids,
+        'user_weights': user_weights,
+        'user_cdf': _cdf(user_weights),
+        'market_ids': market_ids,
+        'outcome_ids': outcome_ids,
+        'market_shard': market_shard,
+        'market_cdf': _cdf(market_weights),
+    })
+
+    started = time.monotonic()
+    # Each user range gets the share of positions its users' weights call for.
+    bounds = list(range(0, users, max(1, users * chunk_size // max(positions, 1)))) + [users]
+    shares = np.array([user_weights[lo:hi].sum() for lo, hi in zip(bounds, bounds[1:])]) / user_weights.sum()
+    counts = np.floor(shares * positions).astype(np.int64)
+    counts[np.argsort(shares)[::-1][:positions - counts.sum()]] += 1
+    tasks = [(i, lo, hi, int(n)) for i, (lo, hi, n) in enumerate(zip(bounds, bounds[1:], counts)) if n]
+    created['positions'] = sum(_run(_create_positions, tasks, workers))
+    log(f'{created["positions"]} positions in {time.monotonic() - started:.1f}s')
+
+    started = time.monotonic()
+    tasks = [(i, min(chunk_size, comments - lo)) for i, lo in enumerate(range(0, comments, chunk_size))]
+    created['comments'] = sum(_run(_create_comments, tasks, workers))
+    log(f'{created["comments"]} comments in {time.monotonic() - started:.1f}s')
+    return created
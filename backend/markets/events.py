@@ -0,0 +1,361 @@
+"""
+Event log, state snapshots and rebuild.
+
+Every operation that changes pools, positions or balances appends an Event
+in the same transaction:
+
+    market.create / market.edit / market.resolve / market.delete / market.archive
+    market.init   pools (and prices) set when a market is initialized
+    trade         a buy: shares added to the buyer, pools after the trade
+    redeem        winning shares burned
+    balance       a change to UserProfile.balance (delta and reason)
+
+Events carry market ids and outcome names rather than outcome ids, which
+repeat across shards. Replaying the log from the start reproduces
+Outcome.pool_balance / current_price, Position.shares and
+UserProfile.balance, rounding exactly as the database does on save.
+
+So that a rebuild never replays the whole history, take_snapshot() folds the
+events since the previous StateSnapshot into a new compressed one; a task is
+queued for it every SNAPSHOT_EVERY events. Snapshots only cover events older
+than SNAPSHOT_LAG, so a transaction that commits after a later event (ids are
+handed out at insert, not at commit) is not skipped. rebuild() loads the
+latest snapshot, replays the rest of the log and writes back what differs.
+
+Data that existed before the log was introduced is captured once with
+bootstrap_snapshot().
+
+The event id doubles as the change sequence number of the market list:
+market_changes() reads the market events after a client's sequence number
+along the primary key, so a delta sync costs what changed since, not the
+size of the catalog. The sequence numbers it hands out follow the same
+rule as snapshots, with SYNC_LAG: only events old enough that no
+transaction holding a lower id can still be open. A transaction open for
+longer than SYNC_LAG (a bulk import or archival run done in one go) can
+still commit below a sequence number already handed out, and clients
+holding it only see that change on their next full list; such jobs
+should commit in chunks that take less than SYNC_LAG.
+"""
+import json
+import zlib
+from datetime import timedelta
+from decimal import ROUND_HALF_EVEN, Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import sharding, tasks
+from .models import Event, Outcome, Position, StateSnapshot, UserProfile
+
+SNAPSHOT_EVERY = 10_000
+SNAPSHOT_LAG = timedelta(minutes=1)
+SYNC_LAG = timedelta(seconds=10)
+SYNC_BATCH = 5000  # events read per delta sync page
+KEEP_SNAPSHOTS = 3
+CHUNK_SIZE = 5000
+
+SHARES = Decimal('0.0001')  # pools, prices and shares are stored with 4 decimals
+CENTS = Decimal('0.01')     # balances with 2
+
+
+def _q(value, quantum):
+    return Decimal(value).quantize(quantum, rounding=ROUND_HALF_EVEN)
+
+
+def _maybe_schedule_snapshot(first_id, last_id):
+    if last_id // SNAPSHOT_EVERY > (first_id - 1) // SNAPSHOT_EVERY:
+        tasks.enqueue('events.snapshot')
+
+
+def record(kind, market_id=None, user_id=None, **data):
+    """Append one event. Call inside the transaction making the change."""
+    event = Event.objects.create(kind=kind, market_id=market_id, user_id=user_id, data=data)
+    _maybe_schedule_snapshot(event.id, event.id)
+    return event
+
+
+def record_many(events):
+    """Append Event instances in one insert (bulk imports, scheduler transitions)."""
+    events = Event.objects.bulk_create(events)
+    ids = [e.id for e in events if e.id is not None]
+    if ids:
+        _maybe_schedule_snapshot(min(ids), max(ids))
+    return events
+
+
+def balance_changed(user_id, delta, reason):
+    return record('balance', user_id=user_id, delta=delta, reason=reason)
+
+
+def pools(*outcomes):
+    """{name: [pool, price]} payload for market.init and trade events."""
+    return {o.name: [o.pool_balance, o.current_price] for o in outcomes}
+
+
+class State:
+    """Pools, positions and balances as derived from the log up to `seq`."""
+
+    def __init__(self, seq=0, pools=None, positions=None, balances=None):
+        self.seq = seq
+        self.pools = pools or {}          # market_id -> {name: [pool, price]}
+        self.positions = positions or {}  # market_id -> {(user_id, name): shares}
+        self.balances = balances or {}    # user_id -> balance; absent means the starting balance
+
+    def apply(self, event_id, kind, market_id, user_id, data):
+        handler = getattr(self, '_on_' + kind.replace('.', '_'), None)
+        if handler is not None:
+            handler(market_id, user_id, data)
+        self.seq = event_id
+
+    def _set_pools(self, market_id, data):
+        market_pools = self.pools.setdefault(market_id, {})
+        for name, (pool, price) in data['pools'].items():
+            market_pools[name] = [_q(pool, SHARES), _q(price, SHARES)]
+
+    def _on_market_init(self, market_id, user_id, data):
+        self._set_pools(market_id, data)
+
+    def _on_trade(self, market_id, user_id, data):
+        positions = self.positions.setdefault(market_id, {})
+        key = (user_id, data['outcome'])
+        positions[key] = _q(positions.get(key, Decimal('0')) + Decimal(data['shares']), SHARES)
+        self._set_pools(market_id, data)
+
+    def _on_redeem(self, market_id, user_id, data):
+        positions = self.positions.setdefault(market_id, {})
+        key = (user_id, data['outcome'])
+        positions[key] = _q(positions.get(key, Decimal('0')) - Decimal(data['shares']), SHARES)
+
+    def _on_balance(self, market_id, user_id, data):
+        balance = self.balances.get(user_id, UserProfile.starting_balance())
+        self.balances[user_id] = _q(balance + Decimal(data['delta']), CENTS)
+
+    def _on_market_delete(self, market_id, user_id, data):
+        self.pools.pop(market_id, None)
+        self.positions.pop(market_id, None)
+
+    _on_market_archive = _on_market_delete
+
+    def to_bytes(self):
+        data = {
+            'seq': self.seq,
+            'pools': {
+                str(m): {name: [str(pool), str(price)] for name, (pool, price) in p.items()}
+                for m, p in self.pools.items()
+            },
+            'positions': {
+                str(m): [[user_id, name, str(shares)] for (user_id, name), shares in p.items()]
+                for m, p in self.positions.items()
+            },
+            'balances': {str(u): str(b) for u, b in self.balances.items()},
+        }
+        return zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+
+    @classmethod
+    def from_bytes(cls, blob):
+        data = json.loads(zlib.decompress(blob))
+        return cls(
+            seq=data['seq'],
+            pools={
+                int(m): {name: [Decimal(pool), Decimal(price)] for name, (pool, price) in p.items()}
+                for m, p in data['pools'].items()
+            },
+            positions={
+                int(m): {(user_id, name): Decimal(shares) for user_id, name, shares in rows}
+                for m, rows in data['positions'].items()
+            },
+            balances={int(u): Decimal(b) for u, b in data['balances'].items()},
+        )
+
+
+def load_latest():
+    """State of the newest snapshot, or an empty state."""
+    snapshot = StateSnapshot.objects.first()
+    return State.from_bytes(bytes(snapshot.data)) if snapshot else State()
+
+
+def replay(state, until=None):
+    """Apply events after state.seq (up to `until`) in id order. Returns the number applied."""
+    events = Event.objects.filter(id__gt=state.seq)
+    if until is not None:
+        events = events.filter(id__lte=until)
+    count = 0
+    rows = events.order_by('id').values_list('id', 'kind', 'market_id', 'user_id', 'data')
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        state.apply(*row)
+        count += 1
+    return count
+
+
+def _save(state):
+    snapshot, _ = StateSnapshot.objects.get_or_create(seq=state.seq, defaults={'data': state.to_bytes()})
+    stale = StateSnapshot.objects.order_by('-seq').values_list('id', flat=True)[KEEP_SNAPSHOTS:]
+    StateSnapshot.objects.filter(id__in=list(stale)).delete()
+    return snapshot
+
+
+def take_snapshot(now=None):
+    """Fold settled events into a new snapshot. Returns it, or None if nothing new has settled."""
+    now = now or timezone.now()
+    state = load_latest()
+    watermark = (
+        Event.objects.filter(id__gt=state.seq, created_at__lte=now - SNAPSHOT_LAG)
+        .order_by('-id').values_list('id', flat=True).first()
+    )
+    if watermark is None:
+        return None
+    replay(state, until=watermark)
+    return _save(state)
+
+
+def bootstrap_snapshot():
+    """
+    Snapshot the live tables as they are now, at the current end of the log.
+    Only for adopting the log on an existing database: it trusts the tables.
+    """
+    def shard_state():
+        market_pools, positions = {}, {}
+        for market_id, name, pool, price in Outcome.objects.values_list(
+            'market_id', 'name', 'pool_balance', 'current_price'
+        ).iterator(chunk_size=CHUNK_SIZE):
+            market_pools.setdefault(market_id, {})[name] = [pool, price]
+        for user_id, market_id, name, shares in Position.objects.values_list(
+            'user_id', 'outcome__market_id', 'outcome__name', 'shares'
+        ).iterator(chunk_size=CHUNK_SIZE):
+            positions.setdefault(market_id, {})[(user_id, name)] = shares
+        return market_pools, positions
+
+    with transaction.atomic():
+        seq = Event.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        state = State(seq=seq)
+        for market_pools, positions in sharding.scatter_gather(shard_state):
+            state.pools.update(market_pools)
+            state.positions.update(positions)
+        state.balances = dict(UserProfile.objects.values_list('user_id', 'balance').iterator(chunk_size=CHUNK_SIZE))
+        return _save(state)
+
+
+def _bulk_update(model, objs, fields):
+    if objs:
+        model.objects.bulk_update(objs, fields, batch_size=1000)
+
+
+def _repair_shard(state, dry_run):
+    """Compare and fix the outcomes and positions of the active shard against `state`."""
+    fixed = {'outcomes': 0, 'positions': 0}
+    outcome_ids = {}
+    updates = []
+    for outcome_id, market_id, name, pool, price in Outcome.objects.values_list(
+        'id', 'market_id', 'name', 'pool_balance', 'current_price'
+    ).iterator(chunk_size=CHUNK_SIZE):
+        outcome_ids[(market_id, name)] = outcome_id
+        expected = state.pools.get(market_id, {}).get(name)
+        if expected is not None and [pool, price] != expected:
+            updates.append(Outcome(id=outcome_id, pool_balance=expected[0], current_price=expected[1]))
+    fixed['outcomes'] = len(updates)
+
+    seen = set()
+    position_updates = []
+    for position_id, user_id, market_id, name, shares in Position.objects.values_list(
+        'id', 'user_id', 'outcome__market_id', 'outcome__name', 'shares'
+    ).iterator(chunk_size=CHUNK_SIZE):
+        if market_id not in state.pools:
+            continue  # not covered by the log
+        seen.add((market_id, user_id, name))
+        expected = state.positions.get(market_id, {}).get((user_id, name), Decimal('0'))
+        if shares != expected:
+            position_updates.append(Position(id=position_id, shares=expected))
+    missing = [
+        Position(user_id=user_id, outcome_id=outcome_ids[(market_id, name)], shares=shares)
+        for market_id, positions in state.positions.items()
+        for (user_id, name), shares in positions.items()
+        if (market_id, user_id, name) not in seen and (market_id, name) in outcome_ids and shares
+    ]
+    fixed['positions'] = len(position_updates) + len(missing)
+
+    if not dry_run:
+        _bulk_update(Outcome, updates, ['pool_balance', 'current_price'])
+        _bulk_update(Position, position_updates, ['shares'])
+        Position.objects.bulk_create(missing, batch_size=1000)
+    return fixed
+
+
+def rebuild(dry_run=False):
+    """
+    Load the latest snapshot, replay the newer events and correct pools,
+    positions and balances that differ. Returns a summary of what was (or,
+    with dry_run, would be) fixed.
+    """
+    state = load_latest()
+    snapshot_seq = state.seq
+    replayed = replay(state)
+
+    report = {'snapshot_seq': snapshot_seq, 'replayed': replayed, 'seq': state.seq,
+              'outcomes': 0, 'positions': 0, 'balances': 0}
+    for alias in sharding.shards():
+        with sharding.use_shard(alias), transaction.atomic(using=alias):
+            for key, count in _repair_shard(state, dry_run).items():
+                report[key] += count
+
+    start = UserProfile.starting_balance()
+    balance_updates = [
+        UserProfile(id=profile_id, balance=state.balances.get(user_id, start))
+        for profile_id, user_id, balance in UserProfile.objects.values_list(
+            'id', 'user_id', 'balance'
+        ).iterator(chunk_size=CHUNK_SIZE)
+        if balance != state.balances.get(user_id, start)
+    ]
+    report['balances'] = len(balance_updates)
+    if not dry_run:
+        with transaction.atomic():
+            _bulk_update(UserProfile, balance_updates, ['balance'])
+    return report
+
+
+@tasks.task('events.snapshot')
+def snapshot_task(payload):
+    take_snapshot()
+
+
+# Change feed
+
+def latest_seq():
+    """Id of the newest event, or 0."""
+    return Event.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def high_water_mark(now=None):
+    """Newest sequence number below which every event has committed (see SYNC_LAG)."""
+    cutoff = (now or timezone.now()) - SYNC_LAG
+    return Event.objects.filter(created_at__lte=cutoff).order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def market_changes(since, limit=None, now=None):
+    """
+    Markets touched by events after `since`, oldest change first. Returns
+    ({market_id: last known slug or None}, seq, more): pass `seq` as the
+    next `since`; `more` means the page was full and there are further
+    changes. `seq` never passes the high-water mark: a full page reaching
+    beyond it is cut there (the rest comes on a later call), so nothing that
+    may still commit below `seq` is skipped. On the last page changes newer
+    than SYNC_LAG are included but not yet covered by `seq`, so they come
+    again on the next call.
+    """
+    limit = limit or SYNC_BATCH
+    rows = list(
+        Event.objects.filter(id__gt=since, market_id__isnull=False).order_by('id')
+        .values_list('id', 'market_id', 'data__slug')[:limit]
+    )
+    mark = high_water_mark(now)
+    more = len(rows) == limit
+    if more and rows[-1][0] > mark:
+        rows = [row for row in rows if row[0] <= mark]
+        more = False
+    changed = {}
+    for event_id, market_id, slug in rows:
+        previous = changed.pop(market_id, None)  # re-inserted to keep last-change order
+        changed[market_id] = slug or previous
+    if more:
+        return changed, rows[-1][0], True
+    # Every market event up to the high-water mark was in this page.
+    return changed, max(since, mark), False
@@ -0,0 +1,153 @@
+"""
+Streaming CSV / NDJSON exports of trades, positions and market ledgers.
+
+Rows are read with QuerySet.values_list().iterator() in fixed-size chunks and
+encoded one line at a time, so memory stays flat regardless of table size.
+Without a market filter every shard is read; trades from several shards are
+merged by time as they stream. Used by the export endpoint and the
+`export_data` management command.
+"""
+import csv
+import heapq
+import json
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db.models import DecimalField, ExpressionWrapper, F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import sharding
+from .models import Market, Position, Trade
+
+CHUNK_SIZE = 2000
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def _trades(market=None, user=None, since=None, until=None):
+    qs = Trade.objects.order_by('created_at', 'id')
+    if market is not None:
+        qs = qs.filter(outcome__market=market)
+    if user is not None:
+        qs = qs.filter(user=user)
+    if since is not None:
+        qs = qs.filter(created_at__gte=since)
+    if until is not None:
+        qs = qs.filter(created_at__lt=until)
+    fields = ['id', 'created_at', 'user__username', 'outcome__market__slug', 'outcome__name',
+              'kind', 'amount', 'shares', 'price']
+    return fields, qs.values_list(*fields)
+
+
+def _positions(market=None, user=None, since=None, until=None, nonzero=False):
+    # Positions carry no timestamps; the time range only applies to trades.
+    qs = Position.objects.order_by('id').annotate(
+        value=ExpressionWrapper(F('shares') * F('outcome__current_price'), output_field=DecimalField())
+    )
+    if market is not None:
+        qs = qs.filter(outcome__market=market)
+    if user is not None:
+        qs = qs.filter(user=user)
+    if nonzero:
+        qs = qs.filter(shares__gt=0)
+    fields = ['id', 'user__username', 'outcome__market__slug', 'outcome__name',
+              'shares', 'outcome__current_price', 'value']
+    return fields, qs.values_list(*fields)
+
+
+def _ledger(market=None, user=None, since=None, until=None):
+    """Same rows as market_ledger: positions with shares > 0."""
+    return _positions(market=market, user=user, nonzero=True)
+
+
+EXPORTS = {
+    'trades': _trades,
+    'positions': _positions,
+    'ledger': _ledger,
+}
+
+# Order of rows merged from several shards; the others are concatenated.
+MERGE_KEYS = {
+    'trades': lambda row: row[1],  # created_at
+}
+
+
+def _parse_time(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'Invalid date: {value}')
+        parsed = datetime(day.year, day.month, day.day)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+def resolve_filters(market_slug=None, username=None, since=None, until=None):
+    """Turn raw filter values (slug, username, ISO dates) into export kwargs. Raises ValueError."""
+    filters = {}
+    if market_slug:
+        alias = sharding.locate(market_slug)
+        filters['market'] = alias and Market.objects.using(alias).filter(slug=market_slug).first()
+        if filters['market'] is None:
+            raise ValueError(f'Unknown market: {market_slug}')
+    if username:
+        filters['user'] = User.objects.filter(username=username).first()
+        if filters['user'] is None:
+            raise ValueError(f'Unknown user: {username}')
+    if since:
+        filters['since'] = _parse_time(since)
+    if until:
+        filters['until'] = _parse_time(until)
+    return filters
+
+
+def _column_name(field):
+    return field.replace('outcome__market__', 'market_').replace('outcome__', 'outcome_').replace('user__', '')
+
+
+def _cell(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+class _Echo:
+    """File-like object whose write() returns the line instead of buffering it."""
+
+    def write(self, value):
+        return value
+
+
+def iter_export(kind, fmt, **filters):
+    """Yield the encoded export line by line."""
+    fields, rows = EXPORTS[kind](**filters)
+    columns = [_column_name(f) for f in fields]
+    market = filters.get('market')
+    aliases = [market._state.db] if market is not None else sharding.shards()
+    streams = [rows.using(alias).iterator(chunk_size=CHUNK_SIZE) for alias in aliases]
+    if len(streams) == 1:
+        rows = streams[0]
+    elif kind in MERGE_KEYS:
+        rows = heapq.merge(*streams, key=MERGE_KEYS[kind])
+    else:
+        rows = (row for stream in streams for row in stream)
+
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow([_cell(v) for v in row])
+    elif fmt == 'ndjson':
+        for row in rows:
+            yield json.dumps(dict(zip(columns, (_cell(v) for v in row)))) + '\n'
+    else:
+        raise ValueError(f'Unknown format: {fmt}')
@@ -0,0 +1,127 @@
+"""
+Market tags and faceted counts (markets per tag per status).
+
+FacetCount keeps one row per (tag, status) on the default database, with
+tag '' counting all markets. Every code path that creates, edits,
+resolves, deletes or archives markets reports the change with
+market_changed(before, after) inside its transaction, which adjusts only
+the rows involved; reading the facets never groups the market table.
+counts() serves the table from the cache for up to CACHE_TIMEOUT seconds.
+rebuild() recomputes everything from the markets (the rebuild_facets
+command), e.g. after enabling tags on an existing database.
+"""
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils.text import slugify
+
+from . import sharding
+from .models import FacetCount, Market, Tag
+
+ALL = ''
+MAX_TAGS = 10
+CACHE_KEY = 'facets:counts'
+CACHE_TIMEOUT = 60
+
+
+def tag_name(raw):
+    """The stored form of a tag name: slugified and cut to the column length ('' if nothing is left)."""
+    return slugify(raw)[:Tag._meta.get_field('name').max_length]
+
+
+def parse_tags(value):
+    """Normalized, de-duplicated tag names from a list (or comma-separated string). Raises ValueError."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [part for part in value.split(',') if part.strip()]
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise ValueError('Tags must be a list of strings.')
+    names = []
+    for raw in value:
+        name = tag_name(raw)
+        if not name:
+            raise ValueError(f'Invalid tag: {raw!r}.')
+        if name not in names:
+            names.append(name)
+    if len(names) > MAX_TAGS:
+        raise ValueError(f'At most {MAX_TAGS} tags.')
+    return names
+
+
+def get_tags(names):
+    """Tag rows for `names`, creating missing ones (which replicates them to every shard)."""
+    tags = {tag.name: tag for tag in Tag.objects.filter(name__in=names)}
+    for name in names:
+        if name not in tags:
+            tags[name], _ = Tag.objects.get_or_create(name=name)
+    return [tags[name] for name in names]
+
+
+def state(market):
+    """(status, tag names) of a market, to pass to market_changed()."""
+    return market.status, frozenset(market.tags.values_list('name', flat=True))
+
+
+def _add(deltas, market_state, sign):
+    if market_state is None:
+        return
+    status, tags = market_state
+    deltas[(ALL, status)] += sign
+    for tag in tags:
+        deltas[(tag, status)] += sign
+
+
+def adjust(deltas):
+    """Apply {(tag, status): delta} to the counts. Call inside the change's transaction."""
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    FacetCount.objects.bulk_create(
+        [FacetCount(tag=tag, status=status) for tag, status in deltas], ignore_conflicts=True,
+    )
+    for (tag, status), delta in sorted(deltas.items()):  # fixed order against deadlocks
+        FacetCount.objects.filter(tag=tag, status=status).update(count=F('count') + delta)
+    transaction.on_commit(lambda: cache.delete(CACHE_KEY))
+
+
+def market_changed(before, after):
+    """Count a market moving from state `before` to `after`; None for created or deleted."""
+    deltas = Counter()
+    _add(deltas, before, -1)
+    _add(deltas, after, 1)
+    adjust(deltas)
+
+
+def counts():
+    """{tag: {status: count}}, with '' for all markets."""
+    data = cache.get(CACHE_KEY)
+    if data is None:
+        data = {}
+        for tag, status, count in FacetCount.objects.filter(count__gt=0).values_list('tag', 'status', 'count'):
+            data.setdefault(tag, {})[status] = count
+        cache.set(CACHE_KEY, data, CACHE_TIMEOUT)
+    return data
+
+
+def rebuild():
+    """Recount every facet from the markets on all shards. Returns the number of rows written."""
+    def shard_counts():
+        totals = Counter()
+        for status, n in Market.objects.values('status').annotate(n=Count('id')).values_list('status', 'n'):
+            totals[(ALL, status)] += n
+        through = Market.tags.through.objects.values('tag__name', 'market__status').annotate(n=Count('id'))
+        for tag, status, n in through.values_list('tag__name', 'market__status', 'n'):
+            totals[(tag, status)] += n
+        return totals
+
+    totals = sum(sharding.scatter_gather(shard_counts), Counter())
+    with transaction.atomic():
+        FacetCount.objects.all().delete()
+        FacetCount.objects.bulk_create(
+            [FacetCount(tag=tag, status=status, count=n) for (tag, status), n in totals.items()]
+        )
+    cache.delete(CACHE_KEY)
+    return len(totals)
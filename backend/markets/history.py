@@ -0,0 +1,127 @@
+"""
+Daily portfolio snapshots.
+
+snapshot_portfolios() values every user's portfolio once per day: cash
+balance, USD reserved by open limit orders, and positions at end-of-day
+prices (winning shares at 1 and losing shares at 0 once a market is
+resolved). Users are processed in id ranges on a thread pool; within a
+range the database sums shares * price per user, so no position rows are
+loaded into Python. Results are upserted into PortfolioSnapshot, one row
+per user per day, and the history endpoint reads only that table.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models import Case, DecimalField, F, Sum, Value, When
+from django.utils import timezone
+
+from . import sharding
+from .audit import id_ranges
+from .models import LimitOrder, Market, PortfolioSnapshot, Position, UserProfile
+
+CHUNK_SIZE = 2000
+MAX_DAYS = 3650  # longest range the history endpoint serves
+
+ZERO = Decimal('0')
+
+_money = DecimalField(max_digits=30, decimal_places=8)
+
+# Value per share: the current price, or the payout once the market is resolved.
+SHARE_VALUE = Case(
+    When(
+        outcome__market__status=Market.STATUS_RESOLVED,
+        then=Case(
+            When(outcome__market__winning_outcome_id=F('outcome_id'), then=Value(Decimal('1'))),
+            default=Value(ZERO),
+            output_field=_money,
+        ),
+    ),
+    default=F('outcome__current_price'),
+    output_field=_money,
+)
+
+
+def _sums(first, last):
+    """{user_id: (positions value, reserved)} on the active shard."""
+    in_range = {'user_id__gte': first, 'user_id__lte': last}
+    positions = (
+        Position.objects.filter(shares__gt=0, **in_range).values('user_id')
+        .annotate(value=Sum(F('shares') * SHARE_VALUE, output_field=_money))
+        .values_list('user_id', 'value')
+    )
+    reserved = (
+        LimitOrder.objects.filter(status=LimitOrder.STATUS_OPEN, **in_range).values('user_id')
+        .annotate(total=Sum('remaining')).values_list('user_id', 'total')
+    )
+    return dict(positions), dict(reserved)
+
+
+def snapshot_range(first, last, date):
+    """Write snapshots for users with first <= id <= last. Returns the number written."""
+    values, reserved = {}, {}
+    for shard_values, shard_reserved in sharding.scatter_gather(lambda: _sums(first, last)):
+        for user_id, value in shard_values.items():
+            values[user_id] = values.get(user_id, ZERO) + value
+        for user_id, total in shard_reserved.items():
+            reserved[user_id] = reserved.get(user_id, ZERO) + total
+
+    quantum = Decimal('0.0001')
+    snapshots = [
+        PortfolioSnapshot(
+            user_id=user_id,
+            date=date,
+            balance=balance,
+            reserved=reserved.get(user_id, ZERO),
+            positions=values.get(user_id, ZERO).quantize(quantum),
+        )
+        for user_id, balance in UserProfile.objects.filter(user_id__gte=first, user_id__lte=last)
+        .values_list('user_id', 'balance').iterator()
+    ]
+    PortfolioSnapshot.objects.bulk_create(
+        snapshots,
+        update_conflicts=True,
+        unique_fields=['user', 'date'],
+        update_fields=['balance', 'reserved', 'positions'],
+    )
+    return len(snapshots)
+
+
+def _snapshot_range_in_thread(args):
+    try:
+        return snapshot_range(*args)
+    finally:
+        connection.close()
+
+
+def snapshot_portfolios(date=None, chunk_size=CHUNK_SIZE, workers=1):
+    """Snapshot every user for `date` (default: today). Re-running a day overwrites it."""
+    date = date or timezone.localdate()
+    ranges = ((first, last, date) for first, last in id_ranges(UserProfile.objects.all(), 'user_id', chunk_size))
+    if workers <= 1:
+        return sum(snapshot_range(*args) for args in ranges)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(_snapshot_range_in_thread, ranges))
+
+
+def pnl_history(user, since=None):
+    """A user's snapshots, oldest first, with P&L against the starting balance and the previous day."""
+    snapshots = PortfolioSnapshot.objects.filter(user=user).order_by('date')
+    if since is not None:
+        snapshots = snapshots.filter(date__gte=since)
+    start = UserProfile.starting_balance()
+    history = []
+    previous = None
+    for snap in snapshots.only('date', 'balance', 'reserved', 'positions'):
+        total = snap.total
+        history.append({
+            'date': snap.date.isoformat(),
+            'balance': snap.balance,
+            'reserved': snap.reserved,
+            'positions': snap.positions,
+            'total': total,
+            'pnl': total - start,
+            'change': total - previous if previous is not None else None,
+        })
+        previous = total
+    return history
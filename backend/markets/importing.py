@@ -0,0 +1,224 @@
+"""
+Bulk market import from CSV or JSONL.
+
+Each row needs `title` and `slug`; `description`, `status`, `liquidity` and
+`tags` (a list, or comma-separated in CSV) are optional. All slugs are
+checked against the live and archive tables up front, then markets and their YES/NO outcomes are inserted with bulk_create
+in batches. Invalid rows are reported individually and never abort the batch.
+"""
+import csv
+import io
+import json
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_slug
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+
+from . import events, facets, sharding
+
+from .archive import archived_slugs
+from .models import Event, Market, Outcome
+
+DEFAULT_LIQUIDITY = Decimal('100.0')
+BATCH_SIZE = 500
+
+MAX_TITLE = Market._meta.get_field('title').max_length
+MAX_SLUG = Market._meta.get_field('slug').max_length
+_pool_field = Outcome._meta.get_field('pool_balance')
+MAX_LIQUIDITY = Decimal(10) ** (_pool_field.max_digits - _pool_field.decimal_places)
+
+FORMATS = ('csv', 'jsonl')
+
+
+def parse_rows(text, fmt):
+    """Parse CSV or JSONL text into a list of dicts. JSON errors become per-row error entries."""
+    if fmt == 'csv':
+        return list(csv.DictReader(io.StringIO(text)))
+    if fmt == 'jsonl':
+        rows = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                row = {'_error': 'Invalid JSON.'}
+            rows.append(row if isinstance(row, dict) else {'_error': 'Row must be an object.'})
+        return rows
+    raise ValueError(f'Unknown format: {fmt}')
+
+
+def _text(row, field, errors, default=''):
+    """Stripped string value of `field`; JSONL rows may carry numbers, lists or objects."""
+    value = row.get(field)
+    if value is None or value == '':
+        return default
+    if not isinstance(value, str):
+        errors[field] = 'Must be a string.'
+        return default
+    return value.strip()
+
+
+def _clean_row(row, default_liquidity):
+    """Validate one row. Returns (fields, errors)."""
+    if row.get('_error'):
+        return None, {'row': row['_error']}
+
+    errors = {}
+    title = _text(row, 'title', errors)
+    slug = _text(row, 'slug', errors)
+    description = _text(row, 'description', errors)
+    status = _text(row, 'status', errors, default=Market.STATUS_DRAFT)
+
+    # setdefault: a non-string value has already been reported.
+    if not title:
+        errors.setdefault('title', 'Title is required.')
+    elif len(title) > MAX_TITLE:
+        errors['title'] = f'Title too long (max {MAX_TITLE} chars).'
+    if not slug:
+        errors.setdefault('slug', 'Slug is required.')
+    elif len(slug) > MAX_SLUG:
+        errors['slug'] = f'Slug too long (max {MAX_SLUG} chars).'
+    else:
+        try:
+            validate_slug(slug)
+        except ValidationError:
+            errors['slug'] = 'Invalid slug.'
+    if status not in dict(Market.STATUS_CHOICES):
+        errors['status'] = 'Invalid status.'
+
+    liquidity = default_liquidity
+    if row.get('liquidity') not in (None, ''):
+        try:
+            if isinstance(row['liquidity'], bool):
+                raise InvalidOperation
+            liquidity = Decimal(str(row['liquidity']))
+            # Rejects NaN and Infinity too, and what the pool column cannot hold.
+            if not liquidity.is_finite() or liquidity <= 0 or liquidity >= MAX_LIQUIDITY:
+                raise InvalidOperation
+        except InvalidOperation:
+            errors['liquidity'] = 'Invalid liquidity.'
+
+    try:
+        tags = facets.parse_tags(row.get('tags') or None)
+    except ValueError as e:
+        errors['tags'] = str(e)
+        tags = []
+
+    fields = {'title': title, 'slug': slug, 'description': description, 'status': status, 'tags': tags}
+    return (fields, liquidity), errors
+
+
+def _insert_batch(batch, created_by):
+    """
+    Insert (row_number, fields, liquidity) tuples in one transaction per
+    database: markets first, then their initialized outcomes. Returns the
+    number of markets created.
+    """
+    if not sharding.enabled():
+        with transaction.atomic():
+            return _insert_rows(batch, created_by)
+    committed = []  # (alias, market ids) already committed on another shard
+    try:
+        # Directory rows, events and facet counts live on the default
+        # database and commit last; each other shard commits on its own.
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            placements = sharding.allocate([fields['slug'] for _, fields, _ in batch])
+            by_shard = {}
+            for (number, fields, liquidity), (market_id, alias) in zip(batch, placements):
+                by_shard.setdefault(alias, []).append((number, {**fields, 'id': market_id}, liquidity))
+            created = 0
+            for alias, rows in by_shard.items():
+                with sharding.use_shard(alias), transaction.atomic(using=alias):
+                    created += _insert_rows(rows, created_by)
+                if alias != DEFAULT_DB_ALIAS:
+                    committed.append((alias, [fields['id'] for _, fields, _ in rows]))
+    except BaseException:
+        # The default transaction rolled back: take the shards' rows back out.
+        for alias, ids in committed:
+            Market.objects.using(alias).filter(id__in=ids).delete()
+        raise
+    return created
+
+
+def _insert_rows(batch, created_by):
+    tag_names = [fields['tags'] for _, fields, _ in batch]
+    markets = Market.objects.bulk_create([
+        Market(created_by=created_by, **{k: v for k, v in fields.items() if k != 'tags'})
+        for _, fields, _ in batch
+    ])
+    used = sorted({name for names in tag_names for name in names})
+    if used:
+        tags = {tag.name: tag for tag in facets.get_tags(used)}
+        Market.tags.through.objects.bulk_create([
+            Market.tags.through(market_id=market.id, tag_id=tags[name].id)
+            for market, names in zip(markets, tag_names)
+            for name in names
+        ])
+    deltas = Counter()
+    for market, names in zip(markets, tag_names):
+        for tag in (facets.ALL, *names):
+            deltas[(tag, market.status)] += 1
+    facets.adjust(deltas)
+    outcomes = []
+    for market, (_, _, liquidity) in zip(markets, batch):
+        outcomes.append(Outcome(market=market, name='YES', current_price=Decimal('0.5'), pool_balance=liquidity))
+        outcomes.append(Outcome(market=market, name='NO', current_price=Decimal('0.5'), pool_balance=liquidity))
+    Outcome.objects.bulk_create(outcomes)
+
+    log = []
+    for market, yes, no in zip(markets, outcomes[::2], outcomes[1::2]):
+        log.append(Event(kind='market.create', market_id=market.id, user_id=created_by.id if created_by else None,
+                         data={'slug': market.slug, 'title': market.title, 'status': market.status}))
+        log.append(Event(kind='market.init', market_id=market.id, data={'pools': events.pools(yes, no)}))
+    events.record_many(log)
+    return len(markets)
+
+
+def import_markets(rows, created_by=None, liquidity=DEFAULT_LIQUIDITY, batch_size=BATCH_SIZE):
+    """
+    Import parsed rows. Returns {'created': n, 'errors': [{'row': i, 'errors': {...}}]}
+    where `row` is the 1-based position of the row in the input.
+    """
+    errors = []
+    valid = []
+    seen = set()
+
+    for number, row in enumerate(rows, start=1):
+        cleaned, row_errors = _clean_row(row, liquidity)
+        if not row_errors:
+            fields, row_liquidity = cleaned
+            if fields['slug'] in seen:
+                row_errors = {'slug': 'Duplicate slug in import.'}
+            else:
+                seen.add(fields['slug'])
+                valid.append((number, fields, row_liquidity))
+        if row_errors:
+            errors.append({'row': number, 'errors': row_errors})
+
+    existing = sharding.existing_slugs(seen)
+    existing |= archived_slugs(seen - existing)
+    pending = []
+    for number, fields, row_liquidity in valid:
+        if fields['slug'] in existing:
+            errors.append({'row': number, 'errors': {'slug': 'Slug already exists.'}})
+        else:
+            pending.append((number, fields, row_liquidity))
+
+    created = 0
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        try:
+            created += _insert_batch(batch, created_by)
+        except IntegrityError:
+            # A slug was taken concurrently; retry row by row to isolate it.
+            for item in batch:
+                try:
+                    created += _insert_batch([item], created_by)
+                except IntegrityError:
+                    errors.append({'row': item[0], 'errors': {'slug': 'Slug already exists.'}})
+
+    errors.sort(key=lambda e: e['row'])
+    return {'created': created, 'errors': errors}
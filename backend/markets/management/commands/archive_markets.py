@@ -0,0 +1,26 @@
+"""
+Management command to move settled markets into the archive.
+Meant to run periodically (e.g. a daily cron job).
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from markets.archive import archive_settled_markets
+
+
+class Command(BaseCommand):
+    help = 'Archive markets resolved more than ARCHIVE_AFTER_DAYS ago with nothing left to settle'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--limit', type=int, help='Archive at most this many markets')
+        parser.add_argument('--dry-run', action='store_true', help='List markets without archiving them')
+
+    def handle(self, *args, **options):
+        slugs = archive_settled_markets(
+            older_than_days=options['days'], limit=options['limit'], dry_run=options['dry_run']
+        )
+        for slug in slugs:
+            self.stdout.write(slug)
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(slugs)} markets.'))
@@ -0,0 +1,47 @@
+"""
+Management command to reconcile pools, positions and balances with the
+Trade journal. Discrepancies are written as JSON lines, followed by a
+summary line; see markets/audit.py for the checks.
+"""
+import json
+import os
+import sys
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+
+from markets import audit
+
+
+class Command(BaseCommand):
+    help = 'Check market, position and balance invariants and report discrepancies as JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=audit.CHUNK_SIZE, help='Rows per chunk')
+        parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1))
+        parser.add_argument('--tolerance', default=str(audit.TOLERANCE), help='Allowed difference before rounding slack')
+        parser.add_argument('--output', '-o', help='Output file (default: stdout)')
+        parser.add_argument('--strict', action='store_true', help='Exit with an error if anything is found')
+
+    def handle(self, *args, **options):
+        try:
+            tolerance = Decimal(options['tolerance'])
+        except InvalidOperation:
+            raise CommandError('Invalid --tolerance.')
+
+        out = open(options['output'], 'w') if options['output'] else sys.stdout
+        try:
+            for entry in audit.run_audit(
+                chunk_size=max(1, options['chunk_size']), workers=options['workers'], tolerance=tolerance,
+            ):
+                out.write(json.dumps(entry) + '\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        summary = entry['summary']
+        message = (f'Checked {summary["markets"]} markets, {summary["positions"]} positions, '
+                   f'{summary["profiles"]} profiles: {summary["discrepancies"]} discrepancies.')
+        if summary['discrepancies'] and options['strict']:
+            raise CommandError(message)
+        self.stderr.write(message)
@@ -0,0 +1,41 @@
+"""
+Management command to stream trades, positions or ledgers to CSV / NDJSON.
+Rows are read in chunks, so memory use does not grow with the export size.
+"""
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from markets import exports
+
+
+class Command(BaseCommand):
+    help = 'Export trades, positions or a market ledger as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(exports.EXPORTS))
+        parser.add_argument('--format', choices=sorted(exports.FORMATS), default='csv')
+        parser.add_argument('--market', help='Market slug')
+        parser.add_argument('--user', help='Username')
+        parser.add_argument('--since', help='ISO date/datetime (inclusive, trades only)')
+        parser.add_argument('--until', help='ISO date/datetime (exclusive, trades only)')
+        parser.add_argument('--output', '-o', help='Output file (default: stdout)')
+
+    def handle(self, *args, **options):
+        try:
+            filters = exports.resolve_filters(
+                market_slug=options['market'],
+                username=options['user'],
+                since=options['since'],
+                until=options['until'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        out = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        try:
+            for line in exports.iter_export(options['kind'], options['format'], **filters):
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,83 @@
+"""
+Management command to fill the database with a synthetic dataset at
+production scale (users with profiles, markets, positions and comments),
+for reproducing scaling problems. See markets/datagen.py.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+
+from markets import datagen, importing
+
+
+def _status_mix(value):
+    """'open=0.8,closed=0.15,draft=0.05' -> {status: weight}."""
+    mix = {}
+    for part in value.split(','):
+        status, _, weight = part.partition('=')
+        status = status.strip()
+        if status not in datagen.STATUSES:
+            raise CommandError(f'Status must be one of {", ".join(datagen.STATUSES)}: {status!r}')
+        try:
+            mix[status] = float(weight)
+        except ValueError:
+            raise CommandError(f'Invalid weight for {status}.')
+    if not sum(mix.values()) > 0 or min(mix.values()) < 0:
+        raise CommandError('Invalid --status-mix.')
+    return mix
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic users, markets, positions and comments with heavy-tailed activity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+        parser.add_argument('--markets', type=int, default=100_000)
+        parser.add_argument('--positions', type=int, default=10_000_000)
+        parser.add_argument('--comments', type=int, default=2_000_000)
+        parser.add_argument('--prefix', default='gen', help='Prefix of generated usernames, slugs and tags')
+        parser.add_argument('--password', default='password', help='Password of every generated user')
+        parser.add_argument('--status-mix', default='open=0.8,closed=0.15,draft=0.05',
+                            help='Relative weights of market statuses')
+        parser.add_argument('--tags', type=int, default=50, help='Size of the tag vocabulary (0 for no tags)')
+        parser.add_argument('--market-alpha', type=float, default=1.1, help='Power-law exponent of market popularity')
+        parser.add_argument('--user-alpha', type=float, default=0.8, help='Power-law exponent of user activity')
+        parser.add_argument('--shares-mean', type=float, default=50.0, help='Mean shares per position')
+        parser.add_argument('--liquidity', default=str(importing.DEFAULT_LIQUIDITY))
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--workers', type=int, help='Default: CPU count, or 1 on SQLite')
+        parser.add_argument('--chunk-size', type=int, default=datagen.CHUNK_SIZE, help='Rows per worker task')
+
+    def handle(self, *args, **options):
+        try:
+            liquidity = Decimal(options['liquidity'])
+            if liquidity <= 0:
+                raise InvalidOperation
+        except InvalidOperation:
+            raise CommandError('Invalid --liquidity.')
+        if options['shares_mean'] <= 0 or options['chunk_size'] <= 0:
+            raise CommandError('--shares-mean and --chunk-size must be positive.')
+
+        try:
+            created = datagen.generate(
+                options['users'], options['markets'], options['positions'], options['comments'],
+                prefix=options['prefix'],
+                password=options['password'],
+                status_mix=_status_mix(options['status_mix']),
+                tags=options['tags'],
+                market_alpha=options['market_alpha'],
+                user_alpha=options['user_alpha'],
+                shares_mean=options['shares_mean'],
+                liquidity=liquidity,
+                seed=options['seed'],
+                workers=options['workers'],
+                chunk_size=options['chunk_size'],
+                log=self.stdout.write,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created["users"]} users, {created["markets"]} markets, {created["positions"]} positions '
+            f'and {created["comments"]} comments (seed {created["seed"]}).'
+        ))
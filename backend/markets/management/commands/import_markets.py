@@ -0,0 +1,55 @@
+"""
+Management command to bulk-import markets from a CSV or JSONL file.
+Markets and their initialized outcomes are inserted in batches; invalid
+rows are reported and skipped.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from markets import importing
+
+
+class Command(BaseCommand):
+    help = 'Bulk-import markets from a CSV or JSONL file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=importing.FORMATS, help='Defaults to the file extension')
+        parser.add_argument('--liquidity', default=str(importing.DEFAULT_LIQUIDITY), help='Default pool liquidity per outcome')
+        parser.add_argument('--batch-size', type=int, default=importing.BATCH_SIZE)
+        parser.add_argument('--created-by', help='Username recorded as the creator')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+
+        try:
+            liquidity = Decimal(options['liquidity'])
+        except InvalidOperation:
+            raise CommandError('Invalid --liquidity.')
+        if not liquidity.is_finite() or liquidity <= 0 or liquidity >= importing.MAX_LIQUIDITY:
+            raise CommandError(f'--liquidity must be positive and below {importing.MAX_LIQUIDITY}.')
+        if options['batch_size'] <= 0:
+            raise CommandError('--batch-size must be positive.')
+
+        created_by = None
+        if options['created_by']:
+            created_by = get_user_model().objects.filter(username=options['created_by']).first()
+            if created_by is None:
+                raise CommandError(f'Unknown user: {options["created_by"]}')
+
+        with open(path, encoding='utf-8') as f:
+            rows = importing.parse_rows(f.read(), fmt)
+
+        result = importing.import_markets(
+            rows, created_by=created_by, liquidity=liquidity, batch_size=options['batch_size']
+        )
+
+        for error in result['errors']:
+            details = '; '.join(f'{k}: {v}' for k, v in error['errors'].items())
+            self.stdout.write(self.style.WARNING(f'Row {error["row"]}: {details}'))
+        self.stdout.write(
+            self.style.SUCCESS(f'Created {result["created"]} markets ({len(result["errors"])} rows rejected).')
+        )
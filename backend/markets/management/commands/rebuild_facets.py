@@ -0,0 +1,16 @@
+"""
+Management command recounting the faceted market counts (markets per tag
+per status) from scratch. The counts are kept up to date incrementally;
+run this once after migrating an existing database, or to repair drift.
+"""
+from django.core.management.base import BaseCommand
+
+from markets import facets
+
+
+class Command(BaseCommand):
+    help = 'Recompute markets per tag per status from the market tables'
+
+    def handle(self, *args, **options):
+        rows = facets.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} facet counts.'))
@@ -0,0 +1,26 @@
+"""
+Management command recomputing pools, positions and balances from the
+latest snapshot plus the events after it, and writing back whatever
+differs. Use --dry-run to only report the differences.
+"""
+import json
+
+from django.core.management.base import BaseCommand
+
+from markets import events
+
+
+class Command(BaseCommand):
+    help = 'Rebuild pools, positions and balances from the event log'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report differences without fixing them')
+
+    def handle(self, *args, **options):
+        report = events.rebuild(dry_run=options['dry_run'])
+        self.stdout.write(json.dumps(report))
+        verb = 'Would fix' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {report["outcomes"]} outcomes, {report["positions"]} positions, {report["balances"]} balances '
+            f'(snapshot #{report["snapshot_seq"]}, {report["replayed"]} events replayed).'
+        ))
@@ -0,0 +1,27 @@
+"""
+Management command running the market scheduler: opens draft markets at
+`opens_at` and closes open markets at `closes_at`. Sleeps until the nearest
+deadline between passes.
+"""
+from django.core.management.base import BaseCommand
+
+from markets import scheduler
+
+
+class Command(BaseCommand):
+    help = 'Open and close markets on schedule'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run one pass and exit')
+        parser.add_argument('--max-sleep', type=float, default=60.0, help='Longest sleep between passes (seconds)')
+
+    def handle(self, *args, **options):
+        while True:
+            opened, closed = scheduler.run_due()
+            for slug in opened:
+                self.stdout.write(f'opened {slug}')
+            for slug in closed:
+                self.stdout.write(f'closed {slug}')
+            if options['once']:
+                return
+            scheduler.sleep_until(scheduler.next_deadline(), max_sleep=options['max_sleep'])
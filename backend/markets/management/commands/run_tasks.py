@@ -0,0 +1,46 @@
+"""
+Management command running the background task worker.
+Each thread claims a batch of due tasks, runs it, and polls again.
+"""
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from markets import tasks
+
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, default=100, help='Tasks claimed per batch')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Drain due tasks and exit')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+
+        def work():
+            try:
+                while not stop.is_set():
+                    claimed = tasks.run_pending(options['batch_size'])
+                    if not claimed:
+                        if options['once']:
+                            return
+                        stop.wait(options['poll'])
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(max(1, options['threads']))]
+        for t in threads:
+            t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            stop.set()
+            for t in threads:
+                t.join()
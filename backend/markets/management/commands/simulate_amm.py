@@ -0,0 +1,99 @@
+"""
+Management command to backtest AMM configurations against a trade flow.
+The parameter grid is split into chunks that run vectorized in a process
+pool, one chunk per task.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from markets.models import Market
+from markets import sharding, simulation
+
+
+def _floats(value):
+    """'50,100,200' or 'start:stop:count' (inclusive linspace)."""
+    if ':' in value:
+        start, stop, count = value.split(':')
+        return np.linspace(float(start), float(stop), int(count))
+    return np.array([float(v) for v in value.split(',')])
+
+
+class Command(BaseCommand):
+    help = 'Replay recorded or synthetic trade flows against alternative AMM parameters'
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group()
+        source.add_argument('--market', help='Replay recorded buys of this market (slug)')
+        source.add_argument('--all-markets', action='store_true', help='Replay every recorded buy')
+        source.add_argument('--synthetic', type=int, metavar='N', help='Generate N random buys')
+        parser.add_argument('--p-yes', type=float, default=0.5, help='Synthetic: probability a buy is YES')
+        parser.add_argument('--mean-amount', type=float, default=20.0, help='Synthetic: mean buy size (USD)')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--curves', default='cpmm', help=f'Comma-separated: {", ".join(simulation.CURVES)}')
+        parser.add_argument('--liquidity', default='100', help="Values '50,100' or range 'start:stop:count'")
+        parser.add_argument('--fees', default='0', help="Fee rates '0,0.01' or range 'start:stop:count'")
+        parser.add_argument('--resolution', choices=['yes', 'no'], help='Settle LP P&L at this outcome (default: final price)')
+        parser.add_argument('--path-points', type=int, default=20)
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Parameter sets per task')
+        parser.add_argument('--top', type=int, default=10, help='Rows to print, best LP P&L first')
+        parser.add_argument('--output', '-o', help='Write the full JSON report here')
+
+    def handle(self, *args, **options):
+        curves = [c.strip() for c in options['curves'].split(',') if c.strip()]
+        unknown = set(curves) - set(simulation.CURVES)
+        if unknown:
+            raise CommandError(f'Unknown curves: {", ".join(sorted(unknown))}')
+
+        if options['market']:
+            alias = sharding.locate(options['market'])
+            market = alias and Market.objects.using(alias).filter(slug=options['market']).first()
+            if market is None:
+                raise CommandError(f'Unknown market: {options["market"]}')
+            flow = simulation.recorded_flow(market)
+        elif options['all_markets']:
+            flow = simulation.recorded_flow()
+        else:
+            flow = simulation.synthetic_flow(
+                options['synthetic'] or 1000,
+                p_yes=options['p_yes'],
+                mean_amount=options['mean_amount'],
+                seed=options['seed'],
+            )
+
+        try:
+            grid = simulation.parameter_grid(curves, _floats(options['liquidity']), _floats(options['fees']))
+        except ValueError:
+            raise CommandError('Invalid --liquidity or --fees.')
+
+        resolution = {'yes': simulation.YES, 'no': simulation.NO}.get(options['resolution'])
+        size = max(1, options['chunk_size'])
+        tasks = []
+        for curve, (liquidity, fees) in grid.items():
+            for start in range(0, len(liquidity), size):
+                tasks.append((curve, flow, liquidity[start:start + size], fees[start:start + size],
+                              resolution, options['path_points']))
+
+        if options['workers'] > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+                chunks = list(pool.map(simulation.simulate_chunk, tasks))
+        else:
+            chunks = [simulation.simulate_chunk(task) for task in tasks]
+        rows = [row for chunk in chunks for row in chunk]
+
+        report = {'trades': len(flow), 'volume': float(flow.amounts.sum()), 'results': rows}
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f)
+
+        self.stdout.write(f'{len(flow)} trades, {len(rows)} parameter sets')
+        self.stdout.write(f'{"curve":<6} {"liquidity":>10} {"fee":>6} {"final":>7} {"avg slip":>9} {"max slip":>9} {"LP P&L":>10}')
+        for row in sorted(rows, key=lambda r: r['lp_pnl'], reverse=True)[:options['top']]:
+            self.stdout.write(
+                f'{row["curve"]:<6} {row["liquidity"]:>10.2f} {row["fee"]:>6.3f} {row["final_price_yes"]:>7.4f} '
+                f'{row["mean_slippage"]:>9.4f} {row["max_slippage"]:>9.4f} {row["lp_pnl"]:>10.2f}'
+            )
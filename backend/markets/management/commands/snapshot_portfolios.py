@@ -0,0 +1,29 @@
+"""
+Management command writing the daily portfolio snapshots used by the P&L
+history endpoint. Meant to run nightly (e.g. a cron job just before
+midnight); running it again the same day replaces that day's rows.
+"""
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from markets.history import CHUNK_SIZE, snapshot_portfolios
+
+
+class Command(BaseCommand):
+    help = "Value every user's portfolio at current prices and store it as today's snapshot"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Snapshot date (YYYY-MM-DD, default: today)')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Users per chunk')
+        parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1))
+
+    def handle(self, *args, **options):
+        date = None
+        if options['date']:
+            date = parse_date(options['date'])
+            if date is None:
+                raise CommandError('Invalid --date.')
+        count = snapshot_portfolios(date=date, chunk_size=max(1, options['chunk_size']), workers=options['workers'])
+        self.stdout.write(self.style.SUCCESS(f'Snapshotted {count} portfolios.'))
@@ -0,0 +1,24 @@
+"""
+Management command folding new events into a state snapshot. The task
+worker does this every SNAPSHOT_EVERY events; run it by hand (or from cron)
+to snapshot sooner, or once with --bootstrap when adopting the event log on
+an existing database.
+"""
+from django.core.management.base import BaseCommand
+
+from markets import events
+
+
+class Command(BaseCommand):
+    help = 'Write a snapshot of pools, positions and balances derived from the event log'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bootstrap', action='store_true',
+                            help='Snapshot the live tables instead of the log (first run on existing data)')
+
+    def handle(self, *args, **options):
+        snapshot = events.bootstrap_snapshot() if options['bootstrap'] else events.take_snapshot()
+        if snapshot is None:
+            self.stdout.write('No settled events since the last snapshot.')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Snapshot at event #{snapshot.seq}.'))
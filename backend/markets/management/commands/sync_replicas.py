@@ -0,0 +1,25 @@
+"""
+Management command copying auth users and tags from the default database
+to every shard. Saves and deletes are replicated as they happen; run this
+after adding a shard, after turning sharding on for an existing database,
+or to repair rows written with signals bypassed (bulk loads, raw SQL).
+"""
+from django.core.management.base import BaseCommand
+
+from markets import sharding
+
+
+class Command(BaseCommand):
+    help = 'Bring the users and tags replicated on each shard in line with the default database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows compared per query')
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            self.stdout.write('Sharding is off; nothing to do.')
+            return
+        for alias, counts in sharding.sync_replicas(max(1, options['chunk_size'])).items():
+            self.stdout.write(self.style.SUCCESS(
+                f'{alias}: {counts["created"]} created, {counts["updated"]} updated, {counts["deleted"]} deleted.'
+            ))
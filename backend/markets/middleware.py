@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, _get_user_session_key, load_backend
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import AnonymousUser, User
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+
+
+def _fetch_user(backend, user_id):
+    """Load the user with its profile in one query when the backend is model-based."""
+    if not isinstance(backend, ModelBackend):
+        return backend.get_user(user_id)
+    try:
+        user = User._default_manager.select_related('userprofile').get(pk=user_id)
+    except User.DoesNotExist:
+        return None
+    return user if backend.user_can_authenticate(user) else None
+
+
+def get_user(request):
+    """
+    Same contract as django.contrib.auth.get_user, but the user row and its
+    UserProfile are fetched together so views reading `request.user.userprofile`
+    do not issue a second query.
+    """
+    user = None
+    try:
+        user_id = _get_user_session_key(request)
+        backend_path = request.session[BACKEND_SESSION_KEY]
+    except KeyError:
+        pass
+    else:
+        if backend_path in settings.AUTHENTICATION_BACKENDS:
+            user = _fetch_user(load_backend(backend_path), user_id)
+            # Verify the session
+            if hasattr(user, 'get_session_auth_hash'):
+                session_hash = request.session.get(HASH_SESSION_KEY)
+                session_auth_hash = user.get_session_auth_hash()
+                if session_hash and constant_time_compare(session_hash, session_auth_hash):
+                    pass
+                elif session_hash and any(
+                    constant_time_compare(session_hash, fallback_hash)
+                    for fallback_hash in user.get_session_auth_fallback_hash()
+                ):
+                    request.session.cycle_key()
+                    request.session[HASH_SESSION_KEY] = session_auth_hash
+                else:
+                    request.session.flush()
+                    user = None
+
+    return user or AnonymousUser()
+
+
+def _get_cached_user(request):
+    if not hasattr(request, '_cached_user'):
+        request._cached_user = get_user(request)
+    return request._cached_user
+
+
+class UserProfileAuthenticationMiddleware(AuthenticationMiddleware):
+    """Drop-in replacement for AuthenticationMiddleware that joins UserProfile."""
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: _get_cached_user(request))
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.27 on 2026-10-19 14:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('markets', '0006_comment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LimitOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('limit_price', models.DecimalField(decimal_places=4, max_digits=5)),
+                ('amount', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('remaining', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('shares_filled', models.DecimalField(decimal_places=4, default=0.0, max_digits=20)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('filled', 'Filled'), ('cancelled', 'Cancelled')], default='open', max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('outcome', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='limit_orders', to='markets.outcome')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='limit_orders', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-limit_price', 'id'],
+                'indexes': [models.Index(fields=['outcome', 'status', '-limit_price', 'id'], name='limitorder_book_idx'), models.Index(fields=['user', 'status'], name='limitorder_user_idx')],
+            },
+        ),
+    ]
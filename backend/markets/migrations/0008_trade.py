@@ -0,0 +1,33 @@
+# Generated by Django 4.2.27 on 2026-10-19 14:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('markets', '0007_limitorder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Trade',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('buy', 'Buy'), ('redeem', 'Redeem')], default='buy', max_length=16)),
+                ('amount', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('shares', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('price', models.DecimalField(decimal_places=4, max_digits=5)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('outcome', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trades', to='markets.outcome')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trades', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['outcome', 'created_at'], name='trade_outcome_time_idx'), models.Index(fields=['user', 'created_at'], name='trade_user_time_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.27 on 2026-10-19 14:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0008_trade'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMarket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('market_id', models.BigIntegerField(unique=True)),
+                ('slug', models.SlugField(max_length=200, unique=True)),
+                ('title', models.CharField(max_length=200)),
+                ('status', models.CharField(max_length=16)),
+                ('winning_outcome', models.CharField(blank=True, max_length=50)),
+                ('created_at', models.DateTimeField()),
+                ('resolved_at', models.DateTimeField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('data', models.JSONField(default=dict)),
+            ],
+            options={
+                'ordering': ['-archived_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='market',
+            name='resolved_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.27 on 2026-10-19 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0009_market_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='market',
+            name='closes_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='market',
+            name='opens_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='market',
+            index=models.Index(fields=['status', 'opens_at'], name='market_opens_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='market',
+            index=models.Index(fields=['status', 'closes_at'], name='market_closes_due_idx'),
+        ),
+    ]
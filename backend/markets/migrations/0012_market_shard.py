@@ -0,0 +1,21 @@
+# Generated by Django 4.2.27 on 2026-10-19 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0011_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarketShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(max_length=200, unique=True)),
+                ('shard', models.CharField(max_length=100)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.27 on 2026-10-19 14:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('markets', '0012_market_shard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=20)),
+                ('reserved', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('positions', models.DecimalField(decimal_places=4, max_digits=20)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='portfolio_snapshots', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['user', 'date'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='portfoliosnapshot',
+            constraint=models.UniqueConstraint(fields=('user', 'date'), name='portfolio_snapshot_user_date'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_resolved_at(apps, schema_editor):
+    """
+    Markets resolved before 0009 have no resolved_at and would never be
+    archived. Use their last trade as the resolution time, or their creation
+    time if they were never traded.
+    """
+    Market = apps.get_model('markets', 'Market')
+    Trade = apps.get_model('markets', 'Trade')
+    db = schema_editor.connection.alias
+
+    last_trade = (
+        Trade.objects.using(db).filter(outcome__market=OuterRef('pk'))
+        .order_by('-created_at').values('created_at')[:1]
+    )
+    Market.objects.using(db).filter(status='resolved', resolved_at__isnull=True).update(
+        resolved_at=Coalesce(Subquery(last_trade), F('created_at')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0017_trending_scores'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_resolved_at, migrations.RunPython.noop),
+    ]
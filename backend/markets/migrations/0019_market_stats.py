@@ -0,0 +1,21 @@
+# Generated by Django 4.2.27 on 2026-10-19 15:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0018_backfill_resolved_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarketStats',
+            fields=[
+                ('market_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('volume', models.DecimalField(decimal_places=4, default=0, max_digits=24)),
+                ('trades', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
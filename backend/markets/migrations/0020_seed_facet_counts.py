@@ -0,0 +1,42 @@
+from collections import Counter
+
+from django.db import DEFAULT_DB_ALIAS, migrations
+from django.db.models import Count
+
+
+def seed_facet_counts(apps, schema_editor):
+    """
+    0016 created FacetCount empty, so markets that existed before it were
+    never counted. Recount from the markets, as facets.rebuild() does. The
+    counts are read from the default database only, so with more shards run
+    `manage.py rebuild_facets` once every shard is migrated.
+    """
+    db = schema_editor.connection.alias
+    if db != DEFAULT_DB_ALIAS:
+        return
+    Market = apps.get_model('markets', 'Market')
+    FacetCount = apps.get_model('markets', 'FacetCount')
+
+    totals = Counter()
+    markets = Market.objects.using(db).values('status').annotate(n=Count('id'))
+    for status, n in markets.values_list('status', 'n'):
+        totals[('', status)] += n
+    links = Market.tags.through.objects.using(db).values('tag__name', 'market__status').annotate(n=Count('id'))
+    for tag, status, n in links.values_list('tag__name', 'market__status', 'n'):
+        totals[(tag, status)] += n
+
+    FacetCount.objects.using(db).all().delete()
+    FacetCount.objects.using(db).bulk_create(
+        [FacetCount(tag=tag, status=status, count=n) for (tag, status), n in totals.items()]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('markets', '0019_market_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_facet_counts, migrations.RunPython.noop),
+    ]
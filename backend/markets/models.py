@@ -1,6 +1,20 @@
+from decimal import Decimal
+
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 
 
+class Tag(models.Model):
+    """Market category. Rows are replicated to every shard so the market_tags join stays local."""
+    name = models.SlugField(max_length=50, unique=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
 class Market(models.Model):
     STATUS_DRAFT = 'draft'
     STATUS_OPEN = 'open'
@@ -21,14 +35,88 @@ class Market(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey('auth.User', null=True, blank=True, on_delete=models.SET_NULL, related_name='created_markets')
     winning_outcome = models.ForeignKey('Outcome', null=True, blank=True, on_delete=models.SET_NULL, related_name='won_markets')
+    resolved_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    opens_at = models.DateTimeField(null=True, blank=True)  # draft -> open at this time
+    closes_at = models.DateTimeField(null=True, blank=True)  # open -> closed at this time
+    tags = models.ManyToManyField(Tag, related_name='markets', blank=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Market list filtered by status.
+            models.Index(fields=['status', '-created_at'], name='market_status_created_idx'),
+            # "Next due" lookups of the market scheduler.
+            models.Index(fields=['status', 'opens_at'], name='market_opens_due_idx'),
+            models.Index(fields=['status', 'closes_at'], name='market_closes_due_idx'),
+        ]
 
     def __str__(self) -> str:
         return self.title
 
 
+class ArchivedMarket(models.Model):
+    """
+    Cold storage for a settled market. The indexed columns keep the slug
+    resolvable; outcomes, positions, comments and trades live in `data`.
+    """
+    market_id = models.BigIntegerField(unique=True)  # id the market had in the hot tables
+    slug = models.SlugField(max_length=200, unique=True)
+    title = models.CharField(max_length=200)
+    status = models.CharField(max_length=16)
+    winning_outcome = models.CharField(max_length=50, blank=True)
+    created_at = models.DateTimeField()
+    resolved_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    data = models.JSONField(default=dict)
+
+    class Meta:
+        ordering = ['-archived_at']
+
+    def __str__(self) -> str:
+        return f"{self.title} (archived)"
+
+
+class MarketShard(models.Model):
+    """
+    Slug-to-shard directory, kept on the default database when markets are
+    sharded (see markets/sharding.py). The row id is the market's id, so ids
+    stay unique across shards.
+    """
+    slug = models.SlugField(max_length=200, unique=True)
+    shard = models.CharField(max_length=100)
+
+    def __str__(self) -> str:
+        return f"{self.slug} -> {self.shard}"
+
+
+class TrendingScore(models.Model):
+    """
+    Decayed activity score of a market (see markets/trending.py), stored as
+    log(score) + decay rate * time so rows compare without being decayed.
+    Kept on the default database; `shard` says where the market lives.
+    """
+    market_id = models.BigIntegerField(unique=True)
+    shard = models.CharField(max_length=100)
+    log_score = models.FloatField(db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"market {self.market_id}: {self.log_score:.3f}"
+
+
+class MarketStats(models.Model):
+    """
+    Traded volume and number of trades of a market, folded in by the
+    trade.executed task. Kept on the default database with the task queue.
+    """
+    market_id = models.BigIntegerField(primary_key=True)
+    volume = models.DecimalField(max_digits=24, decimal_places=4, default=0)
+    trades = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f"market {self.market_id}: {self.trades} trades"
+
+
 class Outcome(models.Model):
     market = models.ForeignKey(Market, related_name='outcomes', on_delete=models.CASCADE)
     name = models.CharField(max_length=50)  # e.g., "YES", "NO"
@@ -51,6 +139,143 @@ class Position(models.Model):
         return f"{self.user.username} - {self.shares} shares of {self.outcome}"
 
 
+class Trade(models.Model):
+    """Journal of cash flows between users and markets: buys (market or limit) and redemptions."""
+    KIND_BUY = 'buy'
+    KIND_REDEEM = 'redeem'
+
+    KIND_CHOICES = [
+        (KIND_BUY, 'Buy'),
+        (KIND_REDEEM, 'Redeem'),
+    ]
+
+    user = models.ForeignKey('auth.User', related_name='trades', on_delete=models.CASCADE)
+    outcome = models.ForeignKey(Outcome, related_name='trades', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, default=KIND_BUY)
+    amount = models.DecimalField(max_digits=20, decimal_places=4)  # USD paid (buy) or received (redeem)
+    shares = models.DecimalField(max_digits=20, decimal_places=4)
+    price = models.DecimalField(max_digits=5, decimal_places=4)  # outcome price after the trade
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['outcome', 'created_at'], name='trade_outcome_time_idx'),
+            models.Index(fields=['user', 'created_at'], name='trade_user_time_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.user.username} {self.kind} {self.shares} of {self.outcome}"
+
+
+class LimitOrder(models.Model):
+    """Resting buy order for an outcome, filled against the pool once its price is at or below limit_price."""
+    STATUS_OPEN = 'open'
+    STATUS_FILLED = 'filled'
+    STATUS_CANCELLED = 'cancelled'
+
+    STATUS_CHOICES = [
+        (STATUS_OPEN, 'Open'),
+        (STATUS_FILLED, 'Filled'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+
+    user = models.ForeignKey('auth.User', related_name='limit_orders', on_delete=models.CASCADE)
+    outcome = models.ForeignKey(Outcome, related_name='limit_orders', on_delete=models.CASCADE)
+    limit_price = models.DecimalField(max_digits=5, decimal_places=4)
+    amount = models.DecimalField(max_digits=20, decimal_places=4)  # USD reserved at placement
+    remaining = models.DecimalField(max_digits=20, decimal_places=4)  # USD not yet filled
+    shares_filled = models.DecimalField(max_digits=20, decimal_places=4, default=0.0)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_OPEN)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-limit_price', 'id']
+        indexes = [
+            # Price-time priority scan of one outcome's open orders.
+            models.Index(fields=['outcome', 'status', '-limit_price', 'id'], name='limitorder_book_idx'),
+            models.Index(fields=['user', 'status'], name='limitorder_user_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.user.username} buy {self.outcome.name} <= {self.limit_price} ({self.remaining} left)"
+
+
+class FacetCount(models.Model):
+    """Number of markets with `tag` ('' for all markets) and `status`; see markets/facets.py."""
+    tag = models.CharField(max_length=50, blank=True)
+    status = models.CharField(max_length=16, choices=Market.STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tag', 'status'], name='facetcount_tag_status_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.tag or '*'}/{self.status}: {self.count}"
+
+
+class PriceAlert(models.Model):
+    """Notify `user` when an outcome's price crosses `threshold` (see markets/alerts.py)."""
+    DIRECTION_ABOVE = 'above'
+    DIRECTION_BELOW = 'below'
+
+    DIRECTION_CHOICES = [
+        (DIRECTION_ABOVE, 'Rises to or above'),
+        (DIRECTION_BELOW, 'Falls to or below'),
+    ]
+
+    STATUS_ACTIVE = 'active'
+    STATUS_TRIGGERED = 'triggered'
+    STATUS_CANCELLED = 'cancelled'
+
+    STATUS_CHOICES = [
+        (STATUS_ACTIVE, 'Active'),
+        (STATUS_TRIGGERED, 'Triggered'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+
+    user = models.ForeignKey('auth.User', related_name='price_alerts', on_delete=models.CASCADE)
+    outcome = models.ForeignKey(Outcome, related_name='price_alerts', on_delete=models.CASCADE)
+    direction = models.CharField(max_length=8, choices=DIRECTION_CHOICES)
+    threshold = models.DecimalField(max_digits=5, decimal_places=4)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_ACTIVE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    triggered_at = models.DateTimeField(null=True, blank=True)
+    triggered_price = models.DecimalField(max_digits=5, decimal_places=4, null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # Loading one outcome's active thresholds into the in-memory index.
+            models.Index(fields=['outcome', 'status'], name='pricealert_outcome_idx'),
+            models.Index(fields=['user', 'status'], name='pricealert_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.outcome} {self.direction} {self.threshold}"
+
+
+class Notification(models.Model):
+    """Message for a user, e.g. a triggered price alert."""
+    user = models.ForeignKey('auth.User', related_name='notifications', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=32)
+    message = models.CharField(max_length=300)
+    data = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    read = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='notification_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.message}"
+
+
 class Comment(models.Model):
     """Comment on a market for discussion."""
     market = models.ForeignKey(Market, related_name='comments', on_delete=models.CASCADE)
@@ -65,23 +290,108 @@ class Comment(models.Model):
         return f"{self.user.username} on {self.market.title}: {self.text[:50]}"
 
 
+class Task(models.Model):
+    """Background job in the local DB-backed queue (see markets/tasks.py)."""
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_at = models.DateTimeField()
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='task_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+
+class PortfolioSnapshot(models.Model):
+    """End-of-day value of one user's portfolio (see markets/history.py)."""
+    user = models.ForeignKey('auth.User', related_name='portfolio_snapshots', on_delete=models.CASCADE)
+    date = models.DateField()
+    balance = models.DecimalField(max_digits=20, decimal_places=2)
+    reserved = models.DecimalField(max_digits=20, decimal_places=4)  # USD held by open limit orders
+    positions = models.DecimalField(max_digits=20, decimal_places=4)  # shares valued at end-of-day prices
+
+    class Meta:
+        ordering = ['user', 'date']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'date'], name='portfolio_snapshot_user_date'),
+        ]
+
+    @property
+    def total(self):
+        return self.balance + self.reserved + self.positions
+
+    def __str__(self):
+        return f"{self.user_id} {self.date}: {self.total}"
+
+
+class Event(models.Model):
+    """
+    Append-only log of state changes (see markets/events.py). The id is the
+    global sequence number.
+    """
+    kind = models.CharField(max_length=32)
+    market_id = models.BigIntegerField(null=True, blank=True)
+    user_id = models.BigIntegerField(null=True, blank=True)
+    data = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"#{self.id} {self.kind}"
+
+
+class StateSnapshot(models.Model):
+    """Pools, positions and balances derived from every event up to `seq`, zlib-compressed JSON."""
+    seq = models.BigIntegerField(unique=True)
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-seq']
+
+    def __str__(self):
+        return f"State at #{self.seq}"
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField('auth.User', on_delete=models.CASCADE)
     balance = models.DecimalField(max_digits=20, decimal_places=2, default=1000.00)
 
+    @classmethod
+    def starting_balance(cls):
+        return Decimal(str(cls._meta.get_field('balance').default))
+
     def __str__(self):
         return f"{self.user.username}'s Profile ($ {self.balance})"
 
 # Signals to auto-create UserProfile
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.db import DEFAULT_DB_ALIAS
 from django.contrib.auth.models import User
 
 @receiver(post_save, sender=User)
-def create_user_profile(sender, instance, created, **kwargs):
-    if created:
+def create_user_profile(sender, instance, created, using=None, **kwargs):
+    # Users replicated to market shards (markets/sharding.py) have no profile there.
+    if created and using == DEFAULT_DB_ALIAS:
         UserProfile.objects.create(user=instance)
-
-@receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    instance.userprofile.save()
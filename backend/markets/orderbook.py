@@ -0,0 +1,391 @@
+"""
+Resting limit orders layered on top of the CPMM pool.
+
+A limit order "buy YES up to p" reserves its USD amount at placement and is
+filled against the pool whenever YES trades at or below p. Open orders are
+persisted in LimitOrder (indexed by outcome, status, price, id) and mirrored
+per outcome in an in-memory max-heap so a match pass only touches orders
+that actually cross: popping the best order is O(log n) in the book size.
+
+The in-memory book only ever holds committed orders. A transaction's own
+changes ride on the on_commit callbacks it registers (_PendingChange), so
+they are invisible to other threads and vanish with a rollback, savepoints
+included; a match pass reads the book through a _BookView that layers
+those pending changes on top. On commit the changes are applied to the
+book, the book's version in the cache is bumped and the operations are
+stored under that version for DELTA_TTL seconds. A worker whose book is
+behind replays the missing operations, and only reloads the book from the
+table when some are gone or it is more than MAX_DELTAS versions behind.
+Each book has its own lock, so loading or matching one outcome does not
+hold up the others.
+"""
+import heapq
+import threading
+from contextlib import ExitStack
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from . import events, tasks
+from .models import LimitOrder, Outcome, UserProfile
+from .scheduler import trading_open
+from .services import CPMMService
+from .sharding import atomic_method, current_shard
+
+# Fills smaller than this (in USD) are not worth a pool update.
+MIN_FILL = Decimal('0.01')
+
+# Safety valve for YES/NO orders repeatedly crossing each other in one pass.
+MAX_FILLS_PER_PASS = 1000
+
+MAX_DELTAS = 256
+DELTA_TTL = 300  # seconds
+
+
+class PriceLevelBook:
+    """
+    Open orders of one outcome in price-time priority: highest limit price
+    first, then oldest (lowest id). Cancelled or filled orders are removed
+    lazily when they reach the top of the heap.
+    """
+
+    def __init__(self, version=0):
+        self.version = version
+        self.loaded = False
+        self.lock = threading.RLock()
+        self._heap = []
+        self._live = set()
+
+    def __len__(self):
+        return len(self._live)
+
+    def push(self, order_id, limit_price):
+        if order_id not in self._live:
+            self._live.add(order_id)
+            heapq.heappush(self._heap, (-limit_price, order_id))
+
+    def discard(self, order_id):
+        self._live.discard(order_id)
+
+    def peek(self):
+        """Best (limit_price, order_id), or None if the book is empty."""
+        while self._heap:
+            neg_price, order_id = self._heap[0]
+            if order_id not in self._live:
+                heapq.heappop(self._heap)
+                continue
+            return -neg_price, order_id
+        return None
+
+    def pop(self):
+        best = self.peek()
+        if best is not None:
+            heapq.heappop(self._heap)
+            self._live.discard(best[1])
+        return best
+
+    def apply(self, ops):
+        for op, order_id, *args in ops:
+            if op == 'push':
+                self.push(order_id, *args)
+            else:
+                self.discard(order_id)
+
+
+_books = {}  # (shard, outcome_id) -> PriceLevelBook; outcome ids repeat across shards
+_books_lock = threading.Lock()  # guards the dict only; each book has its own lock
+
+
+def _book_key(outcome_id):
+    return current_shard() or DEFAULT_DB_ALIAS, outcome_id
+
+
+def _version_key(key):
+    shard, outcome_id = key
+    if shard == DEFAULT_DB_ALIAS:
+        return f'orderbook:version:{outcome_id}'
+    return f'orderbook:version:{shard}:{outcome_id}'
+
+
+def _delta_key(key, version):
+    return f'{_version_key(key)}:{version}'
+
+
+def _load_book(book, outcome_id, version):
+    book.version = version
+    book._heap, book._live = [], set()
+    rows = LimitOrder.objects.filter(
+        outcome_id=outcome_id, status=LimitOrder.STATUS_OPEN
+    ).values_list('id', 'limit_price')
+    for order_id, limit_price in rows:
+        book.push(order_id, limit_price)
+    book.loaded = True
+
+
+def _catch_up(book, key, version):
+    """Replay the changes between book.version and `version`. Returns False if some are missing."""
+    if not 0 < version - book.version <= MAX_DELTAS:
+        return False
+    keys = [_delta_key(key, v) for v in range(book.version + 1, version + 1)]
+    deltas = cache.get_many(keys)
+    if len(deltas) != len(keys):
+        return False
+    for k in keys:
+        book.apply(deltas[k])
+    book.version = version
+    return True
+
+
+def get_book(outcome_id):
+    """
+    This process' book of committed orders for an outcome, brought up to
+    date when another worker has changed it since (its version in the cache
+    moved on). Changes not committed yet are only visible through a _BookView.
+    """
+    key = _book_key(outcome_id)
+    with _books_lock:
+        book = _books.get(key)
+        if book is None:
+            book = _books[key] = PriceLevelBook()
+    with book.lock:
+        version = cache.get(_version_key(key), 0)
+        if not book.loaded:
+            _load_book(book, outcome_id, version)
+        elif book.version != version and not _catch_up(book, key, version):
+            _load_book(book, outcome_id, version)
+    return book
+
+
+class _PendingChange:
+    """
+    on_commit callback carrying operations a transaction made on a book.
+    Registered on the book's shard, so a rollback (of the transaction or of
+    the savepoint it was made in) drops the operations with it.
+    """
+
+    def __init__(self, key, ops):
+        self.key = key
+        self.ops = ops
+
+    def __call__(self):
+        version_key = _version_key(self.key)
+        version = 1 if cache.add(version_key, 1, None) else cache.incr(version_key)
+        cache.set(_delta_key(self.key, version), self.ops, DELTA_TTL)
+        with _books_lock:
+            book = _books.get(self.key)
+        if book is None:
+            return
+        with book.lock:
+            book.apply(self.ops)
+            # Otherwise another worker published in between; the next
+            # get_book() replays both (replaying our own ops is harmless).
+            if version == book.version + 1:
+                book.version = version
+
+
+def _mark_changed(key, *ops):
+    """Record `ops` on the book `key` in the current transaction; published on commit."""
+    transaction.on_commit(_PendingChange(key, list(ops)), using=key[0])
+
+
+def _pending_ops(key):
+    """Operations on the book `key` made by this thread's open transaction, oldest first."""
+    connection = transaction.get_connection(key[0])
+    ops = []
+    for _, callback, *_ in connection.run_on_commit:
+        if isinstance(callback, _PendingChange) and callback.key == key:
+            ops.extend(callback.ops)
+    return ops
+
+
+class _BookView:
+    """
+    One transaction's view of a book: the committed orders plus its own
+    pending changes. Changes made through the view are recorded with
+    _mark_changed. Use under book.lock.
+    """
+
+    def __init__(self, outcome_id):
+        self.key = _book_key(outcome_id)
+        self.book = get_book(outcome_id)
+        self._pushed = PriceLevelBook()
+        self._discarded = set()
+        self._committed = self.book  # copied once it must hide our discards
+        for op, order_id, *args in _pending_ops(self.key):
+            if op == 'push':
+                self._push(order_id, *args)
+            else:
+                self._discard(order_id)
+
+    def _push(self, order_id, limit_price):
+        self._discarded.discard(order_id)
+        self._pushed.push(order_id, limit_price)
+
+    def _discard(self, order_id):
+        self._discarded.add(order_id)
+        self._pushed.discard(order_id)
+        if self._committed is not self.book:
+            self._committed.discard(order_id)
+
+    def peek(self):
+        best = self._committed.peek()
+        if best is not None and best[1] in self._discarded:
+            # Pending discards must not touch the shared book: filter a copy.
+            copy = PriceLevelBook()
+            copy._heap = list(self.book._heap)
+            copy._live = self.book._live - self._discarded
+            self._committed = copy
+            best = copy.peek()
+        mine = self._pushed.peek()
+        if best is None or (mine is not None and (mine[0], -mine[1]) > (best[0], -best[1])):
+            return mine
+        return best
+
+    def discard(self, order_id):
+        self._discard(order_id)
+        _mark_changed(self.key, ('discard', order_id))
+
+
+def reset_books():
+    """Drop all in-memory books (used by tests)."""
+    with _books_lock:
+        _books.clear()
+
+
+class OrderBookService:
+    @staticmethod
+    @atomic_method
+    def place_order(user, outcome: Outcome, limit_price: Decimal, amount: Decimal) -> LimitOrder:
+        """Reserve `amount` from the user's balance and rest (or immediately fill) a limit order."""
+        profile = UserProfile.objects.select_for_update().get(user=user)
+        if profile.balance < amount:
+            raise ValueError('Insufficient funds.')
+        profile.balance -= amount
+        profile.save(update_fields=['balance'])
+        events.balance_changed(user.id, -amount, 'order.place')
+
+        order = LimitOrder.objects.create(
+            user=user,
+            outcome=outcome,
+            limit_price=limit_price,
+            amount=amount,
+            remaining=amount,
+        )
+        _mark_changed(_book_key(outcome.id), ('push', order.id, order.limit_price))
+
+        OrderBookService.match_market(outcome.market)
+        order.refresh_from_db()
+        return order
+
+    @staticmethod
+    @atomic_method
+    def cancel_order(order: LimitOrder) -> Decimal:
+        """Cancel an open order and refund its unfilled amount. Returns the refund."""
+        order = LimitOrder.objects.select_for_update().get(pk=order.pk)
+        if order.status != LimitOrder.STATUS_OPEN:
+            return Decimal('0')
+
+        refund = order.remaining
+        order.status = LimitOrder.STATUS_CANCELLED
+        order.remaining = Decimal('0')
+        order.save(update_fields=['status', 'remaining'])
+
+        profile = UserProfile.objects.select_for_update().get(user_id=order.user_id)
+        profile.balance += refund
+        profile.save(update_fields=['balance'])
+        events.balance_changed(order.user_id, refund, 'order.cancel')
+
+        _mark_changed(_book_key(order.outcome_id), ('discard', order.id))
+        return refund
+
+    @staticmethod
+    @atomic_method
+    def cancel_market_orders(market) -> int:
+        """Cancel and refund every open order in a market (on resolve or delete)."""
+        orders = LimitOrder.objects.filter(outcome__market=market, status=LimitOrder.STATUS_OPEN)
+        count = 0
+        for order in orders:
+            OrderBookService.cancel_order(order)
+            count += 1
+        return count
+
+    @staticmethod
+    @atomic_method
+    def match_market(market) -> int:
+        """
+        Fill resting orders that cross the market's current prices. Each fill
+        moves the filled outcome's price up (to at most the order's limit) and
+        the other outcome's price down, so both books are re-checked until no
+        order crosses. Returns the number of fills.
+        """
+        if not trading_open(market.slug):
+            return 0
+
+        outcome_ids = sorted(market.outcomes.values_list('id', flat=True))
+        if len(outcome_ids) < 2:
+            return 0
+
+        fills = 0
+        with ExitStack() as stack:
+            # Always in outcome id order, so two passes cannot deadlock.
+            for outcome_id in outcome_ids:
+                stack.enter_context(get_book(outcome_id).lock)
+            views = {outcome_id: _BookView(outcome_id) for outcome_id in outcome_ids}
+
+            progress = True
+            while progress and fills < MAX_FILLS_PER_PASS:
+                progress = False
+                for outcome_id in outcome_ids:
+                    while fills < MAX_FILLS_PER_PASS and OrderBookService._fill_best(outcome_id, views[outcome_id]):
+                        fills += 1
+                        progress = True
+        return fills
+
+    @staticmethod
+    def _fill_best(outcome_id, book) -> bool:
+        """Fill the best order of one outcome (`book` is its _BookView) if it crosses. Returns True if a fill happened."""
+        while True:
+            best = book.peek()
+            if best is None:
+                return False
+            limit_price, order_id = best
+
+            outcome = Outcome.objects.select_for_update().select_related('market').get(pk=outcome_id)
+            if outcome.current_price > limit_price:
+                return False
+
+            order = LimitOrder.objects.select_for_update().filter(pk=order_id, status=LimitOrder.STATUS_OPEN).first()
+            if order is None or order.remaining < MIN_FILL:
+                # Stale heap entry (filled or cancelled elsewhere).
+                book.discard(order_id)
+                continue
+
+            other_outcome = Outcome.objects.select_for_update().filter(market_id=outcome.market_id).exclude(pk=outcome_id).first()
+            investment = min(order.remaining, CPMMService.investment_to_price(outcome, other_outcome, limit_price))
+            if investment < MIN_FILL:
+                return False
+
+            result = CPMMService.execute_buy(order.user, outcome, investment)
+            tasks.enqueue('trade.executed', {
+                'market_id': outcome.market_id,
+                'shard': current_shard(),
+                'outcome_id': outcome_id,
+                'user_id': order.user_id,
+                'amount': str(investment),
+                'shares': str(result['shares_bought']),
+            })
+
+            order.remaining -= investment
+            order.shares_filled += result['shares_bought']
+            if order.remaining < MIN_FILL:
+                order.status = LimitOrder.STATUS_FILLED
+                book.discard(order_id)
+                if order.remaining > 0:
+                    profile = UserProfile.objects.select_for_update().get(user_id=order.user_id)
+                    profile.balance += order.remaining
+                    profile.save(update_fields=['balance'])
+                    events.balance_changed(order.user_id, order.remaining, 'order.fill')
+                    order.remaining = Decimal('0')
+            order.save(update_fields=['remaining', 'shares_filled', 'status'])
+            return True
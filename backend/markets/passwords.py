@@ -0,0 +1,206 @@
+"""
+Password hashing off the request path, for the login and signup views.
+
+Checking or setting a password costs hundreds of milliseconds of CPU
+(PBKDF2). The views hand that work to a process pool of AUTH_HASH_WORKERS
+processes and await the result, so a burst of logins uses at most that
+many cores per server process, whatever the number of requests.
+
+Admission control: at most AUTH_HASH_QUEUE hashes may be running or queued
+per server process. Beyond that verify() and make() raise Busy at once and
+the views answer 503 with Retry-After, rather than letting waiting logins
+pile up.
+
+Those limits are per server process, so the host-wide bound comes from the
+shared cache: every hash in flight holds one of AUTH_HASH_HOST_LIMIT slot
+keys (cache.add, expiring after AUTH_HASH_SLOT_TTL seconds in case the
+holder dies), and a hash that finds no free slot is Busy too. With the
+local-memory cache each process only sees its own slots.
+
+Login goes through authenticate() with markets.backends.PoolBackend, which
+blocks its request thread (not the event loop) on the pool through verify();
+signup awaits make().
+
+Repeated known-bad credentials (credential stuffing, a client retrying a
+wrong password) are answered without hashing: failed attempts are kept in a
+bounded in-process LRU for AUTH_FAILURE_TTL seconds, keyed by a keyed digest
+of (username, password), never the password itself. An entry only counts
+while the account's stored hash is the one it was recorded against, so a
+password change or a signup with those credentials takes effect at once.
+"""
+import asyncio
+import hashlib
+import hmac
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.cache import cache
+
+
+class Busy(Exception):
+    """Too many hashes in flight in this process or on this host; retry later."""
+
+
+# Pool side. These run in the worker processes and must not touch the database.
+
+def _verify(password, encoded):
+    """(correct, new_encoded); new_encoded is set when the stored hash should be upgraded."""
+    if encoded is None:
+        # Unknown user: hash anyway so the response time does not tell.
+        make_password(password)
+        return False, None
+    upgraded = []
+    correct = check_password(password, encoded, setter=lambda raw: upgraded.append(make_password(raw)))
+    return correct, (upgraded[0] if upgraded else None)
+
+
+def _make(password):
+    return make_password(password)
+
+
+# Server side
+
+_executor = None
+_in_flight = 0
+_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        # Spawned, not forked: server processes run threads and event loops.
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.AUTH_HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _executor
+
+
+def _take_slot():
+    """Claim a free host-wide slot in the shared cache. Returns its key, or None if all are taken."""
+    for i in range(settings.AUTH_HASH_HOST_LIMIT):
+        key = f'passwords:slot:{i}'
+        if cache.add(key, 1, settings.AUTH_HASH_SLOT_TTL):
+            return key
+    return None
+
+
+def _release(slot):
+    global _in_flight
+    with _lock:
+        _in_flight -= 1
+    if slot is not None:
+        cache.delete(slot)
+
+
+def _submit(func, *args):
+    """Admit one hash and hand it to the pool. Returns its concurrent future. Raises Busy."""
+    global _in_flight
+    with _lock:
+        if _in_flight >= settings.AUTH_HASH_QUEUE:
+            raise Busy
+        _in_flight += 1
+    slot = _take_slot()
+    if slot is None:
+        _release(None)
+        raise Busy
+    try:
+        with _lock:
+            future = _pool().submit(func, *args)
+    except BrokenProcessPool:
+        _release(slot)
+        raise _broken()
+    # Released when the hash finishes, even if the request was cancelled meanwhile.
+    future.add_done_callback(lambda future: _release(slot))
+    return future
+
+
+def _broken():
+    global _executor
+    with _lock:
+        _executor = None  # a worker died; start a fresh pool on the next call
+    return Busy()
+
+
+async def _run(func, *args):
+    try:
+        return await asyncio.wrap_future(_submit(func, *args))
+    except BrokenProcessPool:
+        raise _broken()
+
+
+def _call(func, *args):
+    try:
+        return _submit(func, *args).result()
+    except BrokenProcessPool:
+        raise _broken()
+
+
+def verify(password, encoded):
+    """
+    Check `password` against `encoded` (None for an unknown user). Returns
+    (correct, new_encoded). Blocks the calling thread, not the process, so
+    call it from a request thread. Raises Busy.
+    """
+    return _call(_verify, password, encoded)
+
+
+async def make(password):
+    """Hash a new password. Raises Busy."""
+    return await _run(_make, password)
+
+
+def shutdown():
+    """Stop the pool (used by tests)."""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown()
+
+
+# Known-bad credentials
+
+_failures = OrderedDict()  # digest -> (stored hash or None, expires)
+_failures_lock = threading.Lock()
+
+
+def _digest(username, password):
+    key = hashlib.sha256(f'passwords:{settings.SECRET_KEY}'.encode()).digest()
+    return hmac.new(key, f'{username}\0{password}'.encode(), hashlib.sha256).digest()
+
+
+def known_bad(username, password, encoded):
+    """True if these credentials failed against the account's current hash (`encoded`) recently."""
+    digest = _digest(username, password)
+    with _failures_lock:
+        entry = _failures.get(digest)
+        if entry is None:
+            return False
+        recorded, expires = entry
+        if expires < time.monotonic() or recorded != encoded:
+            del _failures[digest]
+            return False
+        _failures.move_to_end(digest)
+        return True
+
+
+def remember_bad(username, password, encoded):
+    """Record credentials that failed against `encoded` (None for an unknown user)."""
+    digest = _digest(username, password)
+    with _failures_lock:
+        _failures[digest] = (encoded, time.monotonic() + settings.AUTH_FAILURE_TTL)
+        _failures.move_to_end(digest)
+        while len(_failures) > settings.AUTH_FAILURE_CACHE_SIZE:
+            _failures.popitem(last=False)
+
+
+def forget_failures():
+    """Drop the known-bad credentials (used by tests)."""
+    with _failures_lock:
+        _failures.clear()
@@ -0,0 +1,250 @@
+"""
+Opt-in request profiler.
+
+ProfilingMiddleware is listed in MIDDLEWARE but removes itself at startup
+unless settings.PROFILE_ENABLED is set. When enabled it keeps two kinds of
+profile:
+
+    sampled   a random PROFILE_SAMPLE_RATE fraction of requests runs under
+              cProfile; the profile holds the top functions by cumulative
+              time.
+    slow      any request taking at least PROFILE_SLOW_MS. Such requests are
+              not known in advance, so a watchdog thread samples the call
+              stack of every request that has been running for over half
+              the threshold (every SAMPLE_INTERVAL); requests finishing
+              earlier are never touched. The profile holds the collapsed
+              stacks with their sample counts.
+
+Both carry the request's SQL statements with their timings; recording them
+costs one timer call and a list append per query. Profiles are written as
+JSON files to PROFILE_DIR, which keeps the newest PROFILE_KEEP of them (a
+ring buffer on disk), and are browsable at /api/profiles/ (staff only).
+"""
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+from .renderers import dumps
+
+SAMPLE_INTERVAL = 0.01  # seconds between stack samples of a slow request
+STACK_DEPTH = 64
+TOP_FUNCTIONS = 50
+MAX_QUERIES = 500
+
+_ID = re.compile(r'^[0-9]+-[0-9a-f]+$')
+
+
+# Storage
+
+def _dir():
+    return settings.PROFILE_DIR
+
+
+def save(profile):
+    """Write a profile and drop the oldest beyond PROFILE_KEEP. Returns its id."""
+    os.makedirs(_dir(), exist_ok=True)
+    profile_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+    profile = {'id': profile_id, **profile}
+    path = os.path.join(_dir(), profile_id + '.json')
+    with open(path + '.tmp', 'wb') as f:
+        f.write(dumps(profile))
+    os.replace(path + '.tmp', path)
+
+    stale = _ids()[:-settings.PROFILE_KEEP]
+    for old_id in stale:
+        try:
+            os.remove(os.path.join(_dir(), old_id + '.json'))
+        except FileNotFoundError:
+            pass  # pruned by another worker
+    return profile_id
+
+
+def _ids():
+    """Stored profile ids, oldest first (ids start with the time they were written)."""
+    try:
+        names = os.listdir(_dir())
+    except FileNotFoundError:
+        return []
+    ids = [name[:-5] for name in names if name.endswith('.json') and _ID.match(name[:-5])]
+    return sorted(ids, key=lambda i: int(i.split('-')[0]))
+
+
+def load(profile_id):
+    """A stored profile, or None."""
+    if not _ID.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(_dir(), profile_id + '.json'), 'rb') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+SUMMARY_FIELDS = ('id', 'reason', 'method', 'path', 'status', 'duration_ms', 'query_count', 'query_ms', 'started_at')
+
+
+def summaries():
+    """Newest first, without stacks, functions and queries."""
+    result = []
+    for profile_id in reversed(_ids()):
+        profile = load(profile_id)
+        if profile is not None:
+            result.append({field: profile.get(field) for field in SUMMARY_FIELDS})
+    return result
+
+
+# Capture
+
+class _QueryLog:
+    """connection.execute_wrapper recording (alias, sql, duration) of each statement."""
+
+    def __init__(self):
+        self.queries = []
+
+    def wrapper(self, alias):
+        def record(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                self.queries.append((alias, sql, time.perf_counter() - start))
+        return record
+
+
+def _collapse(frame):
+    """Stack as 'outer;...;inner' of file:function:line entries."""
+    entries = []
+    while frame is not None and len(entries) < STACK_DEPTH:
+        code = frame.f_code
+        entries.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+        frame = frame.f_back
+    return ';'.join(reversed(entries))
+
+
+class _Watchdog:
+    """Samples the stacks of requests running longer than `after` seconds."""
+
+    def __init__(self, after):
+        self.after = after
+        self._running = {}  # thread id -> (start, Counter of stacks)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def begin(self, start):
+        samples = Counter()
+        with self._lock:
+            self._running[threading.get_ident()] = (start, samples)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiling-watchdog', daemon=True)
+                self._thread.start()
+        return samples
+
+    def end(self):
+        with self._lock:
+            self._running.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            now = time.perf_counter()
+            # Sampling under the lock: once end() returns, its Counter is no longer written.
+            with self._lock:
+                late = [(ident, samples) for ident, (start, samples) in self._running.items()
+                        if now - start >= self.after]
+                if not late:
+                    continue
+                frames = sys._current_frames()
+                for ident, samples in late:
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_collapse(frame)] += 1
+                del frames
+
+
+def _top_functions(profiler):
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            'function': f'{os.path.basename(filename)}:{name}:{line}',
+            'calls': calls,
+            'tottime_ms': round(tottime * 1000, 3),
+            'cumtime_ms': round(cumtime * 1000, 3),
+        })
+    rows.sort(key=lambda r: r['cumtime_ms'], reverse=True)
+    return rows[:TOP_FUNCTIONS]
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILE_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = settings.PROFILE_SAMPLE_RATE
+        self.slow = settings.PROFILE_SLOW_MS / 1000
+        self.watchdog = _Watchdog(after=self.slow / 2) if self.slow > 0 else None
+
+    def __call__(self, request):
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled and self.watchdog is None:
+            return self.get_response(request)
+
+        log = _QueryLog()
+        started_at = timezone.now()
+        start = time.perf_counter()
+        profiler = cProfile.Profile() if sampled else None
+        stacks = None
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(log.wrapper(connection.alias)))
+            if profiler is not None:
+                profiler.enable()
+                stack.callback(profiler.disable)
+            else:
+                stacks = self.watchdog.begin(start)
+                stack.callback(self.watchdog.end)
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        if not sampled and (self.slow <= 0 or duration < self.slow):
+            return response
+        self._store(request, response, started_at, duration, log, profiler, stacks)
+        return response
+
+    def _store(self, request, response, started_at, duration, log, profiler, stacks):
+        user = getattr(request, '_cached_user', None)  # never load the user just for this
+        profile = {
+            'reason': 'sampled' if profiler is not None else 'slow',
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'user_id': getattr(user, 'pk', None),
+            'started_at': started_at.isoformat(),
+            'duration_ms': round(duration * 1000, 3),
+            'query_count': len(log.queries),
+            'query_ms': round(sum(d for _, _, d in log.queries) * 1000, 3),
+            'queries': [
+                {'db': alias, 'sql': sql, 'ms': round(d * 1000, 3)}
+                for alias, sql, d in log.queries[:MAX_QUERIES]
+            ],
+        }
+        if profiler is not None:
+            profile['functions'] = _top_functions(profiler)
+        else:
+            profile['sample_interval_ms'] = SAMPLE_INTERVAL * 1000
+            profile['stacks'] = [{'stack': s, 'samples': n} for s, n in stacks.most_common()]
+        save(profile)
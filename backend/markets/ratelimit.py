@@ -0,0 +1,212 @@
+"""
+Token-bucket rate limiting for write endpoints (trading, orders).
+
+Buckets live in the shared Django cache so limits hold across workers.
+Each process keeps a small local lease of tokens per key and a memo of
+keys that are currently throttled, so most requests are admitted or
+rejected without a cache round trip. Taking a lease from the shared bucket
+is a read-modify-write, done while holding a lock key claimed with
+cache.add(); a worker that cannot get the lock treats the bucket as empty
+for a moment rather than admitting without it.
+"""
+import math
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .renderers import FastJsonResponse
+
+CACHE_PREFIX = 'ratelimit'
+LOCK_TIMEOUT = 1    # seconds; a worker dying while holding a bucket blocks it at most this long
+LOCK_TRIES = 5
+LOCK_BACKOFF = 0.002  # seconds, times the attempt number
+
+# Rejections seen by this process, keyed by scope ('user', 'market', ...).
+# The cluster-wide totals are kept in the cache, see rejection_counts().
+REJECTED = Counter()
+
+
+class _LocalState:
+    __slots__ = ('leased', 'lease_expires', 'deny_until')
+
+    def __init__(self):
+        self.leased = 0
+        self.lease_expires = 0.0
+        self.deny_until = 0.0
+
+
+class TokenBucket:
+    """
+    A token bucket shared through the cache.
+
+    `rate` tokens are added per second up to `burst`. A process takes up to
+    `lease` tokens at a time from the shared bucket and spends them locally
+    for at most `lease_ttl` seconds.
+    """
+
+    def __init__(self, scope, rate, burst, lease=1, lease_ttl=1.0):
+        self.scope = scope
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.lease = max(1, int(lease))
+        self.lease_ttl = lease_ttl
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def _key(self, ident):
+        return f'{CACHE_PREFIX}:{self.scope}:{ident}'
+
+    def _take_shared(self, ident, now):
+        """Take up to `lease` tokens from the shared bucket. Returns (granted, retry_after)."""
+        key = self._key(ident)
+        lock = key + ':lock'
+        for attempt in range(1, LOCK_TRIES + 1):
+            if cache.add(lock, 1, LOCK_TIMEOUT):
+                break
+            time.sleep(LOCK_BACKOFF * attempt)
+        else:
+            return 0, LOCK_BACKOFF * LOCK_TRIES
+
+        try:
+            tokens, updated = cache.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+
+            if tokens < 1:
+                return 0, (1 - tokens) / self.rate
+
+            granted = min(self.lease, int(tokens))
+            ttl = math.ceil(self.burst / self.rate) + 1
+            cache.set(key, (tokens - granted, max(now, updated)), ttl)
+            return granted, 0.0
+        finally:
+            cache.delete(lock)
+
+    def consume(self, ident):
+        """Consume one token for `ident`. Returns 0 if admitted, else seconds to wait."""
+        # Wall-clock time: bucket timestamps are compared across processes.
+        now = time.time()
+        with self._lock:
+            state = self._local.get(ident)
+            if state is None:
+                state = self._local[ident] = _LocalState()
+
+            if state.deny_until > now:
+                return state.deny_until - now
+
+            if state.leased > 0 and state.lease_expires > now:
+                state.leased -= 1
+                return 0.0
+
+            granted, retry_after = self._take_shared(ident, now)
+            if not granted:
+                state.deny_until = now + retry_after
+                return retry_after
+
+            state.leased = granted - 1
+            state.lease_expires = now + self.lease_ttl
+            return 0.0
+
+    def reset(self):
+        with self._lock:
+            self._local.clear()
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(scope):
+    """Return the bucket for a scope configured in settings.RATE_LIMITS, or None."""
+    config = settings.RATE_LIMITS.get(scope)
+    if not config:
+        return None
+    with _buckets_lock:
+        bucket = _buckets.get(scope)
+        if bucket is None or (bucket.rate, bucket.burst) != (float(config['rate']), float(config['burst'])):
+            bucket = _buckets[scope] = TokenBucket(
+                scope,
+                rate=config['rate'],
+                burst=config['burst'],
+                lease=config.get('lease', 1),
+                lease_ttl=config.get('lease_ttl', 1.0),
+            )
+        return bucket
+
+
+def reset_buckets():
+    """Drop all in-process bucket state (used by tests)."""
+    with _buckets_lock:
+        _buckets.clear()
+    REJECTED.clear()
+
+
+def record_rejection(scope):
+    REJECTED[scope] += 1
+    key = f'{CACHE_PREFIX}:rejected:{scope}'
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def rejection_counts():
+    """Cluster-wide count of rejected requests per scope."""
+    scopes = list(settings.RATE_LIMITS)
+    values = cache.get_many([f'{CACHE_PREFIX}:rejected:{s}' for s in scopes])
+    return {s: values.get(f'{CACHE_PREFIX}:rejected:{s}', 0) for s in scopes}
+
+
+def client_ident(request):
+    if request.user.is_authenticated:
+        return f'u{request.user.pk}'
+    return 'ip' + request.META.get('REMOTE_ADDR', '')
+
+
+def check_rate_limits(request, endpoint, market_slug=None):
+    """
+    Check the user, market and endpoint buckets in that order.
+    Returns (scope, retry_after) for the first bucket that rejects, else None.
+    """
+    checks = [('user', client_ident(request)), ('endpoint', endpoint)]
+    if market_slug:
+        checks.insert(1, ('market', market_slug))
+
+    for scope, ident in checks:
+        bucket = get_bucket(scope)
+        if bucket is None:
+            continue
+        retry_after = bucket.consume(ident)
+        if retry_after > 0:
+            record_rejection(scope)
+            return scope, retry_after
+    return None
+
+
+def rate_limit(endpoint, methods=('POST',)):
+    """
+    View decorator applying the configured token buckets to `endpoint`.
+    Only authenticated requests with one of `methods` are charged; the view
+    answers (or rejects) the others without spending tokens.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if settings.RATE_LIMIT_ENABLED and request.method in methods and request.user.is_authenticated:
+                rejected = check_rate_limits(request, endpoint, kwargs.get('slug'))
+                if rejected:
+                    scope, retry_after = rejected
+                    seconds = max(1, math.ceil(retry_after))
+                    response = FastJsonResponse(
+                        {'error': 'Rate limit exceeded.', 'scope': scope, 'retry_after': seconds},
+                        status=429,
+                    )
+                    response['Retry-After'] = str(seconds)
+                    return response
+            return view(request, *args, **kwargs)
+        return wrapped
+    return decorator
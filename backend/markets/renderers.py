@@ -0,0 +1,193 @@
+"""
+Fast JSON responses.
+
+FastJsonResponse is a drop-in replacement for JsonResponse. It encodes with
+orjson when installed (falling back to the stdlib json module) and renders
+every Decimal the same way across endpoints: as a JSON number holding its
+exact digits (str(value), never rounded through a float) by default, or as
+a string when settings.JSON_DECIMAL_FORMAT == 'string'. MessagePack has no
+decimal type, so there 'number' means a float.
+
+Already-encoded fragments (e.g. a cached market payload) can be embedded by
+wrapping the bytes in RawJSON; they are spliced into the output verbatim
+instead of being decoded and encoded again.
+
+Large list endpoints respond with NegotiatedResponse, which also offers a
+compact columnar layout: every array of objects becomes
+{"fields": [...], "rows": [[...], ...]}, so keys are sent once per array
+instead of once per row. Clients opt in with the Accept header (or
+?format=):
+
+    application/json                  plain JSON (default)
+    application/vnd.columnar+json     columnar JSON
+    application/msgpack               columnar MessagePack (needs msgpack)
+"""
+import json
+import re
+import secrets
+from decimal import Decimal
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional format
+    msgpack = None
+
+JSON = 'application/json'
+COLUMNAR = 'application/vnd.columnar+json'
+MSGPACK = 'application/msgpack'
+
+FORMATS = {'json': JSON, 'columnar': COLUMNAR, 'msgpack': MSGPACK}
+_ACCEPTED = {JSON: JSON, COLUMNAR: COLUMNAR, MSGPACK: MSGPACK, 'application/x-msgpack': MSGPACK}
+
+
+class RawJSON(bytes):
+    """Bytes that already hold valid JSON and are emitted as-is."""
+
+
+def _decimals_as_strings():
+    return getattr(settings, 'JSON_DECIMAL_FORMAT', 'number') == 'string'
+
+
+class _Encoder:
+    """
+    default= hook shared by both backends. RawJSON fragments, and Decimals
+    rendered as numbers, are swapped for placeholder strings and spliced
+    back in afterwards: neither backend can emit a number from its digits.
+    """
+
+    def __init__(self):
+        self.fragments = []
+        self.token = None
+
+    def _placeholder(self, fragment):
+        if self.token is None:
+            self.token = secrets.token_hex(8)
+        self.fragments.append(fragment)
+        return f'__raw_{self.token}_{len(self.fragments) - 1}__'
+
+    def __call__(self, value):
+        if isinstance(value, Decimal):
+            if _decimals_as_strings():
+                return str(value)
+            if not value.is_finite():
+                return None  # no JSON spelling; as floats were
+            return self._placeholder(str(value).encode())
+        if isinstance(value, RawJSON):
+            return self._placeholder(value)
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+    def splice(self, content):
+        fragments = self.fragments
+        return re.sub(
+            rb'"__raw_' + self.token.encode() + rb'_(\d+)__"',
+            lambda match: fragments[int(match.group(1))], content,
+        )
+
+
+def dumps(data) -> bytes:
+    """Encode `data` to JSON bytes."""
+    encoder = _Encoder()
+    if orjson is not None:
+        content = orjson.dumps(data, default=encoder, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    else:
+        content = json.dumps(data, default=encoder, separators=(',', ':')).encode()
+    return encoder.splice(content) if encoder.fragments else content
+
+
+class FastJsonResponse(HttpResponse):
+    """
+    Same signature as JsonResponse (minus `encoder` and `json_dumps_params`):
+    `data` must be a dict unless safe=False.
+    """
+
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError('In order to allow non-dict objects to be serialized set the safe parameter to False.')
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
+
+
+def columnar(data):
+    """
+    Rewrite every non-empty array of objects in `data` as {"fields", "rows"}.
+    Fields are the union of the objects' keys in first-seen order; a row
+    missing a key holds null there. RawJSON fragments are left as they are.
+    """
+    if isinstance(data, dict):
+        return {key: columnar(value) for key, value in data.items()}
+    if isinstance(data, list) and data and all(isinstance(item, dict) for item in data):
+        fields = list(data[0])
+        if any(len(item) != len(fields) or item.keys() != data[0].keys() for item in data):
+            seen = dict.fromkeys(fields)
+            for item in data:
+                seen.update(dict.fromkeys(item))
+            fields = list(seen)
+        return {
+            'fields': fields,
+            'rows': [[columnar(item.get(field)) for field in fields] for item in data],
+        }
+    if isinstance(data, list):
+        return [columnar(item) for item in data]
+    return data
+
+
+def _msgpack_default(value):
+    if isinstance(value, Decimal):
+        return str(value) if _decimals_as_strings() else float(value)
+    if isinstance(value, RawJSON):
+        return json.loads(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+
+def negotiate(request):
+    """Media type to answer `request` with: ?format= first, then the Accept header by quality."""
+    fmt = request.GET.get('format')
+    if fmt in FORMATS:
+        media_type = FORMATS[fmt]
+        return JSON if media_type == MSGPACK and msgpack is None else media_type
+
+    candidates = []
+    for position, part in enumerate(request.headers.get('Accept', '').split(',')):
+        media_type, *params = [p.strip() for p in part.split(';')]
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        media_type = _ACCEPTED.get(media_type.lower())
+        if media_type and quality > 0 and not (media_type == MSGPACK and msgpack is None):
+            candidates.append((-quality, position, media_type))
+    return min(candidates)[2] if candidates else JSON
+
+
+class NegotiatedResponse(HttpResponse):
+    """FastJsonResponse that can also answer in the columnar JSON or MessagePack layouts."""
+
+    def __init__(self, request, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError('In order to allow non-dict objects to be serialized set the safe parameter to False.')
+        media_type = negotiate(request)
+        if media_type == MSGPACK:
+            content = msgpack.packb(columnar(data), default=_msgpack_default, use_bin_type=True)
+        elif media_type == COLUMNAR:
+            content = dumps(columnar(data))
+        else:
+            content = dumps(data)
+        kwargs.setdefault('content_type', media_type)
+        super().__init__(content=content, **kwargs)
+        patch_vary_headers(self, ['Accept'])
@@ -0,0 +1,161 @@
+"""
+Scheduled market transitions: draft -> open at `opens_at`, open -> closed
+at `closes_at`.
+
+The worker (`run_scheduler` command) asks the (status, time) indexes for the
+nearest deadline and sleeps until then instead of scanning all markets.
+Editing a schedule bumps a wake-up key in the cache so the worker notices
+earlier deadlines without waiting for its current sleep to end.
+
+Trading checks go through trading_open(), which reads a short-lived cached
+copy of (status, closes_at) per slug. It compares closes_at with the clock
+itself, so trading stops exactly at the deadline even if the worker lags.
+"""
+import time
+from collections import Counter
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import events, facets, sharding
+from .models import Event, Market
+
+STATUS_CACHE_TTL = 60
+WAKEUP_KEY = 'scheduler:wakeup'
+BATCH_SIZE = 1000
+
+
+def _state_key(slug):
+    return f'market:state:{slug}'
+
+
+def _market_state(slug):
+    """(status, closes_at timestamp or None) for a slug, or None if it does not exist."""
+    key = _state_key(slug)
+    state = cache.get(key)
+    if state is None:
+        row = Market.objects.filter(slug=slug).values_list('status', 'closes_at').first()
+        if row is None:
+            return None
+        status, closes_at = row
+        state = (status, closes_at.timestamp() if closes_at else None)
+        cache.set(key, state, STATUS_CACHE_TTL)
+    return state
+
+
+def trading_open(slug):
+    """True if the market accepts trades right now (open and not past closes_at)."""
+    state = _market_state(slug)
+    if state is None:
+        return False
+    status, closes_at = state
+    return status == Market.STATUS_OPEN and (closes_at is None or time.time() < closes_at)
+
+
+def invalidate_status(*slugs):
+    """Forget cached states after a status or schedule change."""
+    cache.delete_many([_state_key(slug) for slug in slugs if slug])
+
+
+def notify_schedule_changed():
+    """Wake the scheduler worker so it re-reads the nearest deadline."""
+    if not cache.add(WAKEUP_KEY, 1, None):
+        try:
+            cache.incr(WAKEUP_KEY)
+        except ValueError:
+            cache.set(WAKEUP_KEY, 1, None)
+
+
+def _transition(from_status, new_status, time_field, now):
+    """Move up to BATCH_SIZE markets due at `now` from one status to another. Returns their slugs."""
+    due = list(
+        Market.objects.filter(status=from_status, **{f'{time_field}__lte': now})
+        .order_by(time_field).values_list('id', 'slug')[:BATCH_SIZE]
+    )
+    if not due:
+        return []
+    with sharding.atomic():
+        # Re-check the status under a lock so a concurrent manual edit is not overwritten.
+        ids = set(
+            Market.objects.select_for_update()
+            .filter(id__in=[market_id for market_id, _ in due], status=from_status).values_list('id', flat=True)
+        )
+        due = [(market_id, slug) for market_id, slug in due if market_id in ids]
+        Market.objects.filter(id__in=ids).update(status=new_status)
+        deltas = Counter({(facets.ALL, from_status): -len(ids), (facets.ALL, new_status): len(ids)})
+        for tag in Market.tags.through.objects.filter(market_id__in=ids).values_list('tag__name', flat=True):
+            deltas[(tag, from_status)] -= 1
+            deltas[(tag, new_status)] += 1
+        facets.adjust(deltas)
+        events.record_many([
+            Event(kind='market.edit', market_id=market_id, data={'slug': slug, 'status': new_status})
+            for market_id, slug in due
+        ])
+    slugs = [slug for _, slug in due]
+    invalidate_status(*slugs)
+    return slugs
+
+
+def run_due(now=None):
+    """Apply every transition due at `now` on every shard. Returns (opened slugs, closed slugs)."""
+    now = now or timezone.now()
+    opened, closed = [], []
+    for shard_opened, shard_closed in sharding.scatter_gather(lambda: _run_due_on_shard(now)):
+        opened += shard_opened
+        closed += shard_closed
+    return opened, closed
+
+
+def _run_due_on_shard(now):
+    results = []
+    for from_status, new_status, time_field in [
+        (Market.STATUS_DRAFT, Market.STATUS_OPEN, 'opens_at'),
+        (Market.STATUS_OPEN, Market.STATUS_CLOSED, 'closes_at'),
+    ]:
+        slugs = []
+        while True:
+            batch = _transition(from_status, new_status, time_field, now)
+            slugs += batch
+            if len(batch) < BATCH_SIZE:
+                break
+        results.append(slugs)
+    return results
+
+
+def next_deadline():
+    """Earliest pending opens_at/closes_at on any shard."""
+    deadlines = [d for d in sharding.scatter_gather(_next_deadline_on_shard) if d is not None]
+    return min(deadlines) if deadlines else None
+
+
+def _next_deadline_on_shard():
+    """Earliest pending opens_at/closes_at, using one index range scan each."""
+    next_open = (
+        Market.objects.filter(status=Market.STATUS_DRAFT, opens_at__isnull=False)
+        .order_by('opens_at').values_list('opens_at', flat=True).first()
+    )
+    next_close = (
+        Market.objects.filter(status=Market.STATUS_OPEN, closes_at__isnull=False)
+        .order_by('closes_at').values_list('closes_at', flat=True).first()
+    )
+    deadlines = [d for d in (next_open, next_close) if d is not None]
+    return min(deadlines) if deadlines else None
+
+
+def sleep_until(deadline, max_sleep=60.0, poll=1.0):
+    """
+    Sleep until `deadline` (or at most `max_sleep` seconds), returning early
+    if notify_schedule_changed() was called meanwhile.
+    """
+    start = time.monotonic()
+    wait = max_sleep
+    if deadline is not None:
+        wait = min(max_sleep, max(0.0, (deadline - timezone.now()).total_seconds()))
+    version = cache.get(WAKEUP_KEY)
+    while True:
+        remaining = wait - (time.monotonic() - start)
+        if remaining <= 0:
+            return
+        time.sleep(min(poll, remaining))
+        if cache.get(WAKEUP_KEY) != version:
+            return
@@ -1,8 +1,9 @@
 from decimal import Decimal
 import math
-from django.db import transaction
 from django.contrib.auth.models import User
-from .models import Market, Outcome, Position
+from .models import Market, Outcome, Position, Trade
+from . import alerts, events
+from .sharding import atomic_method
 
 class CPMMService:
     @staticmethod
@@ -31,7 +32,8 @@ class CPMMService:
         if no.pool_balance == 0:
             no.pool_balance = liquidity
             no.save()
-            
+
+        events.record('market.init', market_id=market.id, pools=events.pools(yes, no))
         return yes, no
 
     @staticmethod
@@ -56,8 +58,33 @@ class CPMMService:
         return Decimal(other_balance) / Decimal(this_balance + other_balance)
 
     @staticmethod
-    @transaction.atomic
-    def buy_tokens(user: User, outcome: Outcome, investment_amount: Decimal):
+    def investment_to_price(outcome: Outcome, other_outcome: Outcome, target_price: Decimal) -> Decimal:
+        """
+        Investment in `outcome` that moves its price to `target_price`.
+        After investing x: R_no' = R_no + x, R_yes' = k / R_no', and
+        Price(Yes) = R_no'^2 / (k + R_no'^2), so R_no' = sqrt(p * k / (1 - p)).
+        """
+        if target_price >= 1:
+            return Decimal('Infinity')
+        k = outcome.pool_balance * other_outcome.pool_balance
+        target_R_no = (target_price * k / (1 - target_price)).sqrt()
+        return max(Decimal('0'), target_R_no - other_outcome.pool_balance)
+
+    @staticmethod
+    @atomic_method
+    def buy_tokens(user: User, outcome: Outcome, investment_amount: Decimal, match_orders: bool = True):
+        """
+        Executes a market buy against the pool, then fills any resting limit
+        orders that now cross the new prices in the same transaction.
+        """
+        result = CPMMService.execute_buy(user, outcome, investment_amount)
+        if match_orders:
+            from .orderbook import OrderBookService
+            OrderBookService.match_market(outcome.market)
+        return result
+
+    @staticmethod
+    def execute_buy(user: User, outcome: Outcome, investment_amount: Decimal):
         """
         Executes a buy order using CPMM logic (Gnosis style).
         1. User invests 'investment_amount' (USD).
@@ -73,6 +100,7 @@ class CPMMService:
         other_outcome = next(o for o in all_outcomes if o != outcome)
         
         # 1. State before trade
+        old_prices = [(outcome, outcome.current_price), (other_outcome, other_outcome.current_price)]
         R_yes = outcome.pool_balance
         R_no = other_outcome.pool_balance
         k = R_yes * R_no
@@ -96,17 +124,33 @@ class CPMMService:
         outcome.pool_balance = new_R_yes
         other_outcome.pool_balance = new_R_no
         
-        # Update prices
-        outcome.current_price = CPMMService.get_price(outcome)
-        other_outcome.current_price = CPMMService.get_price(other_outcome)
+        # Update prices from the new (unsaved) pools; get_price() would read
+        # the other outcome's pre-trade balance from the database.
+        total_pool = new_R_yes + new_R_no
+        outcome.current_price = new_R_no / total_pool
+        other_outcome.current_price = new_R_yes / total_pool
         
         outcome.save()
         other_outcome.save()
+        alerts.price_moved(old_prices)
         
         # 6. Create/Update User Position
         position, _ = Position.objects.get_or_create(user=user, outcome=outcome)
         position.shares = Decimal(str(position.shares)) + total_shares
         position.save()
+
+        Trade.objects.create(
+            user=user,
+            outcome=outcome,
+            kind=Trade.KIND_BUY,
+            amount=investment_amount,
+            shares=total_shares,
+            price=outcome.current_price,
+        )
+        events.record(
+            'trade', market_id=market.id, user_id=user.id, outcome=outcome.name,
+            amount=investment_amount, shares=total_shares, pools=events.pools(outcome, other_outcome),
+        )
         
         return {
             'shares_bought': total_shares,
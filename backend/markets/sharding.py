@@ -0,0 +1,415 @@
+"""
+Horizontal sharding of markets.
+
+Each market lives, together with its outcomes, positions, trades, limit
+orders, price alerts, comments and tag links, on one database listed in
+settings.MARKET_SHARDS. The shard is picked from a stable hash of the market
+id when the market is created and recorded in the MarketShard directory on the default database,
+which also hands out the ids so they stay unique across shards. Users,
+balances and tags stay on the default database; auth.User and Tag rows are
+replicated to the other shards so foreign keys hold there, by signal
+handlers as they are saved and deleted, and in bulk by sync_replicas() (the
+sync_replicas command) for rows that predate a shard.
+
+The directory's ids start above every market id that existed before it,
+so markets created while sharding was off (and archived ones) keep their
+ids: the first allocate() in each process moves the id sequence past them.
+
+Code that works on one market runs inside use_shard(alias) (views do this
+with the @market_shard decorator); ShardRouter then sends every query on the
+sharded models to that database. Queries spanning markets go through
+scatter_gather(), which runs a function once per shard on a long-lived
+thread pool; each pool thread keeps its own connections between calls.
+
+With a single shard (the default) none of this adds queries: there is no
+directory lookup and everything runs on the default database.
+"""
+import contextvars
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from functools import wraps
+
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import Max
+
+SHARDED_MODELS = {'market', 'outcome', 'position', 'trade', 'limitorder', 'comment', 'pricealert', 'market_tags'}
+REPLICATED_MODELS = {'auth.User', 'markets.Tag'}
+DIRECTORY_CACHE_SIZE = 100_000
+
+_current = contextvars.ContextVar('market_shard', default=None)
+
+_directory_cache = OrderedDict()
+_directory_lock = threading.Lock()
+_ids_seeded = False
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_thread = threading.local()
+
+
+def shards():
+    return list(getattr(settings, 'MARKET_SHARDS', None) or [DEFAULT_DB_ALIAS])
+
+
+def enabled():
+    return len(shards()) > 1
+
+
+def current_shard():
+    return _current.get()
+
+
+def _is_sharded(model):
+    return model._meta.app_label == 'markets' and model._meta.model_name in SHARDED_MODELS
+
+
+@contextmanager
+def use_shard(alias):
+    """Route queries on sharded models to `alias` inside the block."""
+    token = _current.set(alias)
+    try:
+        yield alias
+    finally:
+        _current.reset(token)
+
+
+def atomic():
+    """
+    Transaction on the default database (balances, tasks) and, if different,
+    on the active shard. The shard commits first; the two are not atomic
+    against a crash in between.
+    """
+    stack = ExitStack()
+    stack.enter_context(transaction.atomic(using=DEFAULT_DB_ALIAS))
+    alias = current_shard()
+    if alias and alias != DEFAULT_DB_ALIAS:
+        stack.enter_context(transaction.atomic(using=alias))
+    return stack
+
+
+def atomic_method(func):
+    """Decorator form of atomic(), evaluated per call so it sees the active shard."""
+    @wraps(func)
+    def inner(*args, **kwargs):
+        with atomic():
+            return func(*args, **kwargs)
+    return inner
+
+
+class ShardRouter:
+    """Sends sharded models to the active shard, or to the shard of the instance they relate to."""
+
+    def _db(self, model, **hints):
+        if not _is_sharded(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and _is_sharded(instance.__class__) and instance._state.db:
+            return instance._state.db
+        return current_shard()
+
+    db_for_read = _db
+    db_for_write = _db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Users and tags are replicated to every shard.
+        if obj1._meta.label in REPLICATED_MODELS and _is_sharded(obj2.__class__):
+            return True
+        if obj2._meta.label in REPLICATED_MODELS and _is_sharded(obj1.__class__):
+            return True
+        return None
+
+
+def shard_for_id(market_id):
+    """Stable hash placement: the same id maps to the same shard in every process."""
+    aliases = shards()
+    return aliases[zlib.crc32(str(market_id).encode()) % len(aliases)]
+
+
+# Directory
+
+def _cache_get(slug):
+    with _directory_lock:
+        alias = _directory_cache.get(slug)
+        if alias is not None:
+            _directory_cache.move_to_end(slug)
+        return alias
+
+
+def _cache_set(slug, alias):
+    with _directory_lock:
+        _directory_cache[slug] = alias
+        _directory_cache.move_to_end(slug)
+        while len(_directory_cache) > DIRECTORY_CACHE_SIZE:
+            _directory_cache.popitem(last=False)
+
+
+def forget(*slugs):
+    """Drop slugs from the directory and this process's cache (market deleted)."""
+    from .models import MarketShard
+
+    with _directory_lock:
+        for slug in slugs:
+            _directory_cache.pop(slug, None)
+    if enabled():
+        MarketShard.objects.using(DEFAULT_DB_ALIAS).filter(slug__in=slugs).delete()
+
+
+def reset_directory_cache():
+    with _directory_lock:
+        _directory_cache.clear()
+
+
+def locate(slug):
+    """Alias of the shard holding `slug`, or None if no shard has it."""
+    from .models import Market, MarketShard
+
+    if not enabled():
+        return DEFAULT_DB_ALIAS if Market.objects.using(DEFAULT_DB_ALIAS).filter(slug=slug).exists() else None
+    alias = _cache_get(slug)
+    if alias is None:
+        alias = MarketShard.objects.using(DEFAULT_DB_ALIAS).filter(slug=slug).values_list('shard', flat=True).first()
+        if alias is None:
+            # Markets created before sharding was enabled are not in the directory.
+            alias = next(
+                (a for a in shards() if Market.objects.using(a).filter(slug=slug).exists()), None
+            )
+        if alias is not None:
+            _cache_set(slug, alias)
+    return alias
+
+
+def existing_slugs(slugs):
+    """The subset of `slugs` taken by a market on any shard."""
+    from .models import Market, MarketShard
+
+    slugs = list(slugs)
+    existing = set()
+    if enabled():
+        existing |= set(
+            MarketShard.objects.using(DEFAULT_DB_ALIAS).filter(slug__in=slugs).values_list('slug', flat=True)
+        )
+    for alias in shards():
+        existing |= set(Market.objects.using(alias).filter(slug__in=slugs).values_list('slug', flat=True))
+    return existing
+
+
+def db_for_slug(slug):
+    """Shard to run a request for `slug` on; the default database if the slug is unknown."""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    return locate(slug) or DEFAULT_DB_ALIAS
+
+
+def _seed_ids():
+    """
+    Move the directory's id sequence past the highest market id on any shard
+    or in the archive, by inserting and deleting a row with that id.
+    """
+    from .archive import _archive_db
+    from .models import ArchivedMarket, Market, MarketShard
+
+    global _ids_seeded
+    if _ids_seeded:
+        return
+    highest = max(
+        [Market.objects.using(alias).aggregate(m=Max('id'))['m'] or 0 for alias in shards()]
+        + [ArchivedMarket.objects.using(_archive_db()).aggregate(m=Max('market_id'))['m'] or 0]
+    )
+    directory = MarketShard.objects.using(DEFAULT_DB_ALIAS)
+    if highest and not directory.filter(id__gte=highest).exists():
+        connection = connections[DEFAULT_DB_ALIAS]
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                directory.create(id=highest, slug=f'-seed-{highest}', shard='')
+                # Backends with sequences (PostgreSQL) do not move them on explicit ids.
+                with connection.cursor() as cursor:
+                    for sql in connection.ops.sequence_reset_sql(no_style(), [MarketShard]):
+                        cursor.execute(sql)
+                directory.filter(id=highest).delete()
+        except IntegrityError:
+            pass  # another process seeded it
+    _ids_seeded = True
+
+
+def allocate(slugs):
+    """
+    Reserve directory entries for new markets. Returns [(market_id, alias)]
+    in the order of `slugs`; create each market with that id on that shard.
+    """
+    from .models import MarketShard
+
+    _seed_ids()
+    entries = MarketShard.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+        [MarketShard(slug=slug, shard='') for slug in slugs]
+    )
+    if any(entry.pk is None for entry in entries):
+        # Backends that do not return ids from bulk inserts.
+        ids = dict(
+            MarketShard.objects.using(DEFAULT_DB_ALIAS).filter(slug__in=slugs).values_list('slug', 'id')
+        )
+        for entry in entries:
+            entry.pk = ids[entry.slug]
+    for entry in entries:
+        entry.shard = shard_for_id(entry.pk)
+    MarketShard.objects.using(DEFAULT_DB_ALIAS).bulk_update(entries, ['shard'])
+    for entry in entries:
+        _cache_set(entry.slug, entry.shard)
+    return [(entry.pk, entry.shard) for entry in entries]
+
+
+def rename(old_slug, new_slug):
+    """Point the directory at a market's new slug."""
+    from .models import MarketShard
+
+    if not enabled() or old_slug == new_slug:
+        return
+    MarketShard.objects.using(DEFAULT_DB_ALIAS).filter(slug=old_slug).update(slug=new_slug)
+    with _directory_lock:
+        alias = _directory_cache.pop(old_slug, None)
+    if alias is not None:
+        _cache_set(new_slug, alias)
+
+
+def market_shard(view):
+    """View decorator: run the view on the shard of its `slug` argument."""
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        with use_shard(db_for_slug(kwargs['slug'])):
+            return view(request, *args, **kwargs)
+    return wrapped
+
+
+# Scatter-gather
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'MARKET_SHARD_WORKERS', 8),
+                thread_name_prefix='shard', initializer=_mark_pool_thread,
+            )
+        return _pool
+
+
+def _mark_pool_thread():
+    _pool_thread.active = True
+
+
+def _run_on(alias, func, pooled):
+    if pooled:
+        # Reuse this thread's connection unless it broke or hit CONN_MAX_AGE.
+        connections[alias].close_if_unusable_or_obsolete()
+    with use_shard(alias):
+        return func()
+
+
+def scatter_gather(func, aliases=None):
+    """
+    Call `func` once per shard with that shard active; returns the results in
+    shard order. Runs in parallel on the shared pool unless there is a single
+    shard, a transaction is open on this thread (other threads could not see
+    its uncommitted rows) or this already is a pool thread.
+    """
+    aliases = aliases or shards()
+    if (
+        len(aliases) <= 1 or getattr(settings, 'MARKET_SHARD_WORKERS', 8) <= 1
+        or getattr(_pool_thread, 'active', False)
+        or any(connections[a].in_atomic_block for a in aliases)
+    ):
+        return [_run_on(alias, func, pooled=False) for alias in aliases]
+    futures = [_executor().submit(_run_on, alias, func, True) for alias in aliases]
+    return [future.result() for future in futures]
+
+
+def find(model, aliases=None, **filters):
+    """First object matching `filters` on any of `aliases` (default: every shard), or None."""
+    for alias in aliases or shards():
+        obj = model.objects.using(alias).filter(**filters).first()
+        if obj is not None:
+            return obj
+    return None
+
+
+# Replication
+
+def replicate_user(sender, instance, created, raw=False, using=None, update_fields=None, **kwargs):
+    """post_save handler copying auth.User identity rows to the other shards."""
+    if raw or not enabled() or using != DEFAULT_DB_ALIAS:
+        return
+    if update_fields is not None and 'username' not in update_fields and not created:
+        return
+    for alias in shards():
+        if alias == DEFAULT_DB_ALIAS:
+            continue
+        sender.objects.using(alias).update_or_create(
+            pk=instance.pk, defaults={'username': instance.username, 'password': '!'},
+        )
+
+
+def replicate_tag(sender, instance, created, raw=False, using=None, **kwargs):
+    """post_save handler copying Tag rows to the other shards."""
+    if raw or not enabled() or using != DEFAULT_DB_ALIAS:
+        return
+    for alias in shards():
+        if alias != DEFAULT_DB_ALIAS:
+            sender.objects.using(alias).update_or_create(pk=instance.pk, defaults={'name': instance.name})
+
+
+def drop_replica(sender, instance, using=None, **kwargs):
+    """post_delete handler removing a deleted auth.User or Tag from the other shards."""
+    if not enabled() or using != DEFAULT_DB_ALIAS:
+        return
+    for alias in shards():
+        if alias != DEFAULT_DB_ALIAS:
+            sender.objects.using(alias).filter(pk=instance.pk).delete()
+
+
+# label -> (field copied, extra values of new replicas); as the handlers above write them.
+_REPLICAS = {'auth.User': ('username', {'password': '!'}), 'markets.Tag': ('name', {})}
+
+
+def sync_replicas(chunk_size=5000):
+    """
+    Make the replicated rows of every shard match the default database:
+    create missing ones, copy changed names and delete rows gone from the
+    default database. Works through the tables in pk order, `chunk_size`
+    rows at a time. Returns {alias: {'created', 'updated', 'deleted'}}.
+    """
+    from django.apps import apps
+
+    counts = {}
+    for alias in shards():
+        if alias == DEFAULT_DB_ALIAS:
+            continue
+        created = updated = deleted = 0
+        for label, (field, extra) in _REPLICAS.items():
+            model = apps.get_model(label)
+            source = model.objects.using(DEFAULT_DB_ALIAS).order_by('pk')
+            replica = model.objects.using(alias)
+            last = 0
+            while True:
+                rows = dict(source.filter(pk__gt=last).values_list('pk', field)[:chunk_size])
+                if not rows:
+                    break
+                upper = max(rows)
+                existing = dict(replica.filter(pk__gt=last, pk__lte=upper).values_list('pk', field))
+                gone = existing.keys() - rows.keys()
+                if gone:
+                    deleted += replica.filter(pk__in=gone).delete()[1].get(label, 0)
+                changed = [model(pk=pk, **{field: rows[pk]}) for pk in existing.keys() & rows.keys()
+                           if existing[pk] != rows[pk]]
+                replica.bulk_update(changed, [field])
+                missing = [model(pk=pk, **{field: rows[pk]}, **extra) for pk in rows.keys() - existing.keys()]
+                replica.bulk_create(missing)
+                created += len(missing)
+                updated += len(changed)
+                last = upper
+            deleted += replica.filter(pk__gt=last).delete()[1].get(label, 0)
+        counts[alias] = {'created': created, 'updated': updated, 'deleted': deleted}
+    return counts
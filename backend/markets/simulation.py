@@ -0,0 +1,192 @@
+"""
+AMM backtesting: replay a trade flow against many market-maker configurations.
+
+A flow is a sequence of (outcome, usd_amount) buys, either recorded from the
+Trade journal or generated synthetically. A parameter set is (curve,
+liquidity, fee). Trades are applied one at a time (each depends on the
+previous state) but vectorized across parameter sets with numpy, so
+thousands of configurations cost about as much as one Python loop.
+
+Curves:
+    cpmm  Constant product, as in CPMMService.buy_tokens. `liquidity` is the
+          initial pool of each outcome.
+    lmsr  Logarithmic market scoring rule with b = liquidity / ln 2, so the
+          market maker's worst-case loss equals the CPMM's initial deposit.
+
+Fees are taken from each buy before it reaches the curve and go to the
+liquidity provider.
+"""
+import heapq
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+YES, NO = 0, 1
+CURVES = ('cpmm', 'lmsr')
+
+
+@dataclass
+class Flow:
+    outcomes: np.ndarray  # int8, YES or NO per trade
+    amounts: np.ndarray   # float64, USD per trade
+
+    def __len__(self):
+        return len(self.amounts)
+
+
+def synthetic_flow(n_trades, p_yes=0.5, mean_amount=20.0, sigma=1.0, seed=None):
+    """Random buys: outcome ~ Bernoulli(p_yes), amount ~ lognormal with the given mean."""
+    rng = np.random.default_rng(seed)
+    outcomes = np.where(rng.random(n_trades) < p_yes, YES, NO).astype(np.int8)
+    mu = math.log(mean_amount) - sigma ** 2 / 2
+    amounts = rng.lognormal(mu, sigma, n_trades)
+    return Flow(outcomes, amounts)
+
+
+def recorded_flow(market=None):
+    """
+    Buys from the Trade journal in time order (optionally for one market,
+    read from the shard it was loaded from; otherwise merged across shards).
+    """
+    from . import sharding
+    from .models import Trade
+
+    qs = Trade.objects.filter(kind=Trade.KIND_BUY).order_by('created_at', 'id')
+    if market is not None:
+        qs = qs.filter(outcome__market=market)
+    aliases = [market._state.db] if market is not None else sharding.shards()
+    rows = qs.values_list('created_at', 'id', 'outcome__name', 'amount')
+    streams = [rows.using(alias).iterator(chunk_size=5000) for alias in aliases]
+    names = []
+    amounts = []
+    for _, _, name, amount in heapq.merge(*streams, key=lambda row: row[:2]):
+        names.append(name)
+        amounts.append(float(amount))
+    outcomes = np.array([YES if n == 'YES' else NO for n in names], dtype=np.int8)
+    return Flow(outcomes, np.array(amounts, dtype=np.float64))
+
+
+def _log_diff_exp(a, b):
+    """log(e^a - e^b) for a > b, without overflow."""
+    return a + np.log1p(-np.exp(b - a))
+
+
+def simulate(curve, flow, liquidity, fees, resolution=None, path_points=20):
+    """
+    Replay `flow` against P parameter sets of one curve.
+
+    `liquidity` and `fees` are arrays of shape (P,). `resolution` is YES, NO,
+    or None to mark the LP to market at the final price. Returns a dict of
+    arrays: final_price (P,), price_path (path_points + 1, P), mean/max
+    slippage (P,), fees_collected (P,) and lp_pnl (P,).
+    """
+    liquidity = np.asarray(liquidity, dtype=np.float64)
+    fees = np.asarray(fees, dtype=np.float64)
+    n = len(flow)
+    sample_at = set(np.linspace(0, n, path_points + 1).astype(int).tolist()) if n else {0}
+
+    if curve == 'cpmm':
+        r_yes = liquidity.copy()
+        r_no = liquidity.copy()
+        price = r_no / (r_yes + r_no)
+    elif curve == 'lmsr':
+        b = liquidity / math.log(2)
+        q_yes = np.zeros_like(liquidity)
+        q_no = np.zeros_like(liquidity)
+        cost0 = b * np.logaddexp(0.0, 0.0)
+        price = np.full_like(liquidity, 0.5)
+    else:
+        raise ValueError(f'Unknown curve: {curve}')
+
+    path = [price.copy()] if 0 in sample_at else []
+    slip_sum = np.zeros_like(liquidity)
+    slip_max = np.zeros_like(liquidity)
+    fees_collected = np.zeros_like(liquidity)
+
+    for i in range(n):
+        side = flow.outcomes[i]
+        amount = flow.amounts[i]
+        fee = amount * fees
+        invest = amount - fee
+        fees_collected += fee
+        # Clipped: a saturated LMSR price can underflow to exactly 0.
+        pre = np.maximum(price if side == YES else 1 - price, 1e-12)
+
+        if curve == 'cpmm':
+            # Same arithmetic as CPMMService.execute_buy, mirrored for NO.
+            bought, other = (r_yes, r_no) if side == YES else (r_no, r_yes)
+            k = bought * other
+            new_other = other + invest
+            new_bought = k / new_other
+            shares = invest + (bought - new_bought)
+            if side == YES:
+                r_yes, r_no = new_bought, new_other
+            else:
+                r_no, r_yes = new_bought, new_other
+            price = r_no / (r_yes + r_no)
+        else:
+            # Solve C(q + s) - C(q) = invest for s on the bought outcome.
+            bought, other = (q_yes, q_no) if side == YES else (q_no, q_yes)
+            cost = b * np.logaddexp(q_yes / b, q_no / b)
+            new_bought = b * _log_diff_exp((cost + invest) / b, other / b)
+            shares = new_bought - bought
+            if side == YES:
+                q_yes = new_bought
+            else:
+                q_no = new_bought
+            price = 1 / (1 + np.exp((q_no - q_yes) / b))
+
+        avg_price = amount / shares
+        slippage = (avg_price - pre) / pre
+        slip_sum += slippage
+        np.maximum(slip_max, slippage, out=slip_max)
+        if i + 1 in sample_at:
+            path.append(price.copy())
+
+    p_final_yes = price if resolution is None else np.full_like(price, 1.0 if resolution == YES else 0.0)
+
+    if curve == 'cpmm':
+        # LP deposited `liquidity` and holds the pools; each winning share pays $1.
+        lp_value = r_yes * p_final_yes + r_no * (1 - p_final_yes)
+        lp_pnl = lp_value + fees_collected - liquidity
+    else:
+        # Market maker collected C(q) - C(0) and owes the outstanding shares.
+        collected = b * np.logaddexp(q_yes / b, q_no / b) - cost0
+        owed = q_yes * p_final_yes + q_no * (1 - p_final_yes)
+        lp_pnl = collected - owed + fees_collected
+
+    return {
+        'final_price': price,
+        'price_path': np.vstack(path),
+        'mean_slippage': slip_sum / n if n else slip_sum,
+        'max_slippage': slip_max,
+        'fees_collected': fees_collected,
+        'lp_pnl': lp_pnl,
+    }
+
+
+def simulate_chunk(args):
+    """Process-pool entry point: (curve, flow, liquidity, fees, resolution, path_points) -> rows."""
+    curve, flow, liquidity, fees, resolution, path_points = args
+    result = simulate(curve, flow, liquidity, fees, resolution, path_points)
+    rows = []
+    for j in range(len(liquidity)):
+        rows.append({
+            'curve': curve,
+            'liquidity': float(liquidity[j]),
+            'fee': float(fees[j]),
+            'final_price_yes': float(result['final_price'][j]),
+            'mean_slippage': float(result['mean_slippage'][j]),
+            'max_slippage': float(result['max_slippage'][j]),
+            'fees_collected': float(result['fees_collected'][j]),
+            'lp_pnl': float(result['lp_pnl'][j]),
+            'price_path': [round(float(p), 6) for p in result['price_path'][:, j]],
+        })
+    return rows
+
+
+def parameter_grid(curves, liquidities, fees):
+    """Cartesian product grouped by curve: {curve: (liquidity array, fee array)}."""
+    lq, fe = np.meshgrid(np.asarray(liquidities, dtype=np.float64), np.asarray(fees, dtype=np.float64), indexing='ij')
+    return {curve: (lq.ravel(), fe.ravel()) for curve in curves}
@@ -0,0 +1,194 @@
+"""
+Lightweight background task queue backed by the Task table.
+
+enqueue() inserts a row in the caller's transaction, so a task enqueued
+during a trade only becomes visible to workers once the trade commits (and
+disappears with it on rollback). The `run_tasks` command claims due tasks
+in batches, runs them on a thread pool and retries failures with
+exponential backoff. A task still running after LOCK_TIMEOUT is taken to
+have lost its worker: it is claimed again and that counts as an attempt.
+Handlers registered with batch=True receive every claimed payload of their
+type in one call. A handler runs in the transaction that deletes its tasks,
+so its database writes happen exactly once even when a batch is retried.
+
+    @task('trade.executed', batch=True)
+    def record_trade_stats(payloads): ...
+
+    enqueue('trade.executed', {'market_id': 1, 'amount': '10'})
+"""
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import MarketStats, Task
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2.0  # seconds; doubled on every attempt
+BACKOFF_MAX = 3600.0
+LOCK_TIMEOUT = timedelta(minutes=10)  # running tasks older than this are reclaimed
+
+_registry = {}
+
+
+class Reclaimed(Exception):
+    """Some tasks of a unit were claimed again by another worker while this one ran them."""
+
+
+class _Handler:
+    def __init__(self, func, batch, max_attempts):
+        self.func = func
+        self.batch = batch
+        self.max_attempts = max_attempts
+
+
+def task(name, batch=False, max_attempts=MAX_ATTEMPTS):
+    """Register a handler for tasks called `name`."""
+    def decorator(func):
+        _registry[name] = _Handler(func, batch, max_attempts)
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, delay=None):
+    """Add a task. Call inside the transaction whose commit should publish it."""
+    run_at = timezone.now() + (delay or timedelta(0))
+    return Task.objects.create(name=name, payload=payload or {}, run_at=run_at)
+
+
+def claim(limit=100):
+    """Mark up to `limit` due tasks as running and return them."""
+    now = timezone.now()
+    stale = Q(status=Task.STATUS_RUNNING, locked_at__lt=now - LOCK_TIMEOUT)
+    due = Q(status=Task.STATUS_PENDING, run_at__lte=now) | stale
+    with transaction.atomic():
+        ids = list(
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(due).order_by('run_at').values_list('id', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        # The worker running a stale task died or hung: that was an attempt.
+        Task.objects.filter(Q(id__in=ids) & stale).update(
+            attempts=F('attempts') + 1, last_error='Lock timed out while running.',
+        )
+        # The status filter keeps two workers from claiming the same row on
+        # databases without SKIP LOCKED.
+        Task.objects.filter(Q(id__in=ids) & due).update(status=Task.STATUS_RUNNING, locked_at=now)
+        return list(Task.objects.filter(id__in=ids, status=Task.STATUS_RUNNING, locked_at=now))
+
+
+def _backoff(attempts):
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def _give_up(tasks):
+    for t in tasks:
+        t.status = Task.STATUS_FAILED
+        t.locked_at = None
+        logger.error('Task %s #%s failed permanently: %s', t.name, t.id, t.last_error)
+    Task.objects.bulk_update(tasks, ['locked_at', 'status'])
+
+
+def _fail(tasks, max_attempts, error):
+    now = timezone.now()
+    for t in tasks:
+        t.attempts += 1
+        t.last_error = error
+        t.locked_at = None
+        if t.attempts >= max_attempts:
+            t.status = Task.STATUS_FAILED
+            logger.error('Task %s #%s failed permanently: %s', t.name, t.id, error.splitlines()[-1] if error else '')
+        else:
+            t.status = Task.STATUS_PENDING
+            t.run_at = now + _backoff(t.attempts)
+    Task.objects.bulk_update(tasks, ['attempts', 'last_error', 'locked_at', 'status', 'run_at'])
+
+
+def run_tasks(tasks):
+    """Run claimed tasks, grouping batch handlers. Returns the number that succeeded."""
+    by_name = {}
+    for t in tasks:
+        by_name.setdefault(t.name, []).append(t)
+
+    succeeded = 0
+    for name, group in by_name.items():
+        handler = _registry.get(name)
+        if handler is None:
+            _fail(group, 1, f'No handler registered for {name!r}.')
+            continue
+        exhausted = [t for t in group if t.attempts >= handler.max_attempts]
+        if exhausted:
+            _give_up(exhausted)
+            group = [t for t in group if t.attempts < handler.max_attempts]
+            if not group:
+                continue
+
+        units = [group] if handler.batch else [[t] for t in group]
+        for unit in units:
+            try:
+                with transaction.atomic():
+                    if handler.batch:
+                        handler.func([t.payload for t in unit])
+                    else:
+                        handler.func(unit[0].payload)
+                    # Only rows still under this claim: a task reclaimed as
+                    # stale belongs to the worker that reclaimed it, and
+                    # rolling back here keeps its handler from running twice.
+                    deleted, _ = Task.objects.filter(
+                        id__in=[t.id for t in unit], status=Task.STATUS_RUNNING,
+                        locked_at__in={t.locked_at for t in unit},
+                    ).delete()
+                    if deleted != len(unit):
+                        raise Reclaimed
+                succeeded += len(unit)
+            except Reclaimed:
+                logger.warning('Tasks %s were reclaimed while running; left to their new worker.',
+                               ', '.join(str(t.id) for t in unit))
+            except Exception:
+                _fail(unit, handler.max_attempts, traceback.format_exc())
+    return succeeded
+
+
+def run_pending(limit=100):
+    """Claim and run one batch. Returns the number of tasks claimed."""
+    tasks = claim(limit)
+    if tasks:
+        run_tasks(tasks)
+    return len(tasks)
+
+
+# Handlers
+
+@task('trade.executed', batch=True)
+def record_trade_stats(payloads):
+    """Fold a batch of trades into per-market volume / trade counters, and queue them for trending."""
+    totals = {}
+    for p in payloads:
+        volume, trades = totals.get(p['market_id'], (Decimal('0'), 0))
+        totals[p['market_id']] = (volume + Decimal(p['amount']), trades + 1)
+
+    MarketStats.objects.bulk_create([MarketStats(market_id=market_id) for market_id in totals], ignore_conflicts=True)
+    for market_id, (volume, trades) in totals.items():
+        MarketStats.objects.filter(market_id=market_id).update(
+            volume=F('volume') + volume, trades=F('trades') + trades,
+        )
+
+    # A separate task, so a retry of either does not redo the other.
+    enqueue('trending.trades', {'trades': payloads})
+
+
+def market_stats(market_id):
+    """{'volume', 'trades'} of a market, as far as the stats task has got."""
+    stats = MarketStats.objects.filter(market_id=market_id).values_list('volume', 'trades').first()
+    volume, trades = stats or (Decimal('0'), 0)
+    return {'volume': volume, 'trades': trades}
@@ -1,8 +1,34 @@
+from datetime import timedelta
 from decimal import Decimal
+from importlib import import_module
+from io import StringIO
 import json
-from django.test import TestCase, Client
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import numpy as np
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, transaction
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth import BACKEND_SESSION_KEY
 from django.contrib.auth.models import User
-from .models import Market, Outcome, Position
+from django.contrib.auth.signals import user_login_failed
+from django.utils import timezone
+from .models import (
+    Market, Outcome, Position, LimitOrder, Comment, Event, FacetCount, MarketShard, Notification,
+    PortfolioSnapshot, PriceAlert, Tag, Task, Trade, TrendingScore, UserProfile,
+)
+from . import datagen, passwords, profiling, simulation, views
+from . import alerts, archive, audit, events, exports, facets, history, importing, orderbook, scheduler, sharding, tasks, trending
+from .archive import archive_settled_markets, get_archived
+from .orderbook import OrderBookService, PriceLevelBook, reset_books
+from .ratelimit import rejection_counts, reset_buckets
+from .renderers import FastJsonResponse, RawJSON, columnar, dumps, msgpack
 from .services import CPMMService
 
 class MarketTests(TestCase):
@@ -63,6 +89,7 @@ class MarketTests(TestCase):
         yes, no = CPMMService.initialize_market(self.market)
         data['outcome_id'] = yes.id
         
+        self.client.force_login(self.user)
         response = self.client.post(
             f'/api/markets/{self.market.slug}/trade/',
             data=json.dumps(data),
@@ -73,3 +100,1491 @@ class MarketTests(TestCase):
         json_resp = response.json()
         self.assertEqual(json_resp['status'], 'success')
         self.assertTrue(float(json_resp['trade']['shares_bought']) > 0)
+
+    def test_winning_shares_redeem_once(self):
+        yes, _ = CPMMService.initialize_market(self.market)
+        CPMMService.execute_buy(self.user, yes, Decimal('10'))
+        shares = Position.objects.get(user=self.user, outcome=yes).shares
+        Market.objects.filter(pk=self.market.pk).update(status=Market.STATUS_RESOLVED, winning_outcome=yes)
+
+        self.client.force_login(self.user)
+        url = f'/api/markets/{self.market.slug}/redeem/'
+        response = self.client.post(url, '{}', content_type='application/json')
+        self.assertEqual(Decimal(str(response.json()['payout'])), shares)
+        balance = UserProfile.objects.get(user=self.user).balance
+        self.assertEqual(balance, (Decimal('1000') + shares).quantize(Decimal('0.01')))
+        self.assertEqual(Decimal(str(response.json()['new_balance'])), balance)
+        self.assertEqual(self.client.post(url, '{}', content_type='application/json').json()['payout'], 0)
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, balance)
+
+    def test_stale_cached_status_does_not_admit_trades(self):
+        yes, _ = CPMMService.initialize_market(self.market)
+        cache.clear()
+        self.assertTrue(scheduler.trading_open(self.market.slug))
+        # Resolved by another worker: this process' cached status still says open.
+        Market.objects.filter(pk=self.market.pk).update(status=Market.STATUS_RESOLVED)
+
+        self.client.force_login(self.user)
+        response = self.client.post(f'/api/markets/{self.market.slug}/trade/', data=json.dumps(
+            {'outcome_id': yes.id, 'amount': 20}
+        ), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(UserProfile.objects.get(user=self.user).balance, Decimal('1000'))
+        self.assertFalse(Position.objects.exists())
+
+
+@override_settings(RATE_LIMITS={
+    'user': {'rate': 1, 'burst': 2},
+    'market': {'rate': 100, 'burst': 100},
+    'endpoint': {'rate': 100, 'burst': 100},
+})
+class RateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_buckets()
+        self.user = User.objects.create(username='bot')
+        self.market = Market.objects.create(title="Rate", slug="rate", status=Market.STATUS_OPEN)
+        self.yes, _ = CPMMService.initialize_market(self.market)
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def trade(self):
+        return self.client.post(
+            f'/api/markets/{self.market.slug}/trade/',
+            data=json.dumps({'outcome_id': self.yes.id, 'amount': 1}),
+            content_type='application/json'
+        )
+
+    def test_user_bucket_returns_429_with_retry_after(self):
+        """Trades beyond the user's burst are rejected and counted."""
+        self.assertEqual(self.trade().status_code, 200)
+        self.assertEqual(self.trade().status_code, 200)
+
+        response = self.trade()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response.json()['scope'], 'user')
+        self.assertEqual(rejection_counts()['user'], 1)
+
+    def test_only_requests_reaching_the_view_are_charged(self):
+        anonymous = Client()
+        for _ in range(3):
+            response = anonymous.post(f'/api/markets/{self.market.slug}/trade/', data=json.dumps(
+                {'outcome_id': self.yes.id, 'amount': 1}
+            ), content_type='application/json')
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(self.client.get(f'/api/markets/{self.market.slug}/trade/').status_code, 405)
+        self.assertEqual(self.trade().status_code, 200)
+        self.assertEqual(self.trade().status_code, 200)
+
+    def test_held_bucket_lock_rejects_instead_of_admitting(self):
+        cache.add(f'ratelimit:user:u{self.user.pk}:lock', 1)  # another worker is refilling
+        with mock.patch('markets.ratelimit.time.sleep'):
+            self.assertEqual(self.trade().status_code, 429)
+
+    def test_buckets_are_shared_through_cache(self):
+        """A fresh process (no local state) still sees the drained bucket."""
+        self.trade()
+        self.trade()
+        reset_buckets()
+        self.assertEqual(self.trade().status_code, 429)
+
+
+class AuthQueryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='reader')
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def test_me_view_loads_user_and_profile_in_one_query(self):
+        """Session comes from the cache, user + profile from a single join."""
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/auth/me/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['balance'], 1000.0)
+
+    def test_saving_user_does_not_rewrite_profile(self):
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=['last_login'])
+
+
+class LimitOrderTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_books()
+        self.maker = User.objects.create(username='maker')
+        self.taker = User.objects.create(username='taker')
+        self.market = Market.objects.create(title="Orders", slug="orders", status=Market.STATUS_OPEN)
+        self.yes, self.no = CPMMService.initialize_market(self.market)
+
+    def test_price_level_book_priority(self):
+        """Highest price first, then oldest order."""
+        book = PriceLevelBook()
+        book.push(3, Decimal('0.40'))
+        book.push(1, Decimal('0.45'))
+        book.push(2, Decimal('0.45'))
+        book.discard(1)
+        self.assertEqual(book.pop(), (Decimal('0.45'), 2))
+        self.assertEqual(book.pop(), (Decimal('0.40'), 3))
+        self.assertIsNone(book.pop())
+
+    def test_stale_book_replays_other_workers_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            OrderBookService.place_order(self.maker, self.yes, Decimal('0.30'), Decimal('5'))
+        ours = orderbook.get_book(self.yes.id)
+
+        reset_books()  # another worker
+        with self.captureOnCommitCallbacks(execute=True):
+            second = OrderBookService.place_order(self.maker, self.yes, Decimal('0.35'), Decimal('5'))
+
+        orderbook._books[(DEFAULT_DB_ALIAS, self.yes.id)] = ours
+        with self.assertNumQueries(0):
+            self.assertIs(orderbook.get_book(self.yes.id), ours)
+        self.assertEqual(ours.peek(), (Decimal('0.35'), second.id))
+        self.assertEqual(len(ours), 2)
+
+        # Deltas that are gone mean a reload from the table.
+        cache.delete(orderbook._delta_key((DEFAULT_DB_ALIAS, self.yes.id), ours.version))
+        ours.version -= 1
+        with self.assertNumQueries(1):
+            self.assertEqual(len(orderbook.get_book(self.yes.id)), 2)
+
+    def test_uncommitted_orders_stay_in_their_transaction(self):
+        self.assertEqual(len(orderbook.get_book(self.yes.id)), 0)
+        first = OrderBookService.place_order(self.maker, self.yes, Decimal('0.30'), Decimal('5'))
+        try:
+            with transaction.atomic():
+                OrderBookService.place_order(self.maker, self.yes, Decimal('0.35'), Decimal('5'))
+                raise ValueError
+        except ValueError:
+            pass
+
+        # Only this transaction sees its order, and the rolled-back one is gone.
+        with orderbook.get_book(self.yes.id).lock:
+            self.assertEqual(orderbook._BookView(self.yes.id).peek(), (Decimal('0.30'), first.id))
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(orderbook._BookView(self.yes.id).peek()))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [None])
+        self.assertEqual(len(orderbook.get_book(self.yes.id)), 0)
+
+        # Committing publishes it to the shared book.
+        callbacks = [c for _, c, *_ in connection.run_on_commit if isinstance(c, orderbook._PendingChange)]
+        for callback in callbacks:
+            callback()
+        self.assertEqual(orderbook.get_book(self.yes.id).peek(), (Decimal('0.30'), first.id))
+
+    def test_limit_fills_are_queued_for_stats(self):
+        order = OrderBookService.place_order(self.maker, self.yes, Decimal('0.60'), Decimal('5'))
+        self.assertEqual(order.status, LimitOrder.STATUS_FILLED)
+        payload = Task.objects.get(name='trade.executed').payload
+        self.assertEqual(payload['user_id'], self.maker.id)
+        self.assertEqual(payload['market_id'], self.market.id)
+        self.assertEqual(Decimal(payload['amount']), Decimal('5'))
+
+    def test_resting_order_fills_when_price_drops(self):
+        order = OrderBookService.place_order(self.maker, self.yes, Decimal('0.45'), Decimal('50'))
+        self.assertEqual(order.status, LimitOrder.STATUS_OPEN)
+        self.maker.userprofile.refresh_from_db()
+        self.assertEqual(self.maker.userprofile.balance, Decimal('950'))
+
+        # Buying NO pushes YES below 0.45, which lets the order fill up to its limit.
+        CPMMService.buy_tokens(self.taker, self.no, Decimal('40'))
+
+        order.refresh_from_db()
+        self.yes.refresh_from_db()
+        self.assertGreater(order.shares_filled, 0)
+        self.assertLess(order.remaining, Decimal('50'))
+        self.assertLessEqual(self.yes.current_price, Decimal('0.4501'))
+        self.assertTrue(Position.objects.filter(user=self.maker, outcome=self.yes, shares__gt=0).exists())
+
+    def test_crossing_order_fills_immediately(self):
+        order = OrderBookService.place_order(self.maker, self.yes, Decimal('0.60'), Decimal('5'))
+        self.assertEqual(order.status, LimitOrder.STATUS_FILLED)
+        self.assertEqual(order.remaining, 0)
+
+    def test_cancel_refunds_and_resolve_cancels(self):
+        first = OrderBookService.place_order(self.maker, self.yes, Decimal('0.30'), Decimal('20'))
+        OrderBookService.place_order(self.maker, self.no, Decimal('0.30'), Decimal('30'))
+
+        self.assertEqual(OrderBookService.cancel_order(first), Decimal('20'))
+        self.assertEqual(OrderBookService.cancel_market_orders(self.market), 1)
+        self.maker.userprofile.refresh_from_db()
+        self.assertEqual(self.maker.userprofile.balance, Decimal('1000'))
+
+    def test_order_endpoint(self):
+        self.client.force_login(self.maker)
+        response = self.client.post(
+            f'/api/markets/{self.market.slug}/orders/',
+            data=json.dumps({'outcome_id': self.yes.id, 'limit_price': '0.4', 'amount': 10}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        order_id = response.json()['id']
+
+        response = self.client.post(f'/api/orders/{order_id}/cancel/')
+        self.assertEqual(response.json()['order']['status'], LimitOrder.STATUS_CANCELLED)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create(username='finance', is_staff=True)
+        self.market = Market.objects.create(title="Export", slug="export", status=Market.STATUS_OPEN)
+        self.yes, self.no = CPMMService.initialize_market(self.market)
+        CPMMService.buy_tokens(self.staff, self.yes, Decimal('10'))
+        self.client.force_login(self.staff)
+
+    def test_trades_csv_streams(self):
+        response = self.client.get('/api/export/trades/?format=csv&market=export&since=2000-01-01')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'created_at', 'username'])
+        self.assertEqual(len(lines), 2)
+
+    def test_ledger_ndjson(self):
+        response = self.client.get('/api/export/ledger/?format=ndjson&user=finance')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['market_slug'], 'export')
+        self.assertEqual(rows[0]['outcome_name'], 'YES')
+
+    def test_export_requires_staff(self):
+        self.client.force_login(User.objects.create(username='nobody'))
+        self.assertEqual(self.client.get('/api/export/trades/').status_code, 403)
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create(username='seeder', is_staff=True)
+        Market.objects.create(title="Existing", slug="taken")
+        self.client.force_login(self.staff)
+
+    def test_import_reports_row_errors_without_aborting(self):
+        body = '\n'.join([
+            json.dumps({'title': 'Game 1', 'slug': 'game-1', 'status': 'open'}),
+            json.dumps({'title': 'Game 2', 'slug': 'taken'}),
+            'not json',
+            json.dumps({'title': '', 'slug': 'game-3'}),
+            json.dumps({'title': 'Game 1 again', 'slug': 'game-1'}),
+            json.dumps({'title': 'Game 4', 'slug': 'game-4', 'liquidity': 250}),
+        ])
+        response = self.client.post('/api/import/markets/', data=body, content_type='application/x-ndjson')
+
+        result = response.json()
+        self.assertEqual(result['created'], 2)
+        self.assertEqual([e['row'] for e in result['errors']], [2, 3, 4, 5])
+
+        outcomes = Outcome.objects.filter(market__slug='game-4')
+        self.assertEqual(sorted(o.name for o in outcomes), ['NO', 'YES'])
+        self.assertTrue(all(o.pool_balance == Decimal('250') for o in outcomes))
+
+    def test_import_rejects_malformed_values_per_row(self):
+        body = '\n'.join([
+            json.dumps({'title': 5, 'slug': 'x'}),
+            json.dumps({'title': 'Long', 'slug': 's' * 201}),
+            json.dumps({'title': 'Inf', 'slug': 'inf', 'liquidity': 'Infinity'}),
+            json.dumps({'title': 'NaN', 'slug': 'nan', 'liquidity': 'NaN'}),
+            json.dumps({'title': 'Huge', 'slug': 'huge', 'liquidity': 1e20}),
+            json.dumps({'title': 'List', 'slug': ['a'], 'status': 1}),
+            json.dumps({'title': 'Fine', 'slug': 'fine'}),
+        ])
+        response = self.client.post('/api/import/markets/', data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result['created'], 1)
+        errors = {e['row']: e['errors'] for e in result['errors']}
+        self.assertEqual(errors[1], {'title': 'Must be a string.'})
+        self.assertIn('slug', errors[2])
+        self.assertEqual([set(errors[n]) for n in (3, 4, 5)], [{'liquidity'}] * 3)
+        self.assertEqual(set(errors[6]), {'slug', 'status'})
+
+    def test_import_csv(self):
+        body = 'title,slug,status\nA,a-market,open\nB,b-market,bogus\n'
+        response = self.client.post('/api/import/markets/', data=body, content_type='text/csv')
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual(Market.objects.get(slug='a-market').outcomes.count(), 2)
+
+    def test_command_rejects_bad_defaults(self):
+        for args in (['--liquidity', 'NaN'], ['--liquidity', '-5'], ['--liquidity', 'x'], ['--batch-size', '0']):
+            with self.assertRaises(CommandError):
+                call_command('import_markets', 'markets.jsonl', *args)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='archivist')
+        self.market = Market.objects.create(title="Old", slug="old", status=Market.STATUS_OPEN)
+        self.yes, self.no = CPMMService.initialize_market(self.market)
+        CPMMService.buy_tokens(self.user, self.no, Decimal('10'))
+        Comment.objects.create(market=self.market, user=self.user, text='gg')
+        self.market.winning_outcome = self.yes
+        self.market.status = Market.STATUS_RESOLVED
+        self.market.resolved_at = timezone.now() - timedelta(days=60)
+        self.market.save()
+
+    def test_unredeemed_winners_block_archival(self):
+        CPMMService.buy_tokens(self.user, self.yes, Decimal('5'))
+        self.assertEqual(archive_settled_markets(older_than_days=30), [])
+
+    def test_archived_market_stays_queryable(self):
+        self.assertEqual(archive_settled_markets(older_than_days=30), ['old'])
+        self.assertFalse(Market.objects.filter(slug='old').exists())
+        self.assertFalse(Position.objects.exists())
+
+        stub = self.client.get('/api/markets/old/').json()
+        self.assertTrue(stub['archived'])
+        self.assertEqual(stub['winning_outcome'], 'YES')
+
+        full = self.client.get('/api/archive/old/').json()
+        self.assertEqual(len(full['positions']), 1)
+        self.assertEqual(full['comments'][0]['text'], 'gg')
+        self.assertEqual(full['trades'][0]['kind'], 'buy')
+
+    def test_failed_delete_rolls_back_the_archive_row(self):
+        with mock.patch.object(events, 'record', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            archive_settled_markets(older_than_days=30)
+        self.assertIsNone(get_archived('old'))
+        self.assertTrue(Market.objects.filter(slug='old').exists())
+        self.assertEqual(archive_settled_markets(older_than_days=30), ['old'])
+
+    def test_rerun_after_delete_is_a_no_op(self):
+        archive.archive_market(self.market)
+        archive.archive_market(self.market)
+        self.assertEqual(Event.objects.filter(kind='market.archive').count(), 1)
+
+    def test_migration_backfills_resolution_time(self):
+        backfill = import_module('markets.migrations.0018_backfill_resolved_at').backfill_resolved_at
+
+        Market.objects.filter(pk=self.market.pk).update(resolved_at=None)
+        backfill(apps, mock.Mock(connection=connection))
+        traded = Trade.objects.filter(outcome__market=self.market).latest('created_at').created_at
+        self.assertEqual(Market.objects.get(pk=self.market.pk).resolved_at, traded)
+
+    def test_archived_slug_cannot_be_reused(self):
+        archive_settled_markets(older_than_days=30)
+        self.client.force_login(self.user)
+        response = self.client.post('/api/markets/', data=json.dumps({'title': 'New', 'slug': 'old'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class RendererTests(TestCase):
+    def test_decimals_are_numbers_by_default(self):
+        self.assertEqual(json.loads(dumps({'price': Decimal('0.5250')})), {'price': 0.525})
+        # Exact digits, not the nearest float.
+        content = dumps({'balance': Decimal('12345678901234567.89'), 'nan': Decimal('NaN'), 'tiny': Decimal('1E-9')})
+        self.assertEqual(content, b'{"balance":12345678901234567.89,"nan":null,"tiny":1E-9}')
+        self.assertEqual(json.loads(content, parse_float=Decimal)['balance'], Decimal('12345678901234567.89'))
+
+    @override_settings(JSON_DECIMAL_FORMAT='string')
+    def test_decimals_as_strings(self):
+        self.assertEqual(json.loads(dumps({'price': Decimal('0.5250')})), {'price': '0.5250'})
+
+    def test_raw_fragments_are_spliced(self):
+        cached = RawJSON(b'{"slug":"cached","outcomes":[1,2]}')
+        content = dumps({'markets': [cached, {'slug': 'fresh'}]})
+        self.assertEqual(json.loads(content), {'markets': [{'slug': 'cached', 'outcomes': [1, 2]}, {'slug': 'fresh'}]})
+
+    def test_response_requires_dict_unless_unsafe(self):
+        with self.assertRaises(TypeError):
+            FastJsonResponse([1])
+        self.assertEqual(FastJsonResponse([1], safe=False).content, b'[1]')
+
+    def test_columnar_layout(self):
+        rows = [{'id': 1, 'outcomes': [{'name': 'YES'}]}, {'id': 2, 'extra': True, 'outcomes': []}]
+        self.assertEqual(columnar({'markets': rows}), {'markets': {
+            'fields': ['id', 'outcomes', 'extra'],
+            'rows': [[1, {'fields': ['name'], 'rows': [['YES']]}, None], [2, [], True]],
+        }})
+
+    def test_list_endpoints_negotiate_format(self):
+        market = Market.objects.create(title="Wire", slug="wire", status=Market.STATUS_OPEN)
+        CPMMService.initialize_market(market)
+        plain = self.client.get('/api/markets/')
+        self.assertEqual(plain['Content-Type'], 'application/json')
+        self.assertIn('Accept', plain['Vary'])
+
+        response = self.client.get('/api/markets/', HTTP_ACCEPT='application/json;q=0.5, application/vnd.columnar+json')
+        self.assertEqual(response['Content-Type'], 'application/vnd.columnar+json')
+        data = response.json()
+        self.assertEqual(data['rows'][0][data['fields'].index('slug')], 'wire')
+        outcomes = data['rows'][0][data['fields'].index('outcomes')]
+        self.assertEqual(outcomes['fields'], ['id', 'name', 'price', 'pool'])
+
+        response = self.client.get('/api/markets/wire/ledger/?format=columnar')
+        self.assertEqual(response.json()['ledger'], [])
+
+        response = self.client.get('/api/markets/', HTTP_ACCEPT='application/msgpack')
+        if msgpack is None:
+            self.assertEqual(response['Content-Type'], 'application/json')
+        else:
+            self.assertEqual(msgpack.unpackb(response.content)['fields'], data['fields'])
+
+
+class SimulationTests(TestCase):
+    def test_cpmm_replay_matches_service(self):
+        """The vectorized CPMM gives the same price as CPMMService for the same buy."""
+        market = Market.objects.create(title="Sim", slug="sim")
+        yes, _ = CPMMService.initialize_market(market)
+        CPMMService.buy_tokens(User.objects.create(username='sim'), yes, Decimal('10'))
+        yes.refresh_from_db()
+
+        flow = simulation.recorded_flow(market)
+        result = simulation.simulate('cpmm', flow, np.array([100.0, 50.0]), np.array([0.0, 0.0]),
+                                     resolution=simulation.YES)
+        self.assertAlmostEqual(result['final_price'][0], float(yes.current_price), places=4)
+        self.assertGreater(result['final_price'][1], result['final_price'][0])
+        # LP keeps 100 - 9.09 YES shares after paying out the trader.
+        self.assertAlmostEqual(result['lp_pnl'][0], -9.0909, places=3)
+
+    def test_lmsr_and_fees(self):
+        flow = simulation.synthetic_flow(200, p_yes=0.7, seed=3)
+        result = simulation.simulate('lmsr', flow, np.array([100.0, 100.0]), np.array([0.0, 0.02]))
+        self.assertGreater(result['final_price'][0], 0.5)
+        self.assertEqual(result['price_path'].shape[1], 2)
+        self.assertGreater(result['lp_pnl'][1], result['lp_pnl'][0])
+
+
+class SchedulerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='scheduled')
+        now = timezone.now()
+        self.upcoming = Market.objects.create(title="Up", slug="up", opens_at=now - timedelta(minutes=1),
+                                              closes_at=now + timedelta(hours=1))
+        self.ending = Market.objects.create(title="End", slug="end", status=Market.STATUS_OPEN,
+                                            closes_at=now - timedelta(seconds=1))
+        Market.objects.create(title="Later", slug="later", opens_at=now + timedelta(days=1))
+
+    def test_run_due_transitions_and_next_deadline(self):
+        opened, closed = scheduler.run_due()
+        self.assertEqual((opened, closed), (['up'], ['end']))
+        self.assertEqual(Market.objects.get(slug='end').status, Market.STATUS_CLOSED)
+        self.assertEqual(scheduler.next_deadline(), Market.objects.get(slug='up').closes_at)
+
+    def test_trade_rejected_on_closed_market(self):
+        """Past closes_at trading stops even before the worker runs."""
+        yes, _ = CPMMService.initialize_market(self.ending)
+        self.client.force_login(self.user)
+        response = self.client.post(f'/api/markets/{self.ending.slug}/trade/',
+                                    data=json.dumps({'outcome_id': yes.id, 'amount': 5}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Position.objects.exists())
+
+    def test_status_cache_is_invalidated_on_edit(self):
+        self.assertFalse(scheduler.trading_open('later'))
+        staff = User.objects.create(username='ops', is_staff=True)
+        self.client.force_login(staff)
+        self.client.patch('/api/markets/later/', data=json.dumps({'status': 'open'}),
+                          content_type='application/json')
+        self.assertTrue(scheduler.trading_open('later'))
+
+
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+    def test_trade_enqueues_stats_task_processed_in_batch(self):
+        user = User.objects.create(username='queued')
+        market = Market.objects.create(title="Queue", slug="queue", status=Market.STATUS_OPEN)
+        yes, _ = CPMMService.initialize_market(market)
+        self.client.force_login(user)
+        for _ in range(3):
+            self.client.post(f'/api/markets/{market.slug}/trade/',
+                             data=json.dumps({'outcome_id': yes.id, 'amount': 5}),
+                             content_type='application/json')
+
+        self.assertEqual(Task.objects.filter(name='trade.executed').count(), 3)
+        self.assertEqual(tasks.run_pending(), 3)
+        self.assertEqual(tasks.market_stats(market.id), {'volume': 15.0, 'trades': 3})
+        self.assertEqual(self.client.get(f'/api/markets/{market.slug}/stats/').json(), {'volume': 15, 'trades': 3})
+        self.assertEqual(list(Task.objects.values_list('name', flat=True)), ['trending.trades'])
+        self.assertEqual(tasks.run_pending(), 1)
+        self.assertFalse(Task.objects.exists())
+
+    def test_retried_stats_batch_is_counted_once(self):
+        for amount in ('5', '7'):
+            tasks.enqueue('trade.executed', {'market_id': 42, 'amount': amount})
+        with mock.patch.object(tasks, 'enqueue', side_effect=RuntimeError('boom')):
+            tasks.run_pending()
+        self.assertEqual(tasks.market_stats(42), {'volume': 0.0, 'trades': 0})
+
+        Task.objects.update(run_at=timezone.now())
+        tasks.run_pending()
+        self.assertEqual(tasks.market_stats(42), {'volume': 12.0, 'trades': 2})
+
+    def test_task_reclaimed_mid_run_is_handled_once(self):
+        @tasks.task('test.slow')
+        def slow(payload):
+            Notification.objects.create(user=user, kind='test', message='handled')
+
+        user = User.objects.create(username='slow')
+        tasks.enqueue('test.slow', {'n': 1})
+        claimed = tasks.claim()
+        # Meanwhile another worker takes it for dead and claims it again.
+        Task.objects.update(locked_at=timezone.now() - 2 * tasks.LOCK_TIMEOUT)
+        self.assertEqual(len(tasks.claim()), 1)
+
+        self.assertEqual(tasks.run_tasks(claimed), 0)
+        self.assertFalse(Notification.objects.exists())  # rolled back, the new worker handles it
+        t = Task.objects.get()
+        self.assertEqual((t.status, t.attempts), (Task.STATUS_RUNNING, 1))
+
+    def test_reclaimed_stale_tasks_use_up_attempts(self):
+        @tasks.task('test.hangs', max_attempts=2)
+        def hangs(payload):
+            self.calls.append(payload)
+
+        stale = timezone.now() - 2 * tasks.LOCK_TIMEOUT
+        tasks.enqueue('test.hangs', {'n': 1})
+        Task.objects.update(status=Task.STATUS_RUNNING, locked_at=stale)  # its worker died
+        self.assertEqual([t.attempts for t in tasks.claim()], [1])
+
+        Task.objects.update(locked_at=stale)  # and so did the next one
+        tasks.run_pending()
+        t = Task.objects.get()
+        self.assertEqual((t.status, t.attempts), (Task.STATUS_FAILED, 2))
+        self.assertEqual(self.calls, [])
+
+    def test_failures_are_retried_with_backoff(self):
+        @tasks.task('test.flaky', max_attempts=2)
+        def flaky(payload):
+            self.calls.append(payload)
+            raise RuntimeError('boom')
+
+        tasks.enqueue('test.flaky', {'n': 1})
+        tasks.run_pending()
+        t = Task.objects.get()
+        self.assertEqual((t.status, t.attempts), (Task.STATUS_PENDING, 1))
+        self.assertGreater(t.run_at, timezone.now())
+
+        Task.objects.update(run_at=timezone.now())
+        tasks.run_pending()
+        self.assertEqual(Task.objects.get().status, Task.STATUS_FAILED)
+        self.assertEqual(len(self.calls), 2)
+
+
+class AdminScaleTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='root', password='x', email='')
+        self.client.force_login(self.admin)
+        self.market = Market.objects.create(title="Admin", slug="admin-market")
+        self.yes, self.no = CPMMService.initialize_market(self.market)
+
+    def _changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx)
+
+    def test_position_changelist_queries_do_not_grow_with_rows(self):
+        url = '/admin/markets/position/?market=admin-market'
+        Position.objects.create(user=self.admin, outcome=self.yes, shares=1)
+        baseline = self._changelist_queries(url)
+        for i in range(5):
+            Position.objects.create(user=User.objects.create(username=f'holder{i}'), outcome=self.no, shares=1)
+        self.assertEqual(self._changelist_queries(url), baseline)
+
+    def test_input_filter_matches_username(self):
+        Position.objects.create(user=self.admin, outcome=self.yes, shares=1)
+        response = self.client.get('/admin/markets/position/?username=nobody')
+        self.assertEqual(response.context['cl'].result_count, 0)
+
+
+class AuditTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='auditor', password='x')
+        self.market = Market.objects.create(title="Audit", slug="audit-market", status=Market.STATUS_OPEN)
+        self.yes, self.no = CPMMService.initialize_market(self.market)
+        self.client.force_login(self.user)
+        for outcome_id, amount in [(self.yes.id, '25'), (self.no.id, '10'), (self.yes.id, '7.5')]:
+            response = self.client.post('/api/markets/audit-market/trade/', json.dumps({
+                'outcome_id': outcome_id, 'amount': amount,
+            }), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        OrderBookService.place_order(self.user, self.no, Decimal('0.05'), Decimal('20'))
+
+    def tearDown(self):
+        reset_books()
+        cache.clear()
+
+    def _run(self, **kwargs):
+        entries = list(audit.run_audit(chunk_size=1, **kwargs))
+        return entries[:-1], entries[-1]['summary']
+
+    def test_consistent_ledger_has_no_discrepancies(self):
+        issues, summary = self._run()
+        self.assertEqual(issues, [])
+        self.assertEqual(summary['markets'], 1)
+        self.assertEqual(summary['positions'], 2)
+
+    def test_reports_tampered_rows(self):
+        Outcome.objects.filter(pk=self.yes.pk).update(current_price=Decimal('0.9'))
+        UserProfile.objects.filter(user=self.user).update(balance=Decimal('5000'))
+        Position.objects.filter(user=self.user, outcome=self.no).update(shares=Decimal('1'))
+
+        issues, summary = self._run()
+        checks = {issue['check'] for issue in issues}
+        self.assertEqual(checks, {'price_sum', 'pool_price', 'balance', 'position', 'collateral'})
+        balance = next(i for i in issues if i['check'] == 'balance')
+        self.assertEqual(balance['user'], 'auditor')
+        self.assertEqual(Decimal(balance['actual']), Decimal('5000'))
+        self.assertEqual(summary['discrepancies'], len(issues))
+
+
+class ShardingTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='sharded', password='x')
+        self.client.force_login(self.user)
+        sharding.reset_directory_cache()
+
+    def tearDown(self):
+        reset_books()
+        cache.clear()
+
+    def test_placement_is_stable(self):
+        with override_settings(MARKET_SHARDS=['default', 'shard1', 'shard2']):
+            placements = [sharding.shard_for_id(i) for i in range(300)]
+            self.assertEqual(placements, [sharding.shard_for_id(i) for i in range(300)])
+            self.assertEqual(set(placements), {'default', 'shard1', 'shard2'})
+
+    @override_settings(MARKET_SHARDS=['default'])
+    def test_single_shard_uses_default_database_without_directory(self):
+        response = self.client.post('/api/markets/', json.dumps({'title': 'One', 'slug': 'one'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(MarketShard.objects.exists())
+        self.assertEqual(sharding.locate('one'), 'default')
+
+
+@override_settings(MARKET_SHARDS=['default', 'shard1'])
+class MultiShardTests(TestCase):
+    """Runs against the second database the settings add for test runs."""
+    databases = '__all__'
+
+    def setUp(self):
+        sharding.reset_directory_cache()
+        sharding._ids_seeded = False
+        self.user = User.objects.create_user(username='sharded', password='x')
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        reset_books()
+        cache.clear()
+
+    def create(self, slug, **fields):
+        response = self.client.post('/api/markets/', json.dumps(
+            {'title': slug, 'slug': slug, 'status': 'open', **fields}
+        ), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def test_directory_ids_start_above_existing_markets(self):
+        # Created before sharding was turned on: on the default database, outside the directory.
+        old = [Market.objects.create(title=f'old {i}', slug=f'old-{i}') for i in range(3)]
+        created = self.create('new')
+        self.assertGreater(created['id'], max(m.id for m in old))
+        self.assertEqual(MarketShard.objects.get(slug='new').id, created['id'])
+        self.assertEqual(MarketShard.objects.count(), 1)
+
+    def test_scatter_gather_reuses_one_pool(self):
+        def where():
+            return sharding.current_shard(), threading.current_thread().name
+
+        with mock.patch.object(sharding, 'connections') as connections:
+            connections.__getitem__.return_value.in_atomic_block = False  # as outside a test transaction
+            first = sharding.scatter_gather(where)
+            pool = sharding._pool
+            second = sharding.scatter_gather(where)
+        self.assertEqual([alias for alias, _ in first], ['default', 'shard1'])
+        self.assertTrue(all(name.startswith('shard') for _, name in first + second))
+        self.assertIs(sharding._pool, pool)
+
+    def test_exports_and_audit_cover_every_shard(self):
+        slugs = [f'spread-{i}' for i in range(8)]
+        for slug in slugs:
+            self.create(slug)
+        directory = dict(MarketShard.objects.values_list('slug', 'shard'))
+        traded = {alias: next(s for s in slugs if directory[s] == alias) for alias in ('default', 'shard1')}
+        for alias, slug in traded.items():
+            yes = Outcome.objects.using(alias).get(market__slug=slug, name='YES')
+            response = self.client.post(f'/api/markets/{slug}/trade/', json.dumps(
+                {'outcome_id': yes.id, 'amount': 10}
+            ), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+
+        rows = [json.loads(line) for line in exports.iter_export('trades', 'ndjson')]
+        self.assertEqual({row['market_slug'] for row in rows}, set(traded.values()))
+        self.assertEqual([row['created_at'] for row in rows], sorted(row['created_at'] for row in rows))
+        filters = exports.resolve_filters(market_slug=traded['shard1'])
+        self.assertEqual(len(list(exports.iter_export('trades', 'ndjson', **filters))), 1)
+        self.assertEqual(len(simulation.recorded_flow()), 2)
+        out = StringIO()
+        call_command('simulate_amm', '--market', traded['shard1'], '--workers', '1', stdout=out)
+        self.assertTrue(out.getvalue().startswith('1 trades'))
+
+        entries = list(audit.run_audit())
+        self.assertEqual(entries[-1]['summary']['markets'], len(slugs))
+        self.assertEqual(entries[-1]['summary']['discrepancies'], 0)
+
+        for market in Market.objects.using(directory[slugs[1]]).filter(slug=slugs[1]):
+            market.status = Market.STATUS_RESOLVED
+            market.resolved_at = timezone.now() - timedelta(days=60)
+            market.save()
+        self.assertEqual(archive_settled_markets(older_than_days=30), [slugs[1]])
+        self.assertFalse(Market.objects.using(directory[slugs[1]]).filter(slug=slugs[1]).exists())
+        self.assertIsNotNone(get_archived(slugs[1]))
+
+        # The archive (default) commits before the shard delete: a failed delete keeps both copies.
+        market = Market.objects.using('shard1').get(slug=next(s for s in slugs if directory[s] == 'shard1'))
+        with mock.patch.object(events, 'record', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            archive.archive_market(market)
+        self.assertIsNotNone(get_archived(market.slug))
+        self.assertTrue(Market.objects.using('shard1').filter(pk=market.pk).exists())
+        archive.archive_market(market)
+        self.assertFalse(Market.objects.using('shard1').filter(pk=market.pk).exists())
+
+    def test_failed_import_leaves_no_markets_on_other_shards(self):
+        adjust = facets.adjust
+
+        def fail_on_default(deltas):
+            if sharding.current_shard() == 'default':
+                raise IntegrityError('facet count')
+            adjust(deltas)
+
+        rows = [{'title': f'Imported {i}', 'slug': f'imported-{i}'} for i in range(8)]
+        with mock.patch.object(facets, 'adjust', side_effect=fail_on_default):
+            result = importing.import_markets(rows)
+        directory = dict(MarketShard.objects.values_list('slug', 'shard'))
+        on_shard1 = set(Market.objects.using('shard1').values_list('slug', flat=True))
+        # Only the row-by-row retries on shard1 got through, each with its directory entry.
+        self.assertTrue(on_shard1)
+        self.assertEqual(on_shard1, {slug for slug, alias in directory.items() if alias == 'shard1'})
+        self.assertEqual(result['created'], len(on_shard1))
+        self.assertEqual(len(result['errors']), len(rows) - len(on_shard1))
+        self.assertEqual(Outcome.objects.using('shard1').count(), 2 * len(on_shard1))
+
+    def test_replicas_follow_the_default_database(self):
+        Tag.objects.create(name='politics')
+        stale = User.objects.create_user(username='stale', password='x')
+        self.assertTrue(User.objects.using('shard1').filter(pk=stale.pk).exists())
+        stale.delete()
+        self.assertFalse(User.objects.using('shard1').filter(pk=stale.pk).exists())
+
+        # Rows that bypassed the signals: missing, renamed or left over on the shard.
+        User.objects.using('shard1').filter(pk=self.user.pk).delete()
+        Tag.objects.filter(name='politics').update(name='elections')
+        User.objects.using('shard1').create(username='orphan', password='!')
+        self.assertEqual(sharding.sync_replicas(chunk_size=1), {'shard1': {'created': 1, 'updated': 1, 'deleted': 1}})
+        self.assertEqual(
+            list(User.objects.using('shard1').values_list('pk', 'username')),
+            list(User.objects.values_list('pk', 'username')),
+        )
+        self.assertEqual(list(Tag.objects.using('shard1').values_list('name', flat=True)), ['elections'])
+        self.assertEqual(sharding.sync_replicas(), {'shard1': {'created': 0, 'updated': 0, 'deleted': 0}})
+
+    def test_markets_spread_over_shards(self):
+        slugs = [f'sharded-{i}' for i in range(12)]
+        for slug in slugs:
+            response = self.client.post('/api/markets/', json.dumps(
+                {'title': slug, 'slug': slug, 'status': 'open', 'tags': ['sharded']}
+            ), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+
+        directory = dict(MarketShard.objects.values_list('slug', 'shard'))
+        self.assertGreater(len(set(directory.values())), 1)
+        for slug, alias in directory.items():
+            self.assertTrue(Market.objects.using(alias).filter(slug=slug).exists())
+
+        # Trades, orders and positions land on the market's shard.
+        slug = slugs[0]
+        yes = Outcome.objects.using(directory[slug]).get(market__slug=slug, name='YES')
+        response = self.client.post(f'/api/markets/{slug}/trade/', json.dumps({'outcome_id': yes.id, 'amount': 10}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Position.objects.using(directory[slug]).filter(user=self.user).count(), 1)
+
+        listed = self.client.get('/api/markets/?tag=sharded').json()
+        self.assertEqual({m['slug'] for m in listed}, set(slugs))
+        self.assertEqual(facets.rebuild(), 2)
+        self.assertEqual(facets.counts()['sharded'], {'open': len(slugs)})
+        portfolio = self.client.get('/api/portfolio/').json()
+        self.assertEqual(len(portfolio['created_markets']), len(slugs))
+        self.assertEqual([p['market_slug'] for p in portfolio['positions']], [slug])
+
+
+
+class PortfolioHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='historian', password='x')
+        self.other = User.objects.create_user(username='idle', password='x')
+        self.market = Market.objects.create(title="History", slug="history", status=Market.STATUS_OPEN)
+        self.yes, self.no = CPMMService.initialize_market(self.market)
+        CPMMService.execute_buy(self.user, self.yes, Decimal('10'))
+        UserProfile.objects.filter(user=self.user).update(balance=Decimal('990'))
+
+    def test_snapshot_values_positions_and_history_reads_snapshots(self):
+        today = timezone.localdate()
+        yesterday = today - timedelta(days=1)
+        history.snapshot_portfolios(date=yesterday, chunk_size=1)
+
+        # Resolution values the winning shares at 1.
+        self.market.status = Market.STATUS_RESOLVED
+        self.market.winning_outcome = self.yes
+        self.market.save()
+        history.snapshot_portfolios(date=today, chunk_size=1)
+        history.snapshot_portfolios(date=today, chunk_size=1)  # re-run overwrites
+
+        self.assertEqual(PortfolioSnapshot.objects.count(), 4)
+        shares = Position.objects.get(user=self.user).shares
+        snap = PortfolioSnapshot.objects.get(user=self.user, date=today)
+        self.assertEqual(snap.positions, shares)
+
+        self.client.force_login(self.user)
+        with self.assertNumQueries(2):  # user (session is cached), snapshots
+            data = self.client.get('/api/portfolio/history/?days=7').json()
+        self.assertEqual([h['date'] for h in data['history']], [yesterday.isoformat(), today.isoformat()])
+        self.assertIsNone(data['history'][0]['change'])
+        self.assertAlmostEqual(data['history'][1]['pnl'], float(shares - 10), places=3)
+
+        # Ranges beyond MAX_DAYS are clamped rather than overflowing the date arithmetic.
+        response = self.client.get('/api/portfolio/history/?days=99999999999')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['history']), 2)
+
+
+class EventLogTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='sourced', password='x')
+        self.client.force_login(self.user)
+        self.client.post('/api/markets/', json.dumps({'title': 'Events', 'slug': 'events', 'status': 'open'}),
+                         content_type='application/json')
+        self.market = Market.objects.get(slug='events')
+        self.yes = self.market.outcomes.get(name='YES')
+        self.no = self.market.outcomes.get(name='NO')
+
+    def tearDown(self):
+        reset_books()
+        cache.clear()
+
+    def _trade(self, outcome, amount):
+        response = self.client.post('/api/markets/events/trade/', json.dumps({'outcome_id': outcome.id, 'amount': amount}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def _live_state(self):
+        return (
+            list(Outcome.objects.order_by('id').values_list('pool_balance', 'current_price')),
+            list(Position.objects.order_by('id').values_list('shares', flat=True)),
+            UserProfile.objects.get(user=self.user).balance,
+        )
+
+    def test_rebuild_restores_corrupted_state(self):
+        self._trade(self.yes, '12.5')
+        self._trade(self.no, '3.3333')
+        OrderBookService.place_order(self.user, self.no, Decimal('0.05'), Decimal('7'))
+        expected = self._live_state()
+        self.assertEqual(events.rebuild(dry_run=True)['outcomes'], 0)
+
+        Outcome.objects.filter(pk=self.yes.pk).update(pool_balance=Decimal('1'))
+        Position.objects.filter(outcome=self.no).update(shares=Decimal('999'))
+        UserProfile.objects.filter(user=self.user).update(balance=Decimal('0'))
+
+        report = events.rebuild()
+        self.assertEqual((report['outcomes'], report['positions'], report['balances']), (1, 1, 1))
+        self.assertEqual(self._live_state(), expected)
+
+    def test_rebuild_replays_only_events_after_latest_snapshot(self):
+        self._trade(self.yes, '10')
+        snapshot = events.take_snapshot(now=timezone.now() + events.SNAPSHOT_LAG)
+        self.assertEqual(snapshot.seq, Event.objects.order_by('-id').first().id)
+
+        self._trade(self.no, '5')
+        self.client.post('/api/markets/events/resolve/', json.dumps({'outcome_id': self.no.id}),
+                         content_type='application/json')
+        response = self.client.post('/api/markets/events/redeem/', '{}', content_type='application/json')
+        self.assertEqual(response.json()['status'], 'redeemed')
+        expected = self._live_state()
+
+        Position.objects.update(shares=Decimal('0'))
+        report = events.rebuild()
+        self.assertEqual(report['snapshot_seq'], snapshot.seq)
+        self.assertEqual(report['replayed'], Event.objects.filter(id__gt=snapshot.seq).count())
+        self.assertEqual(self._live_state(), expected)
+
+
+class MarketPageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='x')
+        self.other = User.objects.create_user(username='whale', password='x')
+        self.market = Market.objects.create(title="Page", slug="paged", status=Market.STATUS_OPEN)
+        self.yes, self.no = CPMMService.initialize_market(self.market)
+        CPMMService.execute_buy(self.other, self.yes, Decimal('50'))
+        CPMMService.execute_buy(self.user, self.no, Decimal('5'))
+        for i in range(3):
+            Comment.objects.create(market=self.market, user=self.other, text=f'comment {i}')
+        self.client.force_login(self.user)
+        self.client.get('/api/auth/me/')  # warm the session cache
+
+    def test_all_sections_in_constant_queries(self):
+        with self.assertNumQueries(7):  # user, market + counts, outcomes, tags, ledger, comments, position
+            data = self.client.get('/api/markets/paged/page/?comments_limit=2').json()
+        self.assertEqual(data['market']['slug'], 'paged')
+        self.assertEqual([e['username'] for e in data['ledger']['entries']], ['whale', 'reader'])
+        self.assertEqual(data['ledger']['total_bettors'], 2)
+        self.assertEqual([c['text'] for c in data['comments']['items']], ['comment 2', 'comment 1'])
+        self.assertEqual(data['comments']['count'], 3)
+        self.assertEqual(data['position'][0]['outcome'], 'NO')
+        self.assertEqual(data['me']['username'], 'reader')
+
+        older = self.client.get(f'/api/markets/paged/page/?include=comments&comments_limit=2'
+                                f'&comments_before={data["comments"]["next_before"]}').json()
+        self.assertEqual(list(older), ['comments'])
+        self.assertEqual([c['text'] for c in older['comments']['items']], ['comment 0'])
+        self.assertIsNone(older['comments']['next_before'])
+
+    def test_include_selects_sections(self):
+        response = self.client.get('/api/markets/paged/page/?include=me,position')
+        self.assertEqual(set(response.json()), {'me', 'position'})
+        self.assertEqual(self.client.get('/api/markets/paged/page/?include=nope').status_code, 400)
+        self.assertEqual(self.client.get('/api/markets/missing/page/').status_code, 404)
+
+    def test_limits_below_one_are_rejected(self):
+        for query in ('comments_limit=-1', 'ledger_limit=-5', 'ledger_limit=0'):
+            self.assertEqual(self.client.get(f'/api/markets/paged/page/?{query}').status_code, 400)
+
+
+class PriceAlertTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        alerts.reset_indexes()
+        self.watcher = User.objects.create_user(username='watcher', password='x')
+        self.trader = User.objects.create_user(username='trader', password='x')
+        self.market = Market.objects.create(title="Alerts", slug="alerts", status=Market.STATUS_OPEN)
+        self.yes, self.no = CPMMService.initialize_market(self.market)
+
+    def test_threshold_index_returns_crossed_slice(self):
+        index = alerts.ThresholdIndex()
+        for alert_id, threshold in [(1, '0.55'), (2, '0.60'), (3, '0.60'), (4, '0.70')]:
+            index.add(alert_id, PriceAlert.DIRECTION_ABOVE, Decimal(threshold))
+        index.add(5, PriceAlert.DIRECTION_BELOW, Decimal('0.40'))
+
+        self.assertEqual(index.crossed(Decimal('0.50'), Decimal('0.60')), [1, 2, 3])
+        self.assertEqual(index.crossed(Decimal('0.60'), Decimal('0.65')), [])
+        self.assertEqual(index.crossed(Decimal('0.65'), Decimal('0.40')), [5])
+        self.assertTrue(index.remove(4, PriceAlert.DIRECTION_ABOVE, Decimal('0.70')))
+        self.assertEqual(len(index), 0)
+
+    def test_trade_crossing_threshold_notifies_once(self):
+        up = alerts.create_alert(self.watcher, self.yes, PriceAlert.DIRECTION_ABOVE, Decimal('0.60'))
+        down = alerts.create_alert(self.watcher, self.no, PriceAlert.DIRECTION_BELOW, Decimal('0.40'))
+        far = alerts.create_alert(self.watcher, self.yes, PriceAlert.DIRECTION_ABOVE, Decimal('0.95'))
+
+        CPMMService.execute_buy(self.trader, self.yes, Decimal('50'))  # YES 0.5 -> 0.64
+        CPMMService.execute_buy(self.trader, self.yes, Decimal('5'))
+        self.assertEqual(Task.objects.filter(name='alerts.fired').count(), 1)
+
+        tasks.run_pending()
+        self.assertEqual(
+            set(PriceAlert.objects.filter(status=PriceAlert.STATUS_TRIGGERED).values_list('id', flat=True)),
+            {up.id, down.id},
+        )
+        far.refresh_from_db()
+        self.assertEqual(far.status, PriceAlert.STATUS_ACTIVE)
+        notifications = Notification.objects.filter(user=self.watcher)
+        self.assertEqual(notifications.count(), 2)
+        self.assertEqual(notifications.filter(data__outcome='YES').get().data['market'], 'alerts')
+
+    def test_rolled_back_alert_never_fires(self):
+        try:
+            with transaction.atomic():
+                alerts.create_alert(self.watcher, self.yes, PriceAlert.DIRECTION_ABOVE, Decimal('0.60'))
+                raise ValueError
+        except ValueError:
+            pass
+        CPMMService.execute_buy(self.trader, self.yes, Decimal('50'))
+        self.assertFalse(Task.objects.filter(name='alerts.fired').exists())
+
+    def test_other_workers_changes_are_replayed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = alerts.create_alert(self.watcher, self.yes, PriceAlert.DIRECTION_ABOVE, Decimal('0.60'))
+        ours = alerts.get_index(self.yes.id)
+
+        alerts.reset_indexes()  # another worker
+        with self.captureOnCommitCallbacks(execute=True):
+            alerts.cancel_alert(first)
+            alerts.create_alert(self.watcher, self.yes, PriceAlert.DIRECTION_BELOW, Decimal('0.30'))
+
+        alerts._indexes[(DEFAULT_DB_ALIAS, self.yes.id)] = ours
+        with self.assertNumQueries(0):
+            self.assertIs(alerts.get_index(self.yes.id), ours)
+        self.assertEqual(ours.crossing(Decimal('0.50'), Decimal('0.70')), (PriceAlert.DIRECTION_ABOVE, []))
+        self.assertEqual(len(ours), 1)
+
+    def test_alert_endpoints(self):
+        self.client.force_login(self.watcher)
+        url = '/api/markets/alerts/alerts/'
+        response = self.client.post(url, data=json.dumps(
+            {'outcome_id': self.yes.id, 'direction': 'sideways', 'threshold': '0.6'}
+        ), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(url, data=json.dumps(
+            {'outcome_id': self.yes.id, 'direction': 'above', 'threshold': '0.6'}
+        ), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        alert_id = response.json()['id']
+        self.assertEqual(len(self.client.get(url).json()['alerts']), 1)
+
+        response = self.client.post(f'{url}{alert_id}/cancel/')
+        self.assertEqual(response.json()['status'], PriceAlert.STATUS_CANCELLED)
+        CPMMService.execute_buy(self.trader, self.yes, Decimal('50'))
+        self.assertFalse(Task.objects.filter(name='alerts.fired').exists())
+
+        Notification.objects.create(user=self.watcher, kind='price_alert', message='hello')
+        self.assertEqual(len(self.client.get('/api/notifications/?unread=1').json()['notifications']), 1)
+        self.assertEqual(self.client.post('/api/notifications/', content_type='application/json').json()['marked_read'], 1)
+        self.assertEqual(self.client.get('/api/notifications/?unread=1').json()['notifications'], [])
+        for ids in (['a'], [1.5], 'x'):
+            response = self.client.post('/api/notifications/', json.dumps({'ids': ids}), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='curator', password='x')
+        self.client.force_login(self.user)
+
+    def create(self, slug, tags, status=Market.STATUS_OPEN):
+        response = self.client.post('/api/markets/', data=json.dumps(
+            {'title': slug, 'slug': slug, 'status': status, 'tags': tags}
+        ), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def assert_counts_match_rebuild(self):
+        live = set(FacetCount.objects.filter(count__gt=0).values_list('tag', 'status', 'count'))
+        facets.rebuild()
+        self.assertEqual(live, set(FacetCount.objects.values_list('tag', 'status', 'count')))
+
+    def test_counts_follow_create_edit_resolve_delete(self):
+        self.assertEqual(self.create('rain', ['Weather', 'uk'])['tags'], ['uk', 'weather'])
+        self.create('snow', ['weather'])
+        self.create('vote', ['politics', 'uk'], status=Market.STATUS_DRAFT)
+
+        counts = facets.counts()
+        self.assertEqual(counts['weather'], {'open': 2})
+        self.assertEqual(counts['uk'], {'open': 1, 'draft': 1})
+        self.assertEqual(counts[facets.ALL], {'open': 2, 'draft': 1})
+
+        rain = Market.objects.get(slug='rain')
+        with self.captureOnCommitCallbacks(execute=True):  # invalidates the cached counts
+            self.client.put('/api/markets/vote/', data=json.dumps({'status': 'open', 'tags': ['politics']}),
+                            content_type='application/json')
+            self.client.post('/api/markets/rain/resolve/', data=json.dumps({'outcome_id': rain.outcomes.first().id}),
+                             content_type='application/json')
+            self.client.delete('/api/markets/snow/delete/')
+
+        counts = facets.counts()
+        self.assertNotIn('open', counts['weather'])
+        self.assertEqual(counts['weather'], {'resolved': 1})
+        self.assertEqual(counts['uk'], {'resolved': 1})
+        self.assertEqual(counts['politics'], {'open': 1})
+        self.assert_counts_match_rebuild()
+
+        data = self.client.get('/api/tags/?status=resolved').json()
+        self.assertEqual([t['name'] for t in data['tags']], ['uk', 'weather'])
+        self.assertEqual(data['statuses'], {'open': 1, 'resolved': 1})
+
+    def test_scheduler_and_import_adjust_counts(self):
+        self.create('later', ['sports'], status=Market.STATUS_DRAFT)
+        Market.objects.filter(slug='later').update(opens_at=timezone.now() - timedelta(minutes=1))
+        scheduler.run_due()
+        importing.import_markets([{'title': 'Cup', 'slug': 'cup', 'status': 'open', 'tags': 'sports, Cup'}])
+
+        self.assertEqual(facets.counts()['sports'], {'open': 2})
+        self.assert_counts_match_rebuild()
+
+    def test_migration_seeds_counts_for_existing_markets(self):
+        seed = import_module('markets.migrations.0020_seed_facet_counts').seed_facet_counts
+        self.create('rain', ['weather'])
+        Market.objects.create(title='Old', slug='old', status=Market.STATUS_RESOLVED)  # predates the counts
+        FacetCount.objects.filter(tag='weather').delete()
+
+        seed(apps, mock.Mock(connection=connection))
+        self.assertEqual(facets.counts()[facets.ALL], {'open': 1, 'resolved': 1})
+        self.assertEqual(facets.counts()['weather'], {'open': 1})
+
+    def test_edit_rejects_unknown_status(self):
+        self.create('rain', ['weather'])
+        response = self.client.patch('/api/markets/rain/', data=json.dumps({'status': 'bogus'}),
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('status', response.json()['errors'])
+        self.assertEqual(Market.objects.get(slug='rain').status, Market.STATUS_OPEN)
+
+    def test_list_filters(self):
+        self.create('rain', ['weather'])
+        self.create('vote', ['politics'], status=Market.STATUS_DRAFT)
+        self.assertEqual([m['slug'] for m in self.client.get('/api/markets/?tag=weather').json()], ['rain'])
+        self.assertEqual([m['slug'] for m in self.client.get('/api/markets/?tag=Weather%20').json()], ['rain'])
+        self.assertEqual([m['slug'] for m in self.client.get('/api/markets/?status=draft').json()], ['vote'])
+        self.assertEqual(self.client.get('/api/markets/?status=politics&tag=weather').status_code, 400)
+        response = self.client.post('/api/markets/', data=json.dumps(
+            {'title': 'Bad', 'slug': 'bad', 'tags': 'ok'}
+        ), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post('/api/markets/', data=json.dumps(
+            {'title': 'Bad', 'slug': 'bad2', 'tags': [1]}
+        ), content_type='application/json')
+        self.assertIn('tags', response.json()['errors'])
+
+
+class SparseFieldsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='ticker', password='x')
+        for slug in ('alpha', 'beta'):
+            market = Market.objects.create(title=slug, slug=slug, description='long text', created_by=self.user,
+                                           status=Market.STATUS_OPEN)
+            CPMMService.initialize_market(market)
+
+    def test_list_fetches_only_requested_fields(self):
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get('/api/markets/?fields=slug,outcomes').json()
+        self.assertEqual(len(queries), 3)  # change sequence number, markets, outcomes
+        self.assertNotIn('description', queries[1]['sql'])
+        self.assertNotIn('auth_user', queries[1]['sql'])
+        self.assertEqual([set(m) for m in data], [{'slug', 'outcomes'}] * 2)
+        self.assertEqual(set(data[0]['outcomes'][0]), {'id', 'name', 'price', 'pool'})
+
+        full = self.client.get('/api/markets/').json()
+        self.assertEqual(full[0]['created_by'], 'ticker')
+        self.assertEqual(len(full[0]), len(views.MARKET_FIELDS))
+        self.assertEqual(self.client.get('/api/markets/?fields=slug,secret').status_code, 400)
+
+    def test_detail_and_create_project_fields(self):
+        with self.assertNumQueries(1):
+            data = self.client.get('/api/markets/alpha/?fields=slug,created_by,status').json()
+        self.assertEqual(data, {'slug': 'alpha', 'status': 'open', 'created_by': 'ticker'})
+
+        self.client.force_login(self.user)
+        response = self.client.post('/api/markets/?fields=id,slug', data=json.dumps(
+            {'title': 'Gamma', 'slug': 'gamma'}
+        ), content_type='application/json')
+        self.assertEqual(set(response.json()), {'id', 'slug'})
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.staff = User.objects.create_user(username='ops', password='x', is_staff=True)
+        market = Market.objects.create(title="Slow", slug="slow", status=Market.STATUS_OPEN)
+        CPMMService.initialize_market(market)
+
+    def profiling_settings(self, **kwargs):
+        return override_settings(PROFILE_ENABLED=True, PROFILE_DIR=self.dir.name, PROFILE_KEEP=2, **kwargs)
+
+    def test_disabled_by_default(self):
+        with override_settings(PROFILE_DIR=self.dir.name):
+            self.client.get('/api/markets/slow/ledger/')
+            self.assertEqual(profiling.summaries(), [])
+
+    def test_sampled_requests_keep_newest_profiles(self):
+        with self.profiling_settings(PROFILE_SAMPLE_RATE=1.0, PROFILE_SLOW_MS=0):
+            for _ in range(3):
+                self.client.get('/api/markets/slow/ledger/')
+            summaries = profiling.summaries()
+            profile = profiling.load(summaries[0]['id'])
+        self.assertEqual(len(summaries), 2)
+        self.assertEqual(profile['reason'], 'sampled')
+        self.assertEqual(profile['path'], '/api/markets/slow/ledger/')
+        self.assertGreater(profile['query_count'], 0)
+        self.assertTrue(profile['functions'])
+
+    def test_slow_requests_are_stack_sampled(self):
+        original = views.get_object_or_404
+
+        def slow_lookup(*args, **kwargs):
+            time.sleep(0.1)
+            return original(*args, **kwargs)
+
+        with self.profiling_settings(PROFILE_SAMPLE_RATE=0, PROFILE_SLOW_MS=50), \
+                mock.patch.object(views, 'get_object_or_404', slow_lookup):
+            self.client.get('/api/markets/slow/ledger/')
+            self.client.force_login(self.staff)
+            listed = self.client.get('/api/profiles/').json()['profiles']
+            self.assertEqual([p['reason'] for p in listed], ['slow'])
+            profile = self.client.get(f'/api/profiles/{listed[0]["id"]}/').json()
+        self.assertTrue(any('slow_lookup' in s['stack'] for s in profile['stacks']))
+        self.assertEqual(self.client.get('/api/profiles/../etc/').status_code, 404)
+
+
+class TrendingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        trending.reset_local()
+        self.user = User.objects.create_user(username='crowd', password='x')
+        self.markets = {}
+        for slug in ('quiet', 'busy', 'chatty', 'done'):
+            market = Market.objects.create(title=slug, slug=slug, status=Market.STATUS_OPEN)
+            self.markets[slug] = market
+            CPMMService.initialize_market(market)
+
+    def test_scores_decay_lazily(self):
+        now = 1_000_000.0
+        trending.add({(1, 'default'): 4.0}, now=now)
+        trending.add({(1, 'default'): 4.0}, now=now + trending.HALF_LIFE)
+        row = TrendingScore.objects.get(market_id=1)
+        # 4 halved once, plus 4 fresh.
+        self.assertAlmostEqual(trending.score_at(row.log_score, now + trending.HALF_LIFE), 6.0)
+        self.assertAlmostEqual(trending.score_at(row.log_score, now + 2 * trending.HALF_LIFE), 3.0)
+
+    def test_feed_ranks_open_markets_by_activity(self):
+        self.client.force_login(self.user)
+        for slug, amount in [('busy', 200), ('busy', 200), ('done', 500), ('quiet', 1)]:
+            outcome = self.markets[slug].outcomes.get(name='YES')
+            self.client.post(f'/api/markets/{slug}/trade/', data=json.dumps(
+                {'outcome_id': outcome.id, 'amount': amount}
+            ), content_type='application/json')
+        for _ in range(4):
+            self.client.post('/api/markets/chatty/comments/', data=json.dumps({'text': 'hi'}),
+                             content_type='application/json')
+        self.markets['done'].status = Market.STATUS_RESOLVED
+        self.markets['done'].save()
+        tasks.run_pending()
+        tasks.run_pending()  # trending.trades, queued by the stats batch
+
+        data = self.client.get('/api/trending/?fields=slug').json()
+        self.assertEqual([m['slug'] for m in data['markets']], ['busy', 'chatty', 'quiet'])
+        # busy: 400 USD + one trader, chatty: four comments.
+        self.assertAlmostEqual(data['markets'][0]['score'], 5.0, places=2)
+        self.assertAlmostEqual(data['markets'][1]['score'], 2.0, places=2)
+        self.assertEqual(set(data['markets'][0]), {'slug', 'score'})
+
+        # Served from memory until the snapshot expires.
+        anonymous = Client()
+        with self.assertNumQueries(1):  # the market rows
+            data = anonymous.get('/api/trending/?fields=slug&limit=1').json()
+        self.assertEqual([m['slug'] for m in data['markets']], ['busy'])
+
+
+class DatasetGeneratorTests(TestCase):
+    def test_generates_requested_rows_without_signals(self):
+        created = datagen.generate(
+            40, 6, 120, 30, prefix='syn', status_mix={Market.STATUS_OPEN: 1.0}, tags=4, seed=7, workers=1,
+        )
+        self.assertEqual(created['positions'], 120)
+        users = User.objects.filter(username__startswith='syn')
+        self.assertEqual(users.count(), 40)
+        self.assertEqual(UserProfile.objects.filter(user__in=users).count(), 40)
+        self.assertTrue(users.first().check_password('password'))
+        self.assertEqual(Market.objects.filter(slug__startswith='syn-market-').count(), 6)
+        self.assertEqual(Position.objects.filter(user__in=users).count(), 120)
+        self.assertEqual(Comment.objects.filter(user__in=users).count(), 30)
+        # Markets went through the importer: facet counts and the event log know them.
+        self.assertEqual(facets.counts()[facets.ALL][Market.STATUS_OPEN], 6)
+        self.assertEqual(Event.objects.filter(kind='market.create').count(), 6)
+
+        with self.assertRaises(ValueError):
+            datagen.generate(1, 1, 0, 0, prefix='syn', workers=1)
+
+    def test_popularity_is_heavy_tailed(self):
+        weights = np.sort(datagen.popularity(10_000, 1.1, np.random.default_rng(1)))[::-1]
+        self.assertGreater(weights[:100].sum() / weights.sum(), 0.5)
+        self.assertEqual(len(set(datagen.popularity(100, 0, np.random.default_rng(1)))), 1)
+
+
+class PasswordPoolTests(TestCase):
+    """Login and signup hash in the process pool; the pool is shared by the tests."""
+
+    @classmethod
+    def tearDownClass(cls):
+        passwords.shutdown()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        passwords.forget_failures()
+        self.user = User.objects.create_user(username='alice', password='correct horse')
+
+    def login(self, password, client=None):
+        return (client or self.client).post('/api/auth/login/', data=json.dumps(
+            {'username': 'alice', 'password': password}
+        ), content_type='application/json')
+
+    def test_login_checks_password_in_pool(self):
+        response = self.login('correct horse')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['username'], 'alice')
+        self.assertEqual(response.json()['balance'], 1000.0)
+        self.assertEqual(self.client.get('/api/auth/me/').json()['id'], self.user.id)
+        self.assertEqual(self.login('wrong').status_code, 401)
+
+    def test_repeated_bad_credentials_skip_hashing(self):
+        with mock.patch.object(passwords, 'verify', wraps=passwords.verify) as verify:
+            self.assertEqual(self.login('wrong').status_code, 401)
+            self.assertEqual(self.login('wrong').status_code, 401)
+            self.assertEqual(verify.call_count, 1)
+
+            # A new password invalidates what was learned about the old one.
+            self.user.set_password('wrong')
+            self.user.save()
+            self.assertEqual(self.login('wrong').status_code, 200)
+            self.assertEqual(verify.call_count, 2)
+
+    def test_login_goes_through_authenticate(self):
+        failed = []
+        handler = lambda sender, credentials, **kwargs: failed.append(credentials['username'])
+        user_login_failed.connect(handler)
+        try:
+            self.assertEqual(self.login('wrong').status_code, 401)
+            self.assertEqual(self.login('wrong').status_code, 401)  # known bad, still reported
+        finally:
+            user_login_failed.disconnect(handler)
+        self.assertEqual(failed, ['alice', 'alice'])
+
+        self.assertEqual(self.login('correct horse').status_code, 200)
+        self.assertEqual(self.client.session[BACKEND_SESSION_KEY], 'markets.backends.PoolBackend')
+
+        # Sessions logged in through the plain ModelBackend still resolve.
+        client = Client()
+        client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+        self.assertEqual(client.get('/api/auth/me/').json()['id'], self.user.id)
+
+    def test_full_queue_is_rejected(self):
+        with override_settings(AUTH_HASH_QUEUE=0):
+            response = self.login('correct horse')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    @override_settings(AUTH_HASH_HOST_LIMIT=2)
+    def test_host_wide_slots_are_shared_through_the_cache(self):
+        self.assertEqual(self.login('correct horse').status_code, 200)
+        self.assertIsNone(cache.get('passwords:slot:0'))  # released when the hash finished
+
+        # Another server process holds every slot.
+        cache.set_many({'passwords:slot:0': 1, 'passwords:slot:1': 1})
+        self.assertEqual(self.login('correct horse').status_code, 503)
+        cache.delete('passwords:slot:1')
+        self.assertEqual(self.login('correct horse').status_code, 200)
+
+    def test_non_object_body_is_rejected(self):
+        for url in ('/api/auth/login/', '/api/auth/signup/'):
+            response = self.client.post(url, data='["alice"]', content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_signup_hashes_in_pool_and_logs_in(self):
+        client = Client()
+        response = client.post('/api/auth/signup/', data=json.dumps(
+            {'username': 'bob', 'password': 'hunter22', 'email': 'bob@EXAMPLE.com'}
+        ), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        bob = User.objects.get(username='bob')
+        self.assertTrue(bob.check_password('hunter22'))
+        self.assertEqual(bob.email, 'bob@example.com')
+        self.assertTrue(UserProfile.objects.filter(user=bob).exists())
+        self.assertEqual(client.get('/api/auth/me/').json()['username'], 'bob')
+
+        taken = client.post('/api/auth/signup/', data=json.dumps(
+            {'username': 'bob', 'password': 'x'}
+        ), content_type='application/json')
+        self.assertEqual(taken.status_code, 400)
+
+
+@mock.patch.object(events, 'SYNC_LAG', timedelta(0))
+class DeltaSyncTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(username='ops', password='x', is_staff=True)
+        self.client.force_login(self.admin)
+        for slug in ('steady', 'traded', 'edited', 'doomed'):
+            self.create(slug)
+
+    def create(self, slug):
+        response = self.client.post('/api/markets/', data=json.dumps(
+            {'title': slug, 'slug': slug, 'status': 'open'}
+        ), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+    def sync(self, since, query=''):
+        return self.client.get(f'/api/markets/?since={since}&fields=slug,status{query}').json()
+
+    def test_since_returns_only_changes_and_tombstones(self):
+        full = self.client.get('/api/markets/')
+        seq = int(full['X-Change-Seq'])
+        self.assertEqual(seq, Event.objects.latest('id').id)
+
+        outcome = Market.objects.get(slug='traded').outcomes.get(name='YES')
+        self.client.post('/api/markets/traded/trade/', data=json.dumps(
+            {'outcome_id': outcome.id, 'amount': 10}
+        ), content_type='application/json')
+        self.client.put('/api/markets/edited/', data=json.dumps({'title': 'Edited'}),
+                        content_type='application/json')
+        doomed_id = Market.objects.get(slug='doomed').id
+        self.client.delete('/api/markets/doomed/delete/')
+        self.create('fresh')
+
+        data = self.sync(seq)
+        self.assertEqual([m['slug'] for m in data['markets']], ['traded', 'edited', 'fresh'])
+        self.assertEqual(data['removed'], [{'id': doomed_id, 'slug': 'doomed'}])
+        self.assertFalse(data['more'])
+        self.assertEqual(data['seq'], Event.objects.latest('id').id)
+
+        self.assertEqual(self.sync(data['seq']), {'seq': data['seq'], 'more': False, 'markets': [], 'removed': []})
+
+    def test_markets_leaving_the_filter_become_tombstones(self):
+        seq = events.latest_seq()
+        market = Market.objects.get(slug='edited')
+        self.client.post('/api/markets/edited/resolve/', data=json.dumps(
+            {'outcome_id': market.outcomes.get(name='YES').id}
+        ), content_type='application/json')
+        data = self.sync(seq, '&status=open')
+        self.assertEqual(data['markets'], [])
+        self.assertEqual(data['removed'], [{'id': market.id, 'slug': 'edited'}])
+
+    def test_paging_and_bad_sequence_numbers(self):
+        with mock.patch.object(events, 'SYNC_BATCH', 3):
+            data = self.sync(0)
+            self.assertTrue(data['more'])
+            page = self.sync(data['seq'])
+        # Each market has a create and an init event.
+        self.assertEqual([m['slug'] for m in data['markets']], ['steady', 'traded'])
+        self.assertEqual(page['markets'][0]['slug'], 'traded')
+        self.assertEqual(self.client.get('/api/markets/?since=x').status_code, 400)
+        self.assertEqual(self.client.get(f'/api/markets/?since={events.latest_seq() + 1}').status_code, 410)
+
+    def test_recent_changes_are_not_covered_by_seq(self):
+        seq = events.latest_seq()
+        self.create('late')
+        with mock.patch.object(events, 'SYNC_LAG', timedelta(minutes=5)):
+            data = self.sync(seq)
+        self.assertEqual([m['slug'] for m in data['markets']], ['late'])
+        self.assertEqual(data['seq'], seq)
+
+    def test_paging_moves_forward_up_to_the_lagged_mark(self):
+        seen = []
+        since = 0
+        with mock.patch.object(events, 'SYNC_BATCH', 3):
+            while True:
+                data = self.sync(since)
+                seen += [m['slug'] for m in data['markets']]
+                if not data['more']:
+                    break
+                self.assertGreater(data['seq'], since)
+                since = data['seq']
+        self.assertEqual(set(seen), {'steady', 'traded', 'edited', 'doomed'})
+
+        # A full page of changes too recent to cover stops at the mark instead.
+        with mock.patch.object(events, 'SYNC_BATCH', 3), \
+                mock.patch.object(events, 'SYNC_LAG', timedelta(minutes=5)):
+            self.assertEqual(self.sync(0), {'seq': 0, 'more': False, 'markets': [], 'removed': []})
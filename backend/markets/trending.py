@@ -0,0 +1,172 @@
+"""
+Trending markets.
+
+Every market's score is a sum of activity weights, each decaying
+exponentially with a half-life of HALF_LIFE seconds:
+
+    trade        VOLUME_WEIGHT per USD traded
+    new trader   TRADER_WEIGHT the first time a user trades the market
+                 within a half-life
+    comment      COMMENT_WEIGHT
+
+Decay is never applied to stored rows. TrendingScore holds
+log(score) + RATE * t, which ages identically for every market, so rows
+rank correctly as stored and adding activity w at time t is
+logaddexp(log_score, log(w) + RATE * t). The current score is
+exp(log_score - RATE * now). Trades are folded in by the trending.trades
+task, which the trade.executed stats task queues for each batch, and
+comments by the comment.posted task, all off the request path.
+
+The feed reads a ranking of the top TOP_N open markets. It is rebuilt
+from the indexed log_score column at most every SNAPSHOT_EVERY seconds
+by whichever worker finds it stale, shared through the cache, and kept
+in each worker's memory for LOCAL_TTL seconds.
+"""
+import math
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+
+from . import sharding, tasks
+from .models import Market, TrendingScore
+
+HALF_LIFE = 6 * 3600
+RATE = math.log(2) / HALF_LIFE
+
+VOLUME_WEIGHT = 0.01
+TRADER_WEIGHT = 1.0
+COMMENT_WEIGHT = 0.5
+
+TOP_N = 100
+CANDIDATES = 3 * TOP_N  # scored markets read per snapshot; closed ones are skipped
+SNAPSHOT_EVERY = 30
+LOCAL_TTL = 5
+MIN_SCORE = 0.001  # rows decayed below this are pruned at snapshot time
+
+SNAPSHOT_KEY = 'trending:snapshot'
+LOCK_KEY = 'trending:rebuilding'
+
+_local = {'fetched': 0.0, 'snapshot': None}
+_local_lock = threading.Lock()
+
+
+def _logaddexp(a, b):
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def score_at(log_score, now=None):
+    """Decayed score at `now` (unix time) of a stored log_score."""
+    return math.exp(log_score - RATE * (now or time.time()))
+
+
+def add(weights, now=None):
+    """
+    Add activity {(market_id, shard): weight} at `now` (unix time). One
+    select and one write per batch, whatever the number of markets.
+    """
+    now = now or time.time()
+    weights = {key: w for key, w in weights.items() if w > 0}
+    if not weights:
+        return
+    updated_at = timezone.now()
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        rows = {
+            row.market_id: row
+            for row in TrendingScore.objects.using(DEFAULT_DB_ALIAS).select_for_update()
+            .filter(market_id__in=[market_id for market_id, _ in weights])
+        }
+        updates, created = [], []
+        for (market_id, shard), weight in weights.items():
+            value = math.log(weight) + RATE * now
+            row = rows.get(market_id)
+            if row is None:
+                created.append(TrendingScore(market_id=market_id, shard=shard, log_score=value))
+            else:
+                row.log_score = _logaddexp(row.log_score, value)
+                row.updated_at = updated_at
+                updates.append(row)
+        TrendingScore.objects.using(DEFAULT_DB_ALIAS).bulk_update(updates, ['log_score', 'updated_at'])
+        # A row created concurrently by another worker wins; this batch's first weight is then lost.
+        TrendingScore.objects.using(DEFAULT_DB_ALIAS).bulk_create(created, ignore_conflicts=True)
+
+
+def _new_trader(market_id, user_id):
+    return cache.add(f'trending:trader:{market_id}:{user_id}', 1, HALF_LIFE)
+
+
+@tasks.task('trending.trades')
+def record_trades(payload):
+    """Fold the trade.executed payloads of a stats batch (payload['trades']) into the scores."""
+    payloads = payload['trades']
+    weights = {}
+    for p in payloads:
+        key = (p['market_id'], p.get('shard') or DEFAULT_DB_ALIAS)
+        weight = VOLUME_WEIGHT * float(p['amount'])
+        if p.get('user_id') and _new_trader(p['market_id'], p['user_id']):
+            weight += TRADER_WEIGHT
+        weights[key] = weights.get(key, 0.0) + weight
+    add(weights)
+
+
+@tasks.task('comment.posted', batch=True)
+def record_comments(payloads):
+    weights = {}
+    for p in payloads:
+        key = (p['market_id'], p.get('shard') or DEFAULT_DB_ALIAS)
+        weights[key] = weights.get(key, 0.0) + COMMENT_WEIGHT
+    add(weights)
+
+
+def build_snapshot(now=None):
+    """Rank the top TOP_N open markets. Returns {'generated_at', 'entries': [[market_id, shard, log_score]]}."""
+    now = now or time.time()
+    TrendingScore.objects.using(DEFAULT_DB_ALIAS).filter(
+        log_score__lt=math.log(MIN_SCORE) + RATE * now
+    ).delete()
+    candidates = list(
+        TrendingScore.objects.using(DEFAULT_DB_ALIAS).order_by('-log_score')
+        .values_list('market_id', 'shard', 'log_score')[:CANDIDATES]
+    )
+    by_shard = {}
+    for market_id, shard, _ in candidates:
+        by_shard.setdefault(shard, []).append(market_id)
+    open_ids = set()
+    for shard, ids in by_shard.items():
+        if shard in sharding.shards():
+            open_ids |= set(
+                Market.objects.using(shard).filter(id__in=ids, status=Market.STATUS_OPEN).values_list('id', flat=True)
+            )
+    entries = [list(c) for c in candidates if c[0] in open_ids][:TOP_N]
+    return {'generated_at': now, 'entries': entries}
+
+
+def snapshot():
+    """The current ranking: this worker's copy, the cached one, or a fresh build."""
+    now = time.time()
+    with _local_lock:
+        if _local['snapshot'] is not None and now - _local['fetched'] < LOCAL_TTL:
+            return _local['snapshot']
+
+    current = cache.get(SNAPSHOT_KEY)
+    if current is None or now - current['generated_at'] >= SNAPSHOT_EVERY:
+        # One worker rebuilds; the others keep serving the previous ranking.
+        if current is None or cache.add(LOCK_KEY, 1, SNAPSHOT_EVERY):
+            current = build_snapshot(now)
+            cache.set(SNAPSHOT_KEY, current, None)
+            cache.delete(LOCK_KEY)
+
+    with _local_lock:
+        _local['snapshot'] = current
+        _local['fetched'] = now
+    return current
+
+
+def reset_local():
+    """Drop this worker's copy of the ranking (used by tests)."""
+    with _local_lock:
+        _local['snapshot'] = None
+        _local['fetched'] = 0.0
@@ -5,14 +5,29 @@ from .api import auth
 
 urlpatterns = [
     path('markets/', views.market_list, name='market-list'),
+    path('tags/', views.market_tags, name='market_tags'),
+    path('trending/', views.trending_markets, name='trending_markets'),
     path('markets/<slug:slug>/', views.market_detail, name='market-detail'),
     path('markets/<slug:slug>/trade/', views.trade_market, name='market-trade'),
     path('markets/<slug:slug>/resolve/', views.resolve_market, name='resolve_market'),
     path('markets/<slug:slug>/redeem/', views.redeem_shares, name='redeem_shares'),
     path('markets/<slug:slug>/delete/', views.delete_market, name='delete_market'),
     path('markets/<slug:slug>/ledger/', views.market_ledger, name='market_ledger'),
+    path('markets/<slug:slug>/stats/', views.market_stats, name='market_stats'),
     path('markets/<slug:slug>/comments/', views.market_comments, name='market_comments'),
+    path('markets/<slug:slug>/orders/', views.market_orders, name='market_orders'),
+    path('markets/<slug:slug>/page/', views.market_page, name='market_page'),
+    path('markets/<slug:slug>/alerts/', views.market_alerts, name='market_alerts'),
+    path('markets/<slug:slug>/alerts/<int:alert_id>/cancel/', views.cancel_alert, name='cancel_alert'),
+    path('orders/<int:order_id>/cancel/', views.cancel_order, name='cancel_order'),
     path('portfolio/', views.user_portfolio, name='user_portfolio'),
+    path('portfolio/history/', views.portfolio_history, name='portfolio_history'),
+    path('notifications/', views.user_notifications, name='user_notifications'),
+    path('archive/<slug:slug>/', views.archived_market, name='archived_market'),
+    path('export/<str:kind>/', views.export_data, name='export_data'),
+    path('import/markets/', views.import_markets, name='import_markets'),
+    path('profiles/', views.request_profiles, name='request_profiles'),
+    path('profiles/<str:profile_id>/', views.request_profiles, name='request_profile'),
     
     # Auth Endpoints
     path('auth/login/', auth.login_view, name='login'),
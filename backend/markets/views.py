@@ -1,24 +1,130 @@
 import json
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
 from decimal import Decimal
 
-from django.http import JsonResponse
+from django.db import DEFAULT_DB_ALIAS, IntegrityError
+from django.db.models import Count, F, IntegerField, OuterRef, Prefetch, Subquery
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.csrf import csrf_exempt
 
-from .models import Market, Outcome, Position, Comment
+from . import (
+    alerts, archive, events, exports, facets, history, importing, profiling, scheduler, sharding, tasks, trending,
+)
+from .models import Market, Outcome, Position, Comment, LimitOrder, Notification, PriceAlert, Trade, UserProfile
+from .orderbook import OrderBookService
+from .ratelimit import rate_limit
+from .renderers import FastJsonResponse, NegotiatedResponse
 from .services import CPMMService
+from .sharding import market_shard
+
+
+def _parse_schedule(payload, errors):
+    """Read optional opens_at/closes_at ISO datetimes from a request payload."""
+    schedule = {}
+    for field in ('opens_at', 'closes_at'):
+        if field not in payload:
+            continue
+        value = payload[field]
+        if value in (None, ''):
+            schedule[field] = None
+            continue
+        parsed = parse_datetime(str(value))
+        if parsed is None:
+            errors[field] = 'Invalid datetime.'
+            continue
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        schedule[field] = parsed
+    return schedule
+
+
+def _outcome_payload(o):
+    return {
+        'id': o.id,
+        'name': o.name,
+        'price': o.current_price,
+        'pool': o.pool_balance,
+    }
+
+
+# Payload fields of a market, in response order, and how each is rendered.
+MARKET_FIELDS = {
+    'id': lambda m: m.id,
+    'title': lambda m: m.title,
+    'slug': lambda m: m.slug,
+    'description': lambda m: m.description,
+    'status': lambda m: m.status,
+    'created_at': lambda m: m.created_at.isoformat(),
+    'created_by': lambda m: m.created_by.username if m.created_by else None,
+    'opens_at': lambda m: m.opens_at.isoformat() if m.opens_at else None,
+    'closes_at': lambda m: m.closes_at.isoformat() if m.closes_at else None,
+    'outcomes': lambda m: [_outcome_payload(o) for o in m.outcomes.all()],
+    'tags': lambda m: [t.name for t in m.tags.all()],
+}
+# Columns read by fields that are not a column of their own name.
+_FIELD_COLUMNS = {'created_by': 'created_by__username'}
+_RELATED_FIELDS = {'outcomes', 'tags'}
+
+
+def _market_payload(market, fields=None):
+    """Market as a dict, restricted to `fields` (default: all of MARKET_FIELDS)."""
+    return {field: MARKET_FIELDS[field](market) for field in fields or MARKET_FIELDS}
+
+
+def _parse_fields(request):
+    """
+    ?fields=slug,outcomes projection. Returns the requested fields in payload
+    order, or None for all of them. Raises ValueError on an unknown field.
+    """
+    value = request.GET.get('fields')
+    if value is None:
+        return None
+    requested = {f.strip() for f in value.split(',') if f.strip()}
+    unknown = requested - set(MARKET_FIELDS)
+    if unknown or not requested:
+        raise ValueError('Unknown fields: ' + ', '.join(sorted(unknown)) if unknown else 'No fields requested.')
+    return [f for f in MARKET_FIELDS if f in requested]
+
+
+def _market_queryset(fields=None, markets=None):
+    """
+    `markets` (default: all) loading only what `fields` render: deferred
+    columns, and created_by, outcomes and tags only when asked for.
+    """
+    markets = Market.objects.all() if markets is None else markets
+    fields = fields or list(MARKET_FIELDS)
+    if 'created_by' in fields:
+        markets = markets.select_related('created_by')
+    if 'outcomes' in fields:
+        markets = markets.prefetch_related(Prefetch(
+            'outcomes', queryset=Outcome.objects.only('id', 'market_id', 'name', 'current_price', 'pool_balance'),
+        ))
+    if 'tags' in fields:
+        markets = markets.prefetch_related('tags')
+    # created_at is the list's sort key.
+    columns = {'id', 'created_at'} | {_FIELD_COLUMNS.get(f, f) for f in fields if f not in _RELATED_FIELDS}
+    return markets.only(*columns)
 
 
 @csrf_exempt
 def market_list(request):
+    try:
+        fields = _parse_fields(request)
+    except ValueError as e:
+        return FastJsonResponse({'error': str(e)}, status=400)
+
     if request.method == 'POST':
         if not request.user.is_authenticated:
-            return JsonResponse({'error': 'Authentication required.'}, status=401)
+            return FastJsonResponse({'error': 'Authentication required.'}, status=401)
 
         try:
             payload = json.loads(request.body.decode('utf-8') or '{}')
         except json.JSONDecodeError:
-            return JsonResponse({'error': 'Invalid JSON body.'}, status=400)
+            return FastJsonResponse({'error': 'Invalid JSON body.'}, status=400)
 
         title = (payload.get('title') or '').strip()
         slug = (payload.get('slug') or '').strip()
@@ -30,147 +136,229 @@ def market_list(request):
             errors['title'] = 'Title is required.'
         if not slug:
             errors['slug'] = 'Slug is required.'
-        elif Market.objects.filter(slug=slug).exists():
+        elif sharding.locate(slug) is not None or archive.archived_slug_exists(slug):
             errors['slug'] = 'Slug already exists.'
 
         if status not in dict(Market.STATUS_CHOICES):
             errors['status'] = 'Invalid status.'
 
+        schedule = _parse_schedule(payload, errors)
+
+        try:
+            tag_names = facets.parse_tags(payload.get('tags'))
+        except ValueError as e:
+            errors['tags'] = str(e)
+
         if errors:
-            return JsonResponse({'errors': errors}, status=400)
-
-        market = Market.objects.create(
-            title=title,
-            slug=slug,
-            description=description,
-            status=status,
-            created_by=request.user
-        )
+            return FastJsonResponse({'errors': errors}, status=400)
 
-        # Auto-initialize 50/50 outcomes
-        CPMMService.initialize_market(market)
+        placement = {}
+        alias = DEFAULT_DB_ALIAS
+        if sharding.enabled():
+            try:
+                [(placement['id'], alias)] = sharding.allocate([slug])
+            except IntegrityError:
+                return FastJsonResponse({'errors': {'slug': 'Slug already exists.'}}, status=400)
 
-        response_payload = {
-            'id': market.id,
-            'title': market.title,
-            'slug': market.slug,
-            'description': market.description,
-            'status': market.status,
-            'created_at': market.created_at.isoformat(),
-            'created_by': market.created_by.username if market.created_by else None,
-            'outcomes': [
-                {
-                    'id': o.id,
-                    'name': o.name,
-                    'price': o.current_price,
-                    'pool': o.pool_balance,
-                }
-                for o in market.outcomes.all()
-            ]
-        }
-        return JsonResponse(response_payload, status=201)
+        with sharding.use_shard(alias), sharding.atomic():
+            market = Market.objects.create(
+                title=title,
+                slug=slug,
+                description=description,
+                status=status,
+                created_by=request.user,
+                **placement,
+                **schedule
+            )
+            if tag_names:
+                market.tags.set(facets.get_tags(tag_names))
+            facets.market_changed(None, (status, frozenset(tag_names)))
+            events.record('market.create', market_id=market.id, user_id=request.user.id,
+                          slug=slug, title=title, status=status)
+            # Auto-initialize 50/50 outcomes
+            CPMMService.initialize_market(market)
+
+        if schedule:
+            scheduler.notify_schedule_changed()
+
+        return FastJsonResponse(_market_payload(market, fields), status=201)
 
     if request.method != 'GET':
-        return JsonResponse({'error': 'Method not allowed.'}, status=405)
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
 
-    markets = Market.objects.all()
-    payload = [
-        {
-            'id': market.id,
-            'title': market.title,
-            'slug': market.slug,
-            'description': market.description,
-            'status': market.status,
-            'created_at': market.created_at.isoformat(),
-            'created_by': market.created_by.username if market.created_by else None,
-            'outcomes': [
-                {
-                    'id': o.id,
-                    'name': o.name,
-                    'price': o.current_price,
-                    'pool': o.pool_balance,
-                }
-                for o in market.outcomes.all()
-            ]
-        }
-        for market in markets
-    ]
-    return JsonResponse(payload, safe=False)
+    markets = _market_queryset(fields)
+    status = request.GET.get('status')
+    if status:
+        if status not in dict(Market.STATUS_CHOICES):
+            return FastJsonResponse({'error': 'Invalid status.'}, status=400)
+        markets = markets.filter(status=status)
+    tag = request.GET.get('tag')
+    if tag:
+        markets = markets.filter(tags__name=facets.tag_name(tag))
+
+    since = request.GET.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+            if since < 0:
+                raise ValueError
+        except ValueError:
+            return FastJsonResponse({'error': 'Invalid since.'}, status=400)
+        return _market_changes(request, since, fields, markets, filtered=bool(status or tag))
+
+    # Taken before reading: changes made while the list is read come again on the first sync.
+    seq = events.high_water_mark()
+
+    def shard_markets():
+        return [(market.created_at, _market_payload(market, fields)) for market in markets.all()]
+
+    rows = [row for shard_rows in sharding.scatter_gather(shard_markets) for row in shard_rows]
+    rows.sort(key=lambda row: row[0], reverse=True)
+    response = NegotiatedResponse(request, [market for _, market in rows], safe=False)
+    response['X-Change-Seq'] = str(seq)
+    return response
+
+
+def _market_changes(request, since, fields, markets, filtered):
+    """
+    ?since=<seq> mode of the market list: markets changed after `since` that
+    match the filters, tombstones for the ones deleted, archived or no
+    longer matching, and the sequence number to pass next time.
+    """
+    if since > events.latest_seq():
+        return FastJsonResponse({'error': 'Unknown sequence number; reload the full list.'}, status=410)
+    changed, seq, more = events.market_changes(since)
+    ids = list(changed)
+
+    def shard_changes():
+        return [(market.id, _market_payload(market, fields)) for market in markets.filter(id__in=ids)]
+
+    found = dict(row for rows in sharding.scatter_gather(shard_changes) for row in rows)
+    missing = [market_id for market_id in ids if market_id not in found]
+    if missing and filtered:
+        # Still there but filtered out: the client needs their current slug.
+        for rows in sharding.scatter_gather(
+            lambda: list(Market.objects.filter(id__in=missing).values_list('id', 'slug'))
+        ):
+            changed.update(rows)
+    return NegotiatedResponse(request, {
+        'seq': seq,
+        'more': more,
+        'markets': [found[market_id] for market_id in ids if market_id in found],
+        'removed': [{'id': market_id, 'slug': changed[market_id]} for market_id in missing],
+    })
 
 
 @csrf_exempt
+@market_shard
 def market_detail(request, slug):
-    market = get_object_or_404(Market, slug=slug)
+    try:
+        fields = _parse_fields(request)
+    except ValueError as e:
+        return FastJsonResponse({'error': str(e)}, status=400)
+
+    if request.method == 'GET':
+        market = _market_queryset(fields, Market.objects.filter(slug=slug)).first()
+    else:
+        market = Market.objects.filter(slug=slug).first()
+    if market is None:
+        # Archived markets keep resolving to a read-only stub.
+        archived = archive.get_archived(slug)
+        if archived is None or request.method != 'GET':
+            return FastJsonResponse({'error': 'Market not found.'}, status=404)
+        return FastJsonResponse(archive.archived_payload(archived, include_details=False))
 
     if request.method in ['PUT', 'PATCH']:
         if not request.user.is_authenticated:
-            return JsonResponse({'error': 'Authentication required.'}, status=401)
+            return FastJsonResponse({'error': 'Authentication required.'}, status=401)
         
         # Allow staff/superusers to edit any market
         is_admin = request.user.is_staff or request.user.is_superuser
         if market.created_by != request.user and not is_admin:
-            return JsonResponse({'error': 'Permission denied.'}, status=403)
+            return FastJsonResponse({'error': 'Permission denied.'}, status=403)
 
         try:
             payload = json.loads(request.body.decode('utf-8') or '{}')
         except json.JSONDecodeError:
-            return JsonResponse({'error': 'Invalid JSON body.'}, status=400)
+            return FastJsonResponse({'error': 'Invalid JSON body.'}, status=400)
+
+        errors = {}
+        if 'status' in payload and payload['status'] not in dict(Market.STATUS_CHOICES):
+            errors['status'] = 'Invalid status.'
+        schedule = _parse_schedule(payload, errors)
+        tag_names = None
+        if 'tags' in payload:
+            try:
+                tag_names = facets.parse_tags(payload['tags'])
+            except ValueError as e:
+                errors['tags'] = str(e)
+        if errors:
+            return FastJsonResponse({'errors': errors}, status=400)
 
-        market.title = payload.get('title', market.title)
-        market.description = payload.get('description', market.description)
-        market.status = payload.get('status', market.status)
-        
         # If slug is updated, we need to handle it carefully or disallow it.
         # For simplicity, we'll allow it but check uniqueness if changed.
         new_slug = payload.get('slug')
         if new_slug and new_slug != market.slug:
-             if Market.objects.filter(slug=new_slug).exists():
-                 return JsonResponse({'error': 'Slug already exists.'}, status=400)
-             market.slug = new_slug
+             if sharding.locate(new_slug) is not None or archive.archived_slug_exists(new_slug):
+                 return FastJsonResponse({'error': 'Slug already exists.'}, status=400)
 
-        market.save()
+        with sharding.atomic():
+            # Edit the locked row so the facet counts move from its current state.
+            market = Market.objects.select_for_update().get(pk=market.pk)
+            old_slug = market.slug
+            before = facets.state(market)
+            for field, value in schedule.items():
+                setattr(market, field, value)
+
+            market.title = payload.get('title', market.title)
+            market.description = payload.get('description', market.description)
+            market.status = payload.get('status', market.status)
+            if new_slug:
+                market.slug = new_slug
+            market.save()
+            if tag_names is not None:
+                market.tags.set(facets.get_tags(tag_names))
+            tags = before[1] if tag_names is None else frozenset(tag_names)
+            facets.market_changed(before, (market.status, tags))
+            events.record('market.edit', market_id=market.id, user_id=request.user.id, slug=market.slug,
+                          **{f: payload[f] for f in ('title', 'description', 'status') if f in payload},
+                          **schedule)
+        sharding.rename(old_slug, market.slug)
+        scheduler.invalidate_status(old_slug, market.slug)
+        if schedule:
+            scheduler.notify_schedule_changed()
         # Fall through to return updated object
 
     if request.method not in ['GET', 'PUT', 'PATCH']:
-        return JsonResponse({'error': 'Method not allowed.'}, status=405)
-
-    payload = {
-        'id': market.id,
-        'title': market.title,
-        'slug': market.slug,
-        'description': market.description,
-        'status': market.status,
-        'created_at': market.created_at.isoformat(),
-        'created_by': market.created_by.username if market.created_by else None,
-        'outcomes': [
-            {
-                'id': o.id,
-                'name': o.name,
-                'price': o.current_price,
-                'pool': o.pool_balance,
-            }
-            for o in market.outcomes.all()
-        ]
-    }
-    return JsonResponse(payload)
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+
+    payload = _market_payload(market, fields)
+    return FastJsonResponse(payload)
 
 from .services import CPMMService
 from django.contrib.auth.models import User  # For demo, using first user or auth
 
 @csrf_exempt
+@rate_limit('trade')
+@market_shard
 def trade_market(request, slug):
     if request.method != 'POST':
-        return JsonResponse({'error': 'Method not allowed.'}, status=405)
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+
+    # Cached (status, closes_at) check: closed markets are rejected before any query.
+    if not scheduler.trading_open(slug):
+        get_object_or_404(Market, slug=slug)
+        return FastJsonResponse({'error': 'Market is not open for trading.'}, status=400)
 
     market = get_object_or_404(Market, slug=slug)
     
     try:
         payload = json.loads(request.body.decode('utf-8') or '{}')
     except json.JSONDecodeError:
-        return JsonResponse({'error': 'Invalid JSON body.'}, status=400)
+        return FastJsonResponse({'error': 'Invalid JSON body.'}, status=400)
 
     if not request.user.is_authenticated:
-        return JsonResponse({'error': 'Authentication required.'}, status=401)
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
     
     user = request.user
 
@@ -178,19 +366,19 @@ def trade_market(request, slug):
     amount = payload.get('amount')
 
     if not outcome_id or not amount:
-        return JsonResponse({'error': 'outcome_id and amount are required.'}, status=400)
+        return FastJsonResponse({'error': 'outcome_id and amount are required.'}, status=400)
 
     try:
         amount = Decimal(str(amount))
         if amount <= 0:
             raise ValueError
     except (ValueError, TypeError):
-        return JsonResponse({'error': 'Invalid amount.'}, status=400)
+        return FastJsonResponse({'error': 'Invalid amount.'}, status=400)
 
     try:
         outcome = market.outcomes.get(pk=outcome_id)
     except Outcome.DoesNotExist:
-         return JsonResponse({'error': 'Outcome not found.'}, status=404)
+         return FastJsonResponse({'error': 'Outcome not found.'}, status=404)
 
     # Initialize market if needed (ensure pools exist)
     if outcome.pool_balance == 0:
@@ -200,20 +388,35 @@ def trade_market(request, slug):
     try:
         # Check Balance
         if user.userprofile.balance < amount:
-             return JsonResponse({'error': 'Insufficient funds.'}, status=400)
+             return FastJsonResponse({'error': 'Insufficient funds.'}, status=400)
+
+        # The pool update, balance deduction and follow-up tasks commit together;
+        # everything else about the trade runs later in the task worker.
+        with sharding.atomic():
+            # The cached check above may be stale in this worker; resolving or
+            # closing takes this row lock, so the row is authoritative here.
+            locked = Market.objects.select_for_update().only('status', 'closes_at').get(pk=market.pk)
+            if locked.status != Market.STATUS_OPEN or (locked.closes_at and locked.closes_at <= timezone.now()):
+                return FastJsonResponse({'error': 'Market is not open for trading.'}, status=400)
+            # Guarded in the UPDATE itself, so concurrent trades cannot spend the same funds.
+            if not UserProfile.objects.filter(user=user, balance__gte=amount).update(balance=F('balance') - amount):
+                return FastJsonResponse({'error': 'Insufficient funds.'}, status=400)
+            result = CPMMService.buy_tokens(user, outcome, amount)
+            events.balance_changed(user.id, -amount, 'trade')
+
+            tasks.enqueue('trade.executed', {
+                'market_id': market.id,
+                'shard': sharding.current_shard(),
+                'outcome_id': outcome.id,
+                'user_id': user.id,
+                'amount': str(amount),
+                'shares': str(result['shares_bought']),
+            })
 
-        result = CPMMService.buy_tokens(user, outcome, amount)
-        
-        # Deduct Balance (Atomic with buy_tokens would be better, but doing here for now)
-        # Note: CPMMService.buy_tokens is atomic, but this deduction is outside it.
-        # Ideally we move this into CPMMService.
-        user.userprofile.balance -= amount
-        user.userprofile.save()
-        
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return FastJsonResponse({'error': str(e)}, status=500)
 
-    return JsonResponse({
+    return FastJsonResponse({
         'status': 'success',
         'trade': result,
         'market_status': {
@@ -230,9 +433,10 @@ def trade_market(request, slug):
 
 
 @csrf_exempt
+@market_shard
 def resolve_market(request, slug):
     if request.method != 'POST':
-        return JsonResponse({'error': 'Method not allowed.'}, status=405)
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
 
     market = get_object_or_404(Market, slug=slug)
     
@@ -243,82 +447,326 @@ def resolve_market(request, slug):
         outcome_id = payload.get('outcome_id')
         outcome = market.outcomes.get(pk=outcome_id)
     except (ValueError, TypeError, Outcome.DoesNotExist):
-        return JsonResponse({'error': 'Invalid outcome_id.'}, status=400)
+        return FastJsonResponse({'error': 'Invalid outcome_id.'}, status=400)
 
-    market.winning_outcome = outcome
-    market.status = Market.STATUS_RESOLVED
-    market.save()
+    with sharding.atomic():
+        market = Market.objects.select_for_update().get(pk=market.pk)
+        before = facets.state(market)
+        market.winning_outcome = outcome
+        market.status = Market.STATUS_RESOLVED
+        market.resolved_at = timezone.now()
+        market.save()
+        facets.market_changed(before, (market.status, before[1]))
+        events.record('market.resolve', market_id=market.id, winner=outcome.name)
+    scheduler.invalidate_status(market.slug)
+
+    # Resting orders can no longer fill; return their reserved funds.
+    OrderBookService.cancel_market_orders(market)
     
-    return JsonResponse({'status': 'resolved', 'winner': outcome.name})
+    return FastJsonResponse({'status': 'resolved', 'winner': outcome.name})
 
 
 @csrf_exempt
+@market_shard
 def redeem_shares(request, slug):
     if request.method != 'POST':
-        return JsonResponse({'error': 'Method not allowed.'}, status=405)
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
 
     market = get_object_or_404(Market, slug=slug)
     if market.status != Market.STATUS_RESOLVED or not market.winning_outcome:
-        return JsonResponse({'error': 'Market is not resolved.'}, status=400)
+        return FastJsonResponse({'error': 'Market is not resolved.'}, status=400)
 
     payload = json.loads(request.body.decode('utf-8') or '{}')
     if not request.user.is_authenticated:
-        return JsonResponse({'error': 'Authentication required.'}, status=401)
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
     
     user = request.user
 
     # Find position in winning outcome
     try:
-        position = Position.objects.get(user=user, outcome=market.winning_outcome)
-        shares = position.shares
-        if shares <= 0:
-             return JsonResponse({'message': 'No shares to redeem.', 'payout': 0})
-             
-        # "Redeem" means giving them $1 per share. 
-        # In a real app, we would add to user balance.
-        # Here we just zero out the shares and return the payout amount.
-        payout = float(shares) * 1.00
-        
-        position.shares = Decimal('0')
-        position.save()
-        
-        # Credit Balance
-        user.userprofile.balance += Decimal(str(payout))
-        user.userprofile.save()
-        
-        return JsonResponse({'status': 'redeemed', 'payout': payout, 'shares_burned': float(shares), 'new_balance': float(user.userprofile.balance)})
-        
+        with sharding.atomic():
+            # Locked, so a concurrent redeem waits and then finds no shares left.
+            position = Position.objects.select_for_update().get(user=user, outcome=market.winning_outcome)
+            shares = position.shares
+            if shares <= 0:
+                return FastJsonResponse({'message': 'No shares to redeem.', 'payout': 0})
+
+            # Each winning share pays out $1.
+            payout = shares * Decimal('1.00')
+            position.shares = Decimal('0')
+            position.save(update_fields=['shares'])
+
+            Trade.objects.create(
+                user=user,
+                outcome=market.winning_outcome,
+                kind=Trade.KIND_REDEEM,
+                amount=shares,
+                shares=shares,
+                price=Decimal('1'),
+            )
+            events.record('redeem', market_id=market.id, user_id=user.id,
+                          outcome=market.winning_outcome.name, shares=shares)
+
+            # Credit Balance
+            UserProfile.objects.filter(user=user).update(balance=F('balance') + payout)
+            events.balance_changed(user.id, payout, 'redeem')
+            new_balance = UserProfile.objects.values_list('balance', flat=True).get(user=user)
+
+        return FastJsonResponse({'status': 'redeemed', 'payout': payout, 'shares_burned': shares, 'new_balance': new_balance})
+
     except Position.DoesNotExist:
-        return JsonResponse({'message': 'No position in winning outcome.', 'payout': 0})
+        return FastJsonResponse({'message': 'No position in winning outcome.', 'payout': 0})
 
 
 @csrf_exempt
+@market_shard
 def delete_market(request, slug):
     if request.method != 'DELETE':
-        return JsonResponse({'error': 'Method not allowed.'}, status=405)
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
 
     if not request.user.is_authenticated:
-        return JsonResponse({'error': 'Authentication required.'}, status=401)
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
 
     market = get_object_or_404(Market, slug=slug)
 
     # Allow staff/superusers to delete any market
     is_admin = request.user.is_staff or request.user.is_superuser
     if market.created_by != request.user and not is_admin:
-        return JsonResponse({'error': 'Permission denied. You are not the owner.'}, status=403)
+        return FastJsonResponse({'error': 'Permission denied. You are not the owner.'}, status=403)
+
+    OrderBookService.cancel_market_orders(market)
+    with sharding.atomic():
+        market_id = market.id
+        facets.market_changed(facets.state(market), None)
+        market.delete()
+        events.record('market.delete', market_id=market_id, user_id=request.user.id, slug=slug)
+    sharding.forget(slug)
+    scheduler.invalidate_status(slug)
+    return FastJsonResponse({'message': 'Market deleted successfully.'}, status=200)
+
+
+def _order_payload(order):
+    return {
+        'id': order.id,
+        'outcome_id': order.outcome_id,
+        'limit_price': order.limit_price,
+        'amount': order.amount,
+        'remaining': order.remaining,
+        'shares_filled': order.shares_filled,
+        'status': order.status,
+        'created_at': order.created_at.isoformat(),
+    }
+
+
+@csrf_exempt
+@rate_limit('order')
+@market_shard
+def market_orders(request, slug):
+    """
+    GET: Returns the caller's limit orders in a market.
+    POST: Places a limit order {outcome_id, limit_price, amount}. The amount is
+    reserved from the balance and filled whenever the price is <= limit_price.
+    """
+    market = get_object_or_404(Market, slug=slug)
+
+    if not request.user.is_authenticated:
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
+
+    if request.method == 'GET':
+        orders = LimitOrder.objects.filter(user=request.user, outcome__market=market)
+        return FastJsonResponse({'orders': [_order_payload(o) for o in orders]})
+
+    if request.method != 'POST':
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+
+    try:
+        payload = json.loads(request.body.decode('utf-8') or '{}')
+    except json.JSONDecodeError:
+        return FastJsonResponse({'error': 'Invalid JSON body.'}, status=400)
+
+    outcome_id = payload.get('outcome_id')
+    if not outcome_id or payload.get('amount') is None or payload.get('limit_price') is None:
+        return FastJsonResponse({'error': 'outcome_id, limit_price and amount are required.'}, status=400)
+
+    try:
+        amount = Decimal(str(payload['amount']))
+        limit_price = Decimal(str(payload['limit_price']))
+        if amount <= 0 or not (0 < limit_price < 1):
+            raise ValueError
+    except (ValueError, TypeError, ArithmeticError):
+        return FastJsonResponse({'error': 'Invalid amount or limit_price.'}, status=400)
+
+    try:
+        outcome = market.outcomes.get(pk=outcome_id)
+    except (Outcome.DoesNotExist, ValueError):
+        return FastJsonResponse({'error': 'Outcome not found.'}, status=404)
+
+    if not scheduler.trading_open(slug):
+        return FastJsonResponse({'error': 'Market is not open for trading.'}, status=400)
+
+    try:
+        order = OrderBookService.place_order(request.user, outcome, limit_price, amount)
+    except ValueError as e:
+        return FastJsonResponse({'error': str(e)}, status=400)
+
+    return FastJsonResponse(_order_payload(order), status=201)
+
+
+@csrf_exempt
+def cancel_order(request, order_id):
+    if request.method not in ['POST', 'DELETE']:
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+
+    if not request.user.is_authenticated:
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
+
+    # Order ids are per shard; ?market=<slug> pins the shard when sharding is on.
+    market_slug = request.GET.get('market')
+    aliases = [sharding.db_for_slug(market_slug)] if market_slug else None
+    order = sharding.find(LimitOrder, aliases, pk=order_id, user=request.user)
+    if order is None:
+        raise Http404('No LimitOrder matches the given query.')
+    with sharding.use_shard(order._state.db):
+        refund = OrderBookService.cancel_order(order)
+        order.refresh_from_db()
+    return FastJsonResponse({'order': _order_payload(order), 'refund': refund})
+
+
+def _alert_payload(alert):
+    return {
+        'id': alert.id,
+        'outcome_id': alert.outcome_id,
+        'direction': alert.direction,
+        'threshold': alert.threshold,
+        'status': alert.status,
+        'created_at': alert.created_at.isoformat(),
+        'triggered_at': alert.triggered_at.isoformat() if alert.triggered_at else None,
+        'triggered_price': alert.triggered_price,
+    }
+
+
+@csrf_exempt
+@market_shard
+def market_alerts(request, slug):
+    """
+    GET: Returns the caller's price alerts in a market.
+    POST: Creates an alert {outcome_id, direction: above|below, threshold},
+    notifying the caller once the outcome's price crosses the threshold.
+    """
+    market = get_object_or_404(Market, slug=slug)
 
-    market.delete()
-    return JsonResponse({'message': 'Market deleted successfully.'}, status=200)
+    if not request.user.is_authenticated:
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
+
+    if request.method == 'GET':
+        user_alerts = PriceAlert.objects.filter(user=request.user, outcome__market=market)
+        return FastJsonResponse({'alerts': [_alert_payload(a) for a in user_alerts]})
+
+    if request.method != 'POST':
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+
+    try:
+        payload = json.loads(request.body.decode('utf-8') or '{}')
+    except json.JSONDecodeError:
+        return FastJsonResponse({'error': 'Invalid JSON body.'}, status=400)
+
+    outcome_id = payload.get('outcome_id')
+    direction = payload.get('direction')
+    if not outcome_id or payload.get('threshold') is None:
+        return FastJsonResponse({'error': 'outcome_id, direction and threshold are required.'}, status=400)
+    if direction not in (PriceAlert.DIRECTION_ABOVE, PriceAlert.DIRECTION_BELOW):
+        return FastJsonResponse({'error': 'direction must be "above" or "below".'}, status=400)
+
+    try:
+        threshold = Decimal(str(payload['threshold']))
+        if not (0 < threshold < 1):
+            raise ValueError
+    except (ValueError, TypeError, ArithmeticError):
+        return FastJsonResponse({'error': 'Invalid threshold.'}, status=400)
+
+    try:
+        outcome = market.outcomes.get(pk=outcome_id)
+    except (Outcome.DoesNotExist, ValueError):
+        return FastJsonResponse({'error': 'Outcome not found.'}, status=404)
+
+    if market.status != Market.STATUS_OPEN:
+        return FastJsonResponse({'error': 'Market is not open.'}, status=400)
+
+    alert = alerts.create_alert(request.user, outcome, direction, threshold.quantize(alerts.PRICE))
+    return FastJsonResponse(_alert_payload(alert), status=201)
+
+
+@csrf_exempt
+@market_shard
+def cancel_alert(request, slug, alert_id):
+    if request.method not in ['POST', 'DELETE']:
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+
+    if not request.user.is_authenticated:
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
+
+    alert = get_object_or_404(PriceAlert, pk=alert_id, user=request.user, outcome__market__slug=slug)
+    alerts.cancel_alert(alert)
+    alert.refresh_from_db()
+    return FastJsonResponse(_alert_payload(alert))
+
+
+@csrf_exempt
+def user_notifications(request):
+    """
+    GET: Returns the caller's latest notifications (?unread=1 for unread only).
+    POST: Marks notifications read: {ids: [...]}, or all of them without ids.
+    """
+    if not request.user.is_authenticated:
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
+
+    notifications = Notification.objects.filter(user=request.user)
+
+    if request.method == 'GET':
+        if request.GET.get('unread') in ('1', 'true'):
+            notifications = notifications.filter(read=False)
+        return FastJsonResponse({'notifications': [
+            {
+                'id': n.id,
+                'kind': n.kind,
+                'message': n.message,
+                'data': n.data,
+                'read': n.read,
+                'created_at': n.created_at.isoformat(),
+            }
+            for n in notifications[:PAGE_MAX_LIMIT]
+        ]})
+
+    if request.method != 'POST':
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+
+    try:
+        payload = json.loads(request.body.decode('utf-8') or '{}')
+    except json.JSONDecodeError:
+        return FastJsonResponse({'error': 'Invalid JSON body.'}, status=400)
+
+    ids = payload.get('ids')
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return FastJsonResponse({'error': 'ids must be a list of integers.'}, status=400)
+        notifications = notifications.filter(id__in=ids)
+    updated = notifications.filter(read=False).update(read=True)
+    return FastJsonResponse({'marked_read': updated})
 
 
 def user_portfolio(request):
     if not request.user.is_authenticated:
-        return JsonResponse({'error': 'Authentication required.'}, status=401)
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
 
     user = request.user
     
-    # 1. Get Positions
-    positions = Position.objects.filter(user=user).select_related('outcome', 'outcome__market')
+    # 1. Get Positions (from every shard)
+    positions = [
+        pos for shard_positions in sharding.scatter_gather(
+            lambda: list(Position.objects.filter(user=user).select_related('outcome', 'outcome__market'))
+        )
+        for pos in shard_positions
+    ]
     positions_data = []
     total_value = Decimal('0.0')
 
@@ -339,7 +787,11 @@ def user_portfolio(request):
         })
 
     # 2. Get Created Markets
-    created_markets = Market.objects.filter(created_by=user).order_by('-created_at')
+    created_markets = sorted(
+        (m for shard_markets in sharding.scatter_gather(lambda: list(Market.objects.filter(created_by=user)))
+         for m in shard_markets),
+        key=lambda m: m.created_at, reverse=True,
+    )
     markets_data = [
         {
             'id': m.id,
@@ -351,15 +803,107 @@ def user_portfolio(request):
         for m in created_markets
     ]
 
-    return JsonResponse({
+    return NegotiatedResponse(request, {
         'positions': positions_data,
         'created_markets': markets_data,
         'total_value': total_value,
         'username': user.username,
-        'balance': float(user.userprofile.balance)
+        'balance': user.userprofile.balance
     })
 
 
+def trending_markets(request):
+    """
+    Open markets ranked by decayed trading and comment activity.
+    ?limit=N (default 20, at most trending.TOP_N); ?fields= as on the market list.
+    """
+    try:
+        fields = _parse_fields(request)
+    except ValueError as e:
+        return FastJsonResponse({'error': str(e)}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', PAGE_LIMIT)), trending.TOP_N)
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        return FastJsonResponse({'error': 'Invalid limit.'}, status=400)
+
+    ranking = trending.snapshot()
+    entries = ranking['entries'][:limit]
+    by_shard = {}
+    for market_id, shard, _ in entries:
+        by_shard.setdefault(shard, []).append(market_id)
+    markets = {}
+    for shard, ids in by_shard.items():
+        with sharding.use_shard(shard):
+            for market in _market_queryset(fields, Market.objects.filter(id__in=ids, status=Market.STATUS_OPEN)):
+                markets[market.id] = market
+
+    now = time.time()
+    return NegotiatedResponse(request, {
+        'generated_at': datetime.fromtimestamp(ranking['generated_at'], tz=dt_timezone.utc).isoformat(),
+        'markets': [
+            {**_market_payload(markets[market_id], fields), 'score': round(trending.score_at(log_score, now), 4)}
+            for market_id, _, log_score in entries
+            if market_id in markets
+        ],
+    })
+
+
+def portfolio_history(request):
+    """
+    Daily portfolio value and P&L of the caller, read from the nightly
+    snapshots. Optional ?days=N limits the range (default 365, at most
+    history.MAX_DAYS).
+    """
+    if not request.user.is_authenticated:
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
+
+    try:
+        days = min(int(request.GET.get('days', 365)), history.MAX_DAYS)
+        if days <= 0:
+            raise ValueError
+    except ValueError:
+        return FastJsonResponse({'error': 'Invalid days.'}, status=400)
+
+    since = timezone.localdate() - timedelta(days=days - 1)
+    return FastJsonResponse({
+        'username': request.user.username,
+        'history': history.pnl_history(request.user, since=since),
+    })
+
+
+def market_tags(request):
+    """
+    Faceted market counts: markets per status, and per tag per status, most
+    used tags first. Optional ?status= ranks tags by their count in that status.
+    """
+    status = request.GET.get('status')
+    if status and status not in dict(Market.STATUS_CHOICES):
+        return FastJsonResponse({'error': 'Invalid status.'}, status=400)
+
+    counts = facets.counts()
+    tags = [
+        {'name': name, 'counts': by_status, 'total': sum(by_status.values())}
+        for name, by_status in counts.items()
+        if name != facets.ALL
+    ]
+    if status:
+        tags = [t for t in tags if t['counts'].get(status)]
+        tags.sort(key=lambda t: (-t['counts'][status], t['name']))
+    else:
+        tags.sort(key=lambda t: (-t['total'], t['name']))
+    return FastJsonResponse({'statuses': counts.get(facets.ALL, {}), 'tags': tags})
+
+
+@market_shard
+def market_stats(request, slug):
+    """Traded volume and number of trades, counted by the trade.executed task (so a little behind)."""
+    market = get_object_or_404(Market.objects.only('id'), slug=slug)
+    return FastJsonResponse(tasks.market_stats(market.id))
+
+
+@market_shard
 def market_ledger(request, slug):
     """
     Returns all positions for a market (public trading ledger).
@@ -378,11 +922,11 @@ def market_ledger(request, slug):
         ledger.append({
             'username': pos.user.username,
             'outcome': pos.outcome.name,
-            'shares': float(pos.shares),
-            'value': float(pos.shares * pos.outcome.current_price),
+            'shares': pos.shares,
+            'value': pos.shares * pos.outcome.current_price,
         })
     
-    return JsonResponse({
+    return NegotiatedResponse(request, {
         'market': market.title,
         'ledger': ledger,
         'total_bettors': len(set(pos.user_id for pos in positions)),
@@ -390,6 +934,7 @@ def market_ledger(request, slug):
 
 
 @csrf_exempt
+@market_shard
 def market_comments(request, slug):
     """
     GET: Returns all comments for a market.
@@ -399,26 +944,32 @@ def market_comments(request, slug):
     
     if request.method == 'POST':
         if not request.user.is_authenticated:
-            return JsonResponse({'error': 'Authentication required.'}, status=401)
+            return FastJsonResponse({'error': 'Authentication required.'}, status=401)
         
         try:
             payload = json.loads(request.body.decode('utf-8') or '{}')
         except json.JSONDecodeError:
-            return JsonResponse({'error': 'Invalid JSON body.'}, status=400)
+            return FastJsonResponse({'error': 'Invalid JSON body.'}, status=400)
         
         text = (payload.get('text') or '').strip()
         if not text:
-            return JsonResponse({'error': 'Comment text is required.'}, status=400)
+            return FastJsonResponse({'error': 'Comment text is required.'}, status=400)
         if len(text) > 1000:
-            return JsonResponse({'error': 'Comment too long (max 1000 chars).'}, status=400)
+            return FastJsonResponse({'error': 'Comment too long (max 1000 chars).'}, status=400)
         
-        comment = Comment.objects.create(
-            market=market,
-            user=request.user,
-            text=text
-        )
+        with sharding.atomic():
+            comment = Comment.objects.create(
+                market=market,
+                user=request.user,
+                text=text
+            )
+            tasks.enqueue('comment.posted', {
+                'market_id': market.id,
+                'shard': sharding.current_shard(),
+                'user_id': request.user.id,
+            })
         
-        return JsonResponse({
+        return FastJsonResponse({
             'id': comment.id,
             'username': comment.user.username,
             'text': comment.text,
@@ -438,8 +989,213 @@ def market_comments(request, slug):
         for c in comments
     ]
     
-    return JsonResponse({
+    return FastJsonResponse({
         'market': market.title,
         'comments': comments_data,
         'count': len(comments_data),
     })
+
+
+PAGE_SECTIONS = ('market', 'ledger', 'comments', 'position', 'me')
+PAGE_LIMIT = 20
+PAGE_MAX_LIMIT = 100
+
+
+def _count_subquery(queryset, group_field, count_field):
+    """Correlated COUNT(DISTINCT count_field) so counts come back with the market row."""
+    return Subquery(
+        queryset.values(group_field).annotate(n=Count(count_field, distinct=True)).values('n')[:1],
+        output_field=IntegerField(),
+    )
+
+
+@market_shard
+def market_page(request, slug):
+    """
+    Everything a market page needs in one request. ?include= picks sections
+    (comma-separated, default all): market, ledger, comments, position, me.
+    Optional: ledger_limit, comments_limit, comments_before=<comment id>.
+    The slug and session are resolved once; counts ride along with the
+    market row, and every section is a single query.
+    """
+    if request.method != 'GET':
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+
+    include = request.GET.get('include')
+    sections = set(include.split(',')) if include else set(PAGE_SECTIONS)
+    unknown = sections - set(PAGE_SECTIONS)
+    if unknown:
+        return FastJsonResponse({'error': f'Unknown sections: {", ".join(sorted(unknown))}.'}, status=400)
+
+    try:
+        ledger_limit = min(int(request.GET.get('ledger_limit', PAGE_LIMIT)), PAGE_MAX_LIMIT)
+        comments_limit = min(int(request.GET.get('comments_limit', PAGE_LIMIT)), PAGE_MAX_LIMIT)
+        if ledger_limit < 1 or comments_limit < 1:
+            raise ValueError
+        comments_before = request.GET.get('comments_before')
+        comments_before = int(comments_before) if comments_before else None
+    except ValueError:
+        return FastJsonResponse({'error': 'Invalid limit or cursor.'}, status=400)
+
+    markets = Market.objects.filter(slug=slug).select_related('created_by').prefetch_related('outcomes', 'tags')
+    if 'ledger' in sections:
+        held = Position.objects.filter(outcome__market=OuterRef('pk'), shares__gt=0)
+        markets = markets.annotate(bettors=_count_subquery(held, 'outcome__market', 'user'))
+    if 'comments' in sections:
+        comments = Comment.objects.filter(market=OuterRef('pk'))
+        markets = markets.annotate(comment_count=_count_subquery(comments, 'market', 'id'))
+    market = markets.first()
+    if market is None:
+        return FastJsonResponse({'error': 'Market not found.'}, status=404)
+    outcomes = {o.id: o for o in market.outcomes.all()}
+
+    user = request.user if request.user.is_authenticated else None
+    payload = {}
+    if 'market' in sections:
+        payload['market'] = _market_payload(market)
+
+    if 'ledger' in sections:
+        rows = (
+            Position.objects.filter(outcome_id__in=outcomes, shares__gt=0)
+            .order_by('-shares').values_list('user__username', 'outcome_id', 'shares')[:ledger_limit]
+        )
+        payload['ledger'] = {
+            'entries': [
+                {
+                    'username': username,
+                    'outcome': outcomes[outcome_id].name,
+                    'shares': shares,
+                    'value': shares * outcomes[outcome_id].current_price,
+                }
+                for username, outcome_id, shares in rows
+            ],
+            'total_bettors': market.bettors or 0,
+        }
+
+    if 'comments' in sections:
+        comments = Comment.objects.filter(market=market).order_by('-id').values_list(
+            'id', 'user__username', 'text', 'created_at'
+        )
+        if comments_before is not None:
+            comments = comments.filter(id__lt=comments_before)
+        page = list(comments[:comments_limit + 1])
+        payload['comments'] = {
+            'items': [
+                {'id': c_id, 'username': username, 'text': text, 'created_at': created_at.isoformat()}
+                for c_id, username, text, created_at in page[:comments_limit]
+            ],
+            'count': market.comment_count or 0,
+            'next_before': page[comments_limit - 1][0] if len(page) > comments_limit else None,
+        }
+
+    if 'position' in sections:
+        positions = []
+        if user is not None:
+            positions = [
+                {
+                    'outcome_id': outcome_id,
+                    'outcome': outcomes[outcome_id].name,
+                    'shares': shares,
+                    'value': shares * outcomes[outcome_id].current_price,
+                }
+                for outcome_id, shares in Position.objects.filter(user=user, outcome_id__in=outcomes)
+                .values_list('outcome_id', 'shares')
+            ]
+        payload['position'] = positions if user is not None else None
+
+    if 'me' in sections:
+        # The profile was loaded with the user by the authentication middleware.
+        payload['me'] = {'username': user.username, 'balance': user.userprofile.balance} if user else None
+
+    return FastJsonResponse(payload)
+
+
+def archived_market(request, slug):
+    """Read-only view of an archived market with its outcomes, positions, comments and trades."""
+    if request.method != 'GET':
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+
+    archived = archive.get_archived(slug)
+    if archived is None:
+        return FastJsonResponse({'error': 'Archived market not found.'}, status=404)
+    return FastJsonResponse(archive.archived_payload(archived))
+
+
+def export_data(request, kind):
+    """
+    Streams trades, positions or a ledger as CSV or NDJSON (staff only).
+    Query params: format=csv|ndjson, market=<slug>, user=<username>,
+    since/until=<ISO date or datetime> (trades only).
+    """
+    if not request.user.is_authenticated:
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
+    if not (request.user.is_staff or request.user.is_superuser):
+        return FastJsonResponse({'error': 'Permission denied.'}, status=403)
+
+    fmt = request.GET.get('format', 'csv')
+    if kind not in exports.EXPORTS or fmt not in exports.FORMATS:
+        return FastJsonResponse({'error': 'Unknown export kind or format.'}, status=404)
+
+    try:
+        filters = exports.resolve_filters(
+            market_slug=request.GET.get('market'),
+            username=request.GET.get('user'),
+            since=request.GET.get('since'),
+            until=request.GET.get('until'),
+        )
+    except ValueError as e:
+        return FastJsonResponse({'error': str(e)}, status=400)
+
+    response = StreamingHttpResponse(
+        exports.iter_export(kind, fmt, **filters),
+        content_type=exports.FORMATS[fmt],
+    )
+    response['Content-Disposition'] = f'attachment; filename="{kind}.{fmt}"'
+    return response
+
+
+@csrf_exempt
+def import_markets(request):
+    """
+    Bulk-creates markets from a CSV or JSONL body (staff only).
+    Format comes from ?format=csv|jsonl or the Content-Type. Rows that fail
+    validation are reported by row number; the rest are still created.
+    """
+    if request.method != 'POST':
+        return FastJsonResponse({'error': 'Method not allowed.'}, status=405)
+    if not request.user.is_authenticated:
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
+    if not (request.user.is_staff or request.user.is_superuser):
+        return FastJsonResponse({'error': 'Permission denied.'}, status=403)
+
+    fmt = request.GET.get('format')
+    if not fmt:
+        fmt = 'csv' if request.content_type == 'text/csv' else 'jsonl'
+    if fmt not in importing.FORMATS:
+        return FastJsonResponse({'error': 'Unknown format.'}, status=400)
+
+    try:
+        rows = importing.parse_rows(request.body.decode('utf-8'), fmt)
+    except UnicodeDecodeError:
+        return FastJsonResponse({'error': 'Body must be UTF-8.'}, status=400)
+
+    result = importing.import_markets(rows, created_by=request.user)
+    return FastJsonResponse(result)
+
+
+def request_profiles(request, profile_id=None):
+    """
+    Stored request profiles (staff only): newest first without details, or
+    one profile in full with its SQL and call stacks.
+    """
+    if not request.user.is_authenticated:
+        return FastJsonResponse({'error': 'Authentication required.'}, status=401)
+    if not (request.user.is_staff or request.user.is_superuser):
+        return FastJsonResponse({'error': 'Permission denied.'}, status=403)
+
+    if profile_id is None:
+        return FastJsonResponse({'profiles': profiling.summaries()})
+    profile = profiling.load(profile_id)
+    if profile is None:
+        return FastJsonResponse({'error': 'Profile not found.'}, status=404)
+    return FastJsonResponse(profile)